@@ -0,0 +1,102 @@
+"""Beam search (TEST_beam) vs. the learned DP (TEST_left_prune_bayes) on JOB.
+
+For every query, plans with the DP and with TEST_beam at each beam width,
+and reports planning time and plan quality: the PG cost of the chosen plan
+and, with --execute, its latency.  Every planner starts from an empty PG
+cost cache and calibration cache, so planning times are comparable.
+
+Usage:
+    python3 beam_benchmark.py --modelpath <prefix of the per-level .pth files>
+        [--queries 1a 2a ...] [--widths 1 5 10 20] [--execute]
+"""
+import argparse
+import math
+import os
+import time
+
+import torch
+
+from util import DP, envs, plans_lib, postgres, search, treeconv_dropout
+
+JOB_QUERIES = ['{}{}'.format(i, v) for v in 'ab' for i in range(1, 34)]
+
+
+def LoadModels(maxLevel, modelpath):
+    """Per-level models modelpath + '<level>.pth'; untrained if missing."""
+    modellist = ['blank', 'blank']
+    for i in range(2, maxLevel + 1):
+        path = modelpath + str(i) + '.pth'
+        if os.path.exists(path):
+            model = torch.load(path, map_location=search.DEVICE)
+        else:
+            print('no model for level', i, 'at', path)
+            model = treeconv_dropout.TreeConvolution(820, 123, 1)
+        modellist.append(model.to(search.DEVICE))
+    return modellist
+
+
+def Plan(planner, sqlfile, workload, model_levels, nodeFeaturizer, **kwargs):
+    """Returns (hint, final plan Node, planning seconds)."""
+    join_graph, all_join_conds, query_leaves, dp_tables = DP.getPreCondition(sqlfile)
+    if DP.dp.calibration_cache is not None:
+        DP.dp.calibration_cache.Clear()
+    start = time.time()
+    hint, finnode = planner(join_graph, all_join_conds, query_leaves, dp_tables, workload, model_levels,
+                            nodeFeaturizer, {}, **kwargs)
+    return hint, finnode, time.time() - start
+
+
+def GeometricMean(values):
+    return math.exp(sum(math.log(v) for v in values) / len(values))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--modelpath', required=True)
+    parser.add_argument('--queries', nargs='+', default=JOB_QUERIES)
+    parser.add_argument('--widths', nargs='+', type=int, default=[1, 5, 10, 20])
+    parser.add_argument('--execute', action='store_true',
+                        help='Also measure the latency of each plan.')
+    args = parser.parse_args()
+
+    workload = envs.JoinOrderBenchmark(envs.JoinOrderBenchmark.Params())
+    workload.workload_info.table_num_rows = postgres.GetAllTableNumRows(workload.workload_info.rel_names)
+    nodeFeaturizer = plans_lib.PhysicalTreeNodeFeaturizer(workload.workload_info)
+    sqlfiles = ['join-order-benchmark/' + q + '.sql' for q in args.queries]
+    maxLevel = max(len(DP.getPreCondition(f)[2]) for f in sqlfiles)
+    model_levels = LoadModels(maxLevel, args.modelpath)
+
+    planners = [('dp', DP.dp.TEST_left_prune_bayes, {})]
+    for width in args.widths:
+        planners.append(('beam{}'.format(width), DP.dp.TEST_beam, {'beam_width': width}))
+    # name -> [(seconds, cost, latency)], one per query.
+    results = {name: [] for name, _, _ in planners}
+    for query, sqlfile in zip(args.queries, sqlfiles):
+        with open(sqlfile, 'r') as f:
+            sql = ' '.join(f.read().splitlines())
+        row = [query]
+        for name, planner, kwargs in planners:
+            hint, finnode, seconds = Plan(planner, sqlfile, workload, model_levels, nodeFeaturizer, **kwargs)
+            latency = None
+            if args.execute:
+                latency = postgres.GetLatencyFromPg(sql, hint, verbose=False, check_hint_used=False,
+                                                    timeout=90000, dropbuffer=False)
+            results[name].append((seconds, finnode.info['cost'], latency))
+            row.append('{}: {:.2f}s cost {:.3g}{}'.format(
+                name, seconds, finnode.info['cost'],
+                '' if latency is None else ' latency {:.1f}ms'.format(latency)))
+        print(' | '.join(row))
+
+    print('\n{:>8} {:>12} {:>15} {:>18}'.format('planner', 'plan time s', 'cost vs dp', 'latency vs dp'))
+    for name, _, _ in planners:
+        seconds = sum(r[0] for r in results[name])
+        cost_ratio = GeometricMean([r[1] / d[1] for r, d in zip(results[name], results['dp'])])
+        latency_ratio = '-'
+        if args.execute:
+            latency_ratio = '{:.3f}'.format(
+                GeometricMean([r[2] / d[2] for r, d in zip(results[name], results['dp'])]))
+        print('{:>8} {:>12.1f} {:>15.3f} {:>18}'.format(name, seconds, cost_ratio, latency_ratio))
+
+
+if __name__ == '__main__':
+    main()
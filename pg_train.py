@@ -12,7 +12,7 @@ import numpy as np
 import torch
 from torch import nn
 
-from util import treeconv, postgres, envs
+from util import treeconv, postgres, envs, pair_loss
 
 DEVICE = 'cuda:1' if torch.cuda.is_available() else 'cpu'
 
@@ -105,29 +105,6 @@ def load_sql(sql_list: list):
     return sqls
 
 
-def calculateLossForBatch(latencies: list, costs: list, calibration: torch.Tensor):
-    """
-    :param latencies: real latency
-    :param costs: PG estimated cost
-    :param calibration: ML model's calibration for cost
-    :return: loss to learn the ML model
-    """
-    loss_fn = nn.CrossEntropyLoss(reduction='none')
-    calibration = calibration.view(-1, 2)
-    costs = torch.tensor(costs, device=DEVICE).view(-1, 2)
-    calibratedCost = calibration * costs
-    softm = nn.functional.softmax(calibratedCost, dim=1)
-    assert (2 * len(costs) == len(latencies)) and (len(latencies) % 2 == 0)
-    res = []
-    for i in range(0, len(latencies), 2):
-        if latencies[i] > latencies[i + 1]:
-            res.append(0)
-        else:
-            res.append(1)
-    res = torch.tensor(res, device=DEVICE)
-    return loss_fn(softm, res)
-
-
 def load_nodes(nodesPath):
     if not os.path.exists(nodesPath):
         raise IOError("nodes files Not Exists!", nodesPath)
@@ -352,33 +329,32 @@ if __name__ == '__main__':
             optimizer = torch.optim.AdamW(models[modelnum].parameters(), lr=learning_rate)
             if len(trainpair[modelnum]) < 1:
                 continue
+            # 每个 pair 的 cost 与 label 只算一次, 放到 DEVICE 上按 batch 取
+            pairCosts, pairLabels = pair_loss.PairTargets([[i[1], i[4]] for i in trainpair[modelnum]],
+                                                          [[i[2], i[5]] for i in trainpair[modelnum]])
+            pairCosts, pairLabels = pairCosts.to(DEVICE), pairLabels.to(DEVICE)
             for epoch in range(0, 10000):
                 shuffled_indices = np.random.permutation(len(trainpair[modelnum]))
                 # train
                 current_idx = 0
                 while current_idx <= len(shuffled_indices):
-                    currentTrainPair = [trainpair[modelnum][idx] for idx in
-                                        shuffled_indices[current_idx: current_idx + batchsize]]
+                    batchIdx = shuffled_indices[current_idx: current_idx + batchsize]
+                    currentTrainPair = [trainpair[modelnum][idx] for idx in batchIdx]
+                    batchIdx = torch.from_numpy(batchIdx).to(DEVICE)
                     query_feats = []
                     nodes = []
-                    latencies = []
-                    costs = []
                     for i in currentTrainPair:
                         query_feats.append(i[0][0])
                         query_feats.append(i[3][0])
                         nodes.append(i[0][1])
                         nodes.append(i[3][1])
-                        latencies.append(i[1])
-                        latencies.append(i[4])
-                        costs.append(i[2])
-                        costs.append(i[5])
                     query_feats = (torch.cat(query_feats, dim=0)).to(DEVICE)
                     trees, indexes = encoding.TreeConvFeaturize(nodeFeaturizer, nodes)
                     if torch.cuda.is_available():
                         trees = trees.to(DEVICE)
                         indexes = indexes.to(DEVICE)
                     calibration = torch.tanh(models[modelnum](query_feats, trees, indexes).to(DEVICE)).add(1)
-                    temloss = calculateLossForBatch(latencies, costs, calibration)
+                    temloss = pair_loss.CrossEntropyLoss(calibration, pairCosts[batchIdx], pairLabels[batchIdx])
                     #  reg =torch.mean(((calibration.sub(1).mul(calibration.sub(1)))*gamma).squeeze(1), 0)
                     losslist = temloss.tolist()
                     loss = torch.mean(temloss, 0)
@@ -389,45 +365,30 @@ if __name__ == '__main__':
                     current_idx += batchsize
 
                 cout = len(shuffled_indices)
-                acc = 0
+                acc = torch.zeros((), dtype=torch.long, device=DEVICE) # 在 DEVICE 上累加, 每个 epoch 读一次
                 current_idx = 0
                 #  test
                 while current_idx <= len(shuffled_indices):
-                    currentTrainPair = [trainpair[modelnum][idx] for idx in
-                                        shuffled_indices[current_idx: current_idx + batchsize]]
+                    batchIdx = shuffled_indices[current_idx: current_idx + batchsize]
+                    currentTrainPair = [trainpair[modelnum][idx] for idx in batchIdx]
+                    batchIdx = torch.from_numpy(batchIdx).to(DEVICE)
                     query_feats = []
                     nodes = []
-                    latencies = []
-                    costs = []
                     for i in currentTrainPair:
                         query_feats.append(i[0][0])
                         query_feats.append(i[3][0])
                         nodes.append(i[0][1])
                         nodes.append(i[3][1])
-                        latencies.append(i[1])
-                        latencies.append(i[4])
-                        costs.append(i[2])
-                        costs.append(i[5])
                     query_feats = (torch.cat(query_feats, dim=0)).to(DEVICE)
                     trees, indexes = encoding.TreeConvFeaturize(nodeFeaturizer, nodes)
                     if torch.cuda.is_available():
                         trees = trees.to(DEVICE)
                         indexes = indexes.to(DEVICE)
                     calibration = torch.tanh(models[modelnum](query_feats, trees, indexes).to(DEVICE)).add(1)
-                    calibration = calibration.view(-1, 2)
-                    costs = torch.tensor(costs, device=DEVICE).view(-1, 2)
-                    calibratedCost = calibration * costs
-                    softm = nn.functional.softmax(calibratedCost, dim=1)
-                    prediction = torch.max(softm, dim=1)[1]
-                    res = []
-                    for i in range(0, len(latencies), 2):
-                        if latencies[i] > latencies[i + 1]:
-                            res.append(0)
-                        else:
-                            res.append(1)
-                    res = torch.tensor(res, device=DEVICE)
+                    softm = pair_loss.Probabilities(calibration, pairCosts[batchIdx])
                     current_idx += batchsize
-                    acc += torch.sum(res == prediction).data.cpu().numpy().squeeze()
+                    acc += pair_loss.NumCorrect(softm, pairLabels[batchIdx])
+                acc = acc.item()
                 logger.info("iter:{},model:{},train iters：{}，acc:{} ".format(iter, modelnum, epoch + 1, acc / cout))
                 if acc / cout > 0.96 or epoch > 10:
                     modelname = log_dir + '/model_' + str(modelnum) + '.pth'
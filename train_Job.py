@@ -1,10 +1,8 @@
-import copy
 import datetime
 import gc
 import logging
 import math
 import os
-import pickle
 import random
 import time
 
@@ -12,8 +10,9 @@ import numpy as np
 import torch
 from torch import nn
 
-from util import postgres, envs, treeconv_dropout, DP
-from util.encoding import TreeConvFeaturize
+from util import postgres, envs, treeconv_dropout, DP, parallel
+from util import checkpoint, experience, explog, feature_store, level_training, pair_loss
+from util.encoding import PairQueryEncoding, TreeConvFeaturize
 
 
 def getexpnum(exp):
@@ -34,40 +33,6 @@ def seed_torch(seed=3407):
     torch.backends.cudnn.deterministic = True
 
 
-def getTrainPair(output1, output2, trainpair):
-    """
-    在 output1 和 output2 相同 level 中, 找满足条件的 pair
-
-    return
-    trainpair[level]
-    对于每个 level 中的一项，[encoding_j, lantency_j, cost_j, encoding_k, lantency_k, cost_k]
-    """
-    for i in range(0, len(output1)): # 遍历 level
-        if len(output1[i]) == 0 or len(output2[i]) == 0:
-            continue
-        for j in output1[i]:
-            for k in output2[i]:
-                if (j[2] == k[2]) and (j[1] == k[1]): # hint 和 sql 相同
-                    #  print('equal')
-                    continue
-                if (j[3] == k[3]): # latency 相同
-                    #  print('equal')
-                    continue
-                if (j[6] != k[6]): # join_ids 不一样
-                    continue
-                tem = []
-                # encoding
-                tem.append(j[4])
-                # latency
-                tem.append(j[3])
-                # cost
-                tem.append(j[0])
-                tem.append(k[4])
-                tem.append(k[3])
-                tem.append(k[0])
-                trainpair[i].append(tem)
-
-
 def getBestTrainPair(output1, output2):
     trainpair = [[] for _ in range(20)]
     for i in range(0, len(output1)):
@@ -103,54 +68,6 @@ def getPartTrainPair(alltrainpair, rate=0.2):
     return sortlist[0:int(len(alltrainpair) * rate)]
 
 
-def calculateLossForBatch(latencies: list, costs: list, calibration: torch.Tensor):
-    """
-    :param latencies: real latency
-    :param costs: PG estimated cost
-    :param calibration: ML model's calibration for cost
-    :return: loss to learn the ML model
-    """
-    loss_fn = nn.CrossEntropyLoss(reduction='none')
-    calibration = calibration.view(-1, 2)
-    costs = torch.tensor(costs, device=DEVICE).view(-1, 2)
-    calibratedCost = calibration * costs
-    softm = nn.functional.softmax(calibratedCost, dim=1)
-    assert (2 * len(costs) == len(latencies)) and (len(latencies) % 2 == 0)
-    res = []
-    for i in range(0, len(latencies), 2):
-        if latencies[i] > latencies[i + 1]:
-            res.append(0)
-        else:
-            res.append(1)
-    res = torch.tensor(res, device=DEVICE)
-    return loss_fn(softm, res)
-
-
-def calculateLossForBatch_MR_0(latencies: list, costs: list, calibration: torch.Tensor):
-    """
-    :param latencies: real latency
-    :param costs: PG estimated cost
-    :param calibration: ML model's calibration for cost
-    :return: loss to learn the ML model
-    """
-    loss_fn = nn.MarginRankingLoss()
-    calibration = calibration.view(-1, 2)
-    costs = torch.tensor(costs, device=DEVICE).view(-1, 2)
-    calibratedCost = calibration * costs
-    c1, c2 = torch.chunk(calibratedCost, 2, dim=1)
-    c1 = torch.squeeze(c1)
-    c2 = torch.squeeze(c2)
-    assert (2 * len(costs) == len(latencies)) and (len(latencies) % 2 == 0)
-    res = []
-    for i in range(0, len(latencies), 2):
-        if latencies[i] > latencies[i + 1]:
-            res.append(1)
-        else:
-            res.append(-1)
-    res = torch.tensor(res, device=DEVICE)
-    return loss_fn(c1, c2, res)
-
-
 def geometric_mean(data):  # 计算几何平均数
     total = 1
     for i in data:
@@ -216,11 +133,7 @@ def collects(finnode, workload, exp, timeout):
                                      with_select_exprs=True)
 
         temhint = currentChild.hint_str()
-        found = False
-        for i in exp[temlevel]:
-            if (i[1] == temsql and i[2] == temhint):
-                found = True
-                break
+        found = experience.FindEntry(exp[temlevel], temsql, temhint) is not None
         if not found:
             tem = []
             tem.append(math.log(currentChild.info["cost"]))
@@ -234,13 +147,13 @@ def collects(finnode, workload, exp, timeout):
                 tem.append([currentChild.info["encoding"], currentChild.info["node"]])
                 tem.append(currentChild)
                 tem.append(currentChild.info["join_ids"])
-                exp[temlevel].append(copy.deepcopy(tem))
+                exp[temlevel].append(tem)
             else:
                 tem.append(nodelatency)
                 tem.append([currentChild.info["encoding"], currentChild.info["node"]])
-                tem.appedn(currentChild)
+                tem.append(currentChild)
                 tem.append(currentChild.info["join_ids"])
-                exp[temlevel].append(copy.deepcopy(tem))
+                exp[temlevel].append(tem)
     while (allPlans):
         currentNode = allPlans.pop()
         allPlans.extend(currentNode.children)
@@ -253,11 +166,7 @@ def collects(finnode, workload, exp, timeout):
                                              with_select_exprs=True)
                 #    print(temsql)
                 temhint = currentChild.hint_str()
-                found = False
-                for i in exp[temlevel]:
-                    if (i[1] == temsql and i[2] == temhint):
-                        found = True
-                        break
+                found = experience.FindEntry(exp[temlevel], temsql, temhint) is not None
                 if not found:
                     tem = []
                     tem.append(math.log(currentChild.info["cost"]))
@@ -271,21 +180,38 @@ def collects(finnode, workload, exp, timeout):
                         tem.append([currentChild.info["encoding"], currentChild.info["node"]])
                         tem.append(currentChild)
                         tem.append(currentChild.info["join_ids"])
-                        exp[temlevel].append(copy.deepcopy(tem))
+                        exp[temlevel].append(tem)
                     else:
                         tem.append(nodelatency)
                         tem.append([currentChild.info["encoding"], currentChild.info["node"]])
                         tem.append(currentChild)
                         tem.append(currentChild.info["join_ids"])
-                        exp[temlevel].append(copy.deepcopy(tem))
+                        exp[temlevel].append(tem)
+
+
+def pinBestPlans(nodes, exp):
+    """
+    exp 有容量上限时, 把当前 best plan 的所有 subplan 钉在 exp 中, 不被淘汰 (上一轮的 pin 先清空)
+    """
+    exp.ClearPins()
+    allPlans = [node for node in nodes if node is not None]
+    while allPlans:
+        currentNode = allPlans.pop()
+        allPlans.extend(currentNode.children)
+        temlevel = currentNode.info.get("currentLevel")
+        if (not temlevel == None) and temlevel > 1:
+            exp.Pin(temlevel, currentNode.to_sql(currentNode.info["join_conds"], with_select_exprs=True),
+                    currentNode.hint_str())
 
 
-def getGMRL(sqls, modellist, pg_latency, nodeFeaturizer, costCache, workload, exp=None, old=None):
+def getGMRL(sqls, modellist, pg_latency, nodeFeaturizer, costCache, workload, exp=None, old=None, planWorkers=1,
+            planBudget=None):
     '''
     计算 一组SQL查询的几何平均相对延迟(Geometric Mean of Relative Latencies, GMRL) 一种评估查询优化模型性能的指标
-    - 遍历 sql
+    - 遍历 sql (planWorkers > 1 时多进程并行)
         - 获取 预处理条件
         - 获得 best plan hint和最终node, 使用了剪枝
+        - planBudget (秒) 不为 None 时使用 TEST_anytime: 超时返回目前最好的完整 plan, 都没有则用 PG 自己的 plan
     - 遍历 sql
         - 计算 3次latency平均值
         - 计算 latency平均值和pg_latency 的相对延迟alllatency
@@ -296,15 +222,28 @@ def getGMRL(sqls, modellist, pg_latency, nodeFeaturizer, costCache, workload, ex
     hints = []
     alllatency = []
     nodes = []
-    for i in sqls:
-        join_graph, all_join_conds, query_leaves, origin_dp_tables = DP.getPreCondition(
-            'join-order-benchmark/' + i + '.sql')
-        # TEST_left_prune_bayes
-        bestplanhint, finnode = DP.dp.TEST_left_prune_bayes(join_graph, all_join_conds, query_leaves, origin_dp_tables,
-                                                            workload,
-                                                            modellist, nodeFeaturizer, costCache)
-        hints.append(bestplanhint)
-        nodes.append(finnode)
+    if planWorkers > 1 and planBudget is None:
+        for bestplanhint, finnode in parallel.PlanTestQueries(planWorkers,
+                                                              ['join-order-benchmark/' + i + '.sql' for i in sqls],
+                                                              workload, nodeFeaturizer, modellist, costCache):
+            hints.append(bestplanhint)
+            nodes.append(finnode)
+    else:
+        for i in sqls:
+            join_graph, all_join_conds, query_leaves, origin_dp_tables = DP.getPreCondition(
+                'join-order-benchmark/' + i + '.sql')
+            if planBudget is None:
+                # TEST_left_prune_bayes (search_space 'beam' 时为 TEST_beam)
+                bestplanhint, finnode = DP.dp.PlanTest(join_graph, all_join_conds, query_leaves,
+                                                       origin_dp_tables, workload,
+                                                       modellist, nodeFeaturizer, costCache)
+            else:
+                bestplanhint, finnode, stats = DP.dp.TEST_anytime(join_graph, all_join_conds, query_leaves,
+                                                                  origin_dp_tables, workload, modellist,
+                                                                  nodeFeaturizer, costCache, planBudget)
+                print(i, 'anytime', stats)
+            hints.append(bestplanhint)
+            nodes.append(finnode)
     for i in range(0, len(sql_)):
         tem = 0
         for j in range(0, 3):
@@ -313,9 +252,11 @@ def getGMRL(sqls, modellist, pg_latency, nodeFeaturizer, costCache, workload, ex
             tem = tem + latency
         print(sqls[i], tem / 3.0, pg_latency[i], (tem / 3.0) / pg_latency[i])
         alllatency.append((tem / 3.0) / pg_latency[i])
+    if exp is not None and exp.capacity is not None:
+        pinBestPlans(nodes, exp)
     if old != None:
         for i in range(len(sqls)):
-            if alllatency[i] > 1.4:
+            if alllatency[i] > 1.4 and finnode is not None:
                 print('degradation collect')
                 collects(finnode, workload, exp, old[i])
     return geometric_mean(alllatency)
@@ -349,6 +290,93 @@ def getModelsFromFile(maxLevel, modelpath):
     return modellist, optlist
 
 
+def getSharedModels(maxLevel, modelpath=None):
+    """
+    所有 level 共享一个 MultiLevelTreeConvolution (带 level embedding) 和一个 optimizer
+    model_levels[level] 是共享模型在该 level 的 view, 调用方式与 TreeConvolution 相同
+    """
+    if modelpath is not None and os.path.exists(modelpath + 'shared.pth'):
+        model = torch.load(modelpath + 'shared.pth').to(DEVICE if torch.cuda.is_available() else 'cpu')
+        print('load succssful shared')
+    else:
+        model = treeconv_dropout.MultiLevelTreeConvolution(820, 123, 1, maxLevel).to(DEVICE)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=0.001)
+    modellist = ['blank', 'blank'] + [model.ForLevel(i) for i in range(2, maxLevel + 1)]
+    optlist = ['blank', 'blank'] + [optimizer] * (maxLevel - 1)
+    return modellist, optlist
+
+
+def getTrainGroups(model_levels, sharedModel):
+    """
+    每个 level 的模型单独训练; 共享模型时所有 level 的 train pairs 合并, 一次训练
+    返回 [(name, levels)]
+    """
+    if sharedModel:
+        return [('shared', list(range(2, len(model_levels))))]
+    return [(modelnum, [modelnum]) for modelnum in range(2, len(model_levels))]
+
+
+def pairBatch(trainpair, featureStore, nodeFeaturizer, pairLevels, pairJ, pairK, pairCosts, pairLabels):
+    """
+    一个 batch 的模型输入: featureStore 不为 None 时 plan 特征从 memory-mapped 的 FeatureStore 读取, 只特征化一次
+    pairCosts / pairLabels: 该 batch 的 pair 的 cost 与 label, 训练前由 pair_loss.PairTargets 一次算好
+    返回 query_feats, query_index, trees, indexes, costs, labels; 在 BatchPrefetcher 的后台线程中调用, 由它拷贝到 DEVICE (见 level_training.TrainModel)
+    """
+    # query_feats, nodes: 每个 pair 依次为 j, k; j 和 k 的 join_ids 相同, 但可能来自不同的 sql (过滤条件不同, query vector 也不同)
+    # 所以 query vector 只在 sql 相同的 plan 之间共享
+    query_feats, nodes, _, _ = trainpair.Gather(pairLevels, pairJ, pairK)
+    if featureStore is None:
+        trees, indexes = TreeConvFeaturize(nodeFeaturizer, nodes)
+    else:
+        trees, indexes = featureStore.Featurize(nodeFeaturizer, trainpair.Keys(pairLevels, pairJ, pairK), nodes)
+    query_feats, query_index = PairQueryEncoding(query_feats, 'cpu', trainpair.QueryKeys(pairLevels, pairJ, pairK))
+    return query_feats, query_index, trees, indexes, pairCosts, pairLabels
+
+
+def trackFeatures(exp, featureStore, nodeFeaturizer):
+    """
+    只有 exp 的经验存入 featureStore (DP 打分的候选不存): 已有的经验现在存, 新经验加入 exp 时存, 被淘汰时删除
+    query vector 按 (sql, join_ids) 只存一份
+    """
+    def put(level, entry):
+        featureStore.Put((entry[1], entry[2]), entry[4][1], entry[4][0], nodeFeaturizer, (entry[1], entry[6]))
+
+    def remove(level, entry):
+        if exp.Find(entry[1], entry[2]) is None:
+            featureStore.Remove((entry[1], entry[2]))
+
+    for level, entries in enumerate(exp):
+        for entry in entries:
+            put(level, entry)
+    exp.on_append.append(put)
+    exp.on_evict.append(remove)
+
+
+def modelStates(model_levels):
+    """
+    所有 level 模型的 state_dict (共享模型只存一份), 写入 checkpoint
+    """
+    if isinstance(model_levels[2], treeconv_dropout.LevelView):
+        return {'shared': model_levels[2].model.state_dict()}
+    return {modelnum: model_levels[modelnum].state_dict() for modelnum in range(2, len(model_levels))}
+
+
+def loadModelStates(model_levels, states):
+    if 'shared' in states:
+        model_levels[2].model.load_state_dict(states['shared'])
+        return
+    for modelnum, state in states.items():
+        model_levels[modelnum].load_state_dict(state)
+
+
+def saveModels(model_levels, prefix):
+    if isinstance(model_levels[2], treeconv_dropout.LevelView):
+        torch.save(model_levels[2].model, prefix + 'shared.pth')
+        return
+    for modelnum in range(2, len(model_levels)):
+        torch.save(model_levels[modelnum], prefix + str(modelnum) + '.pth')
+
+
 def setInitialTimeout(sqls: list, dropbuffer, testtime=3):
     """
     :param sqls: list of sql string
@@ -429,28 +457,62 @@ if __name__ == '__main__':
     log_file_name = os.path.join(log_dir, "running_log")
     logger = get_logger(log_file_name)
     logger.info(config)
-    trainpair = [[] for _ in range(20)]
     ########################################################
     FirstTrain = True
+    sharedModel = False # 所有 level 共享一个模型 (level embedding), 见 getSharedModels
+    planWorkers = 1 # > 1 时各 sql 的 DP 在进程池中并行规划, 见 util/parallel.py
+    planBudget = None # 评估时每个 sql 的规划时间上限 (秒), 见 DynamicProgramming.TEST_anytime
+    pairCap = None # 每个 (level, join_ids) 桶最多生成的 train pair 数, None 不限
+    pairSampleRate = 1.0 # 新 train pair 的保留概率
+    expCapacity = None # exp 每个 level 最多保留的经验数 (int 或按 level 的 list), None 不限
+    expEviction = 'oldest' # exp 满时的淘汰策略: 'oldest' / 'reservoir' / 'information', 见 ExperiencePool
+    finexpCapacity = expCapacity # finexp (best plan 的子计划) 每个 level 最多保留的数目, 淘汰最旧的
+    prioritizedReplay = False # 按 pair 的 priority (模型与 label 的分歧) 采样 train pairs
+    featureStorePath = None # 不为 None 时 plan 特征只计算一次, 存入该目录的 memory-mapped 文件, 见 util/feature_store.py
+    prefetchWorkers = 1 # 后台构建 batch 的线程数, 0 为同步构建
+    prefetchDepth = 2 # 提前构建的 batch 数
+    trainCores = 1 # > 1 时各 level 的模型在进程池中并行训练, 共用这么多 CPU 核, 见 util/level_training.py (共享模型时不生效)
+    trainThreads = None # 并行训练时每个模型的 torch 线程数, None 为 trainCores 按模型数均分
+    resumeCheckpoint = None # 上次运行 log_dir 下的 checkpoint.pt: 恢复完整训练状态, 从下一轮继续, 见 util/checkpoint.py
     ########################################################
+    ckpt = None if resumeCheckpoint is None else checkpoint.Load(resumeCheckpoint, map_location='cpu')
+    featureStore = None
+    if featureStorePath is not None:
+        featureStore = feature_store.FeatureStore(featureStorePath)
+        DP.dp.feature_store = featureStore # DP 打分 (UCB / calibration) 也从 FeatureStore 读取经验的特征
+    # train pair 按 (level, join_ids) 分桶增量生成, 见 util/experience.py PairIndex
+    trainpair = experience.PairIndex(20, max_pairs_per_bucket=pairCap, sample_rate=pairSampleRate)
     seed_torch()
-    if FirstTrain:
-        exp = [[] for _ in range(20)] # exp 经验池 E 
-        finexp = [[] for _ in range(20)]
+    if ckpt is not None:
+        # explog 重放到 checkpoint 时的位置并继续追加; train pair 从 snapshot 恢复, 不重建
+        state = explog.Load(*ckpt['explog'])
+        expLog = explog.ExperienceLog(ckpt['explog'][0], resume=state)
+        exp = experience.ExperiencePool(state['pools']['exp'], capacity=expCapacity, policy=expEviction,
+                                        pinned=ckpt['pinned'])
+        for entries, seen in zip(exp, ckpt['seen']):
+            entries.seen = seen
+        finexp = experience.ExperiencePool(state['pools']['finexp'], capacity=finexpCapacity)
+        costCache = state['dicts']['cost']
+        trainpair = experience.PairIndex.FromSnapshot(ckpt['trainpair'], exp)
+        FirstTrain = ckpt['FirstTrain']
+        print('resume from checkpoint, iter', ckpt['iter'])
+    elif FirstTrain:
+        exp = experience.ExperiencePool(20, capacity=expCapacity, policy=expEviction) # exp 经验池 E, 按 (sql, hint) 和 join_ids 建索引
+        finexp = experience.ExperiencePool(20, capacity=finexpCapacity)
         costCache = {}
     else:
-        b_file = open('', 'rb')
-        exp = pickle.load(b_file)
+        state = explog.Load('') # 上次运行的 explog_*.log, 逐 chunk 重放
+        exp = experience.ExperiencePool(state['pools']['exp'], capacity=expCapacity, policy=expEviction)
         modelpath = ''
-        b_file.close()
-        c_file = open('', 'rb')
-        costCache = pickle.load(c_file)
-        c_file.close()
-        d_file = open('', 'rb')
-        finexp = pickle.load(d_file)
-        d_file.close()
-        getTrainPair(exp, exp, trainpair)
+        costCache = state['dicts']['cost']
+        finexp = experience.ExperiencePool(state['pools']['finexp'], capacity=finexpCapacity)
+        trainpair.AddAll(exp, exp)
         print('load exp bestsubplans costcache success !!')
+    if ckpt is None:
+        expLog = explog.ExperienceLog(os.path.join(log_dir, 'explog_' + logs_name + '.log')) # 每轮追加一个 chunk, 见 util/explog.py
+    exp.information = trainpair.Information # 'information' 淘汰: 先淘汰 pair priority 之和最小的经验
+    exp.on_evict.append(trainpair.Remove) # 被淘汰的经验及其 train pair 一并删除
+    exp.Evict() # 'information' 只在经验加入 trainpair 之后淘汰, 见 ExperiencePool.Evict
     allstime = time.time()
     workload = envs.JoinOrderBenchmark(envs.JoinOrderBenchmark.Params())
     workload.workload_info.table_num_rows = postgres.GetAllTableNumRows(workload.workload_info.rel_names) # workload_info 存 sets of possible relations/aliases/join types
@@ -487,14 +549,21 @@ if __name__ == '__main__':
     bestplanslist = [[] for _ in range(len(sqls))] # 记录每个 sql 的 best plan hint
     iteration_num = 30
 
-    # initial timeout and it will update in dp
-    timeoutlist = setInitialTimeout(sqls, dropbuffer, testtime=3) # 获得一组 sql 的平均执行时间
-    pg_latency_train = getPG_latency(trainsqls) # 获得一组 sql 的 latency，存在列表中
+    if ckpt is None:
+        # initial timeout and it will update in dp
+        timeoutlist = setInitialTimeout(sqls, dropbuffer, testtime=3) # 获得一组 sql 的平均执行时间
+        pg_latency_train = getPG_latency(trainsqls) # 获得一组 sql 的 latency，存在列表中
+        pg_latency_test = getPG_latency(testsqls)
+        train_gmrl = []
+        test_gmrl = []
+    else: # 恢复时不再执行 sql 测 latency
+        timeoutlist, pg_latency_train, pg_latency_test = ckpt['timeoutlist'], ckpt['pg_latency_train'], ckpt[
+            'pg_latency_test']
+        train_gmrl, test_gmrl, dp_Signs = ckpt['train_gmrl'], ckpt['test_gmrl'], ckpt['dp_Signs']
+        for i, plans in enumerate(state['lists'].get('bestplans', [])):
+            bestplanslist[i] = plans
     print('pg_base_latency_train', pg_latency_train)
-    pg_latency_test = getPG_latency(testsqls)
     print('pg_base_latency_test', pg_latency_test)
-    train_gmrl = []
-    test_gmrl = []
     logger.info("timeoutList:{}".format(timeoutlist))
     batchsize = 256
     DEVICE = 'cuda:2' if torch.cuda.is_available() else 'cpu'
@@ -503,6 +572,8 @@ if __name__ == '__main__':
     bestTrainGmrl = 20
     bestTestGmrl = 20
     decay = greedy / (iteration_num * 2)
+    if ckpt is not None:
+        greedy, bestTrainGmrl, bestTestGmrl = ckpt['greedy'], ckpt['bestTrainGmrl'], ckpt['bestTestGmrl']
     # ```````````````
     model_levels = []
     loss_fn = ''
@@ -522,12 +593,14 @@ if __name__ == '__main__':
                 c) 获得 train pairs用来后续训练
             - 判断 timeoutlist[i] 比 pg_latency_train[i] 小很多时, dp_Signs[i] 为 False
         - 遍历 所有levels的model
-            - 获得 当前 level 的 optimizer, temtrainpair
+            - 获得 当前 level 的 optimizer, train pairs 的下标
                 - 迭代 500个epoch; train, test, 每个 batch 跑10次
         - getGMRL
     """
     nodeFeaturizer = plans_lib.PhysicalTreeNodeFeaturizer(workload.workload_info) # 对单个 node 提取 node feature
-    dpsign = True
+    if featureStore is not None:
+        trackFeatures(exp, featureStore, nodeFeaturizer)
+    dpsign = True if ckpt is None else ckpt['dpsign']
     for i in range(0, len(sqls)): # 这里的循环主要为了获得 maxLevel 
         '''
         DP.getPreCondition  将一个 SQL 查询预处理为查询优化所需的数据结构和信息
@@ -538,21 +611,43 @@ if __name__ == '__main__':
         origin_dp_tables 每个 level 有一个 dp table
         '''
         join_graph, all_join_conds, query_leaves, origin_dp_tables = DP.getPreCondition(sqllist[i])
-        dp_tables1 = copy.deepcopy(origin_dp_tables)
         maxLevel = maxLevel if maxLevel > len(query_leaves) else len(query_leaves)
-    if not FirstTrain:
+    if sharedModel:
+        model_levels, optlist = getSharedModels(maxLevel, None if FirstTrain or ckpt is not None else modelpath)
+    elif not FirstTrain and ckpt is None:
         model_levels, optlist = getModelsFromFile(maxLevel, modelpath) # 获得 所有 level 的 model 和 optimizer 
     else:
         model_levels, optlist = getModels(maxLevel)
-
-    for iter in range(0, iteration_num):
+    startIter = 0
+    if ckpt is not None:
+        loadModelStates(model_levels, ckpt['models'])
+        checkpoint.LoadOptimizerStates(optlist, ckpt['optimizers'])
+        checkpoint.SetRngState(ckpt['rng'])
+        startIter = ckpt['iter'] + 1
+
+    for iter in range(startIter, iteration_num):
         logger.info('iter {} start!'.format(str(iter)))
         stime = time.time()
         levelList = [{} for _ in range(20)]
+        if planWorkers > 1:
+            # 各 sql 基于本轮开始时的 exp 快照并行规划, 按 sql 顺序合并 exp 和 costCache
+            planned = [i for i in range(0, len(sqls)) if dp_Signs[i]]
+            tasks = []
+            for i in planned:
+                tasks.append((sqllist[i], sqls[i], timeoutlist[i], greedy))
+                greedy = greedy - decay
+            results = parallel.PlanTrainQueries(planWorkers, tasks, workload, nodeFeaturizer, model_levels, exp,
+                                                costCache, finexp, FirstTrain=FirstTrain, dpsign=dpsign,
+                                                dropbuffer=dropbuffer)
+            for i, (output1, bestplanhint, num, timeout) in zip(planned, results):
+                timeoutlist[i] = round(timeout, 3)
+                bestplanslist[i].append([bestplanhint, num])
+                trainpair.AddAll(output1, exp)
+            exp.Evict()
         for i in range(0, len(sqls)):
-            if dp_Signs[i]:
-                join_graph, all_join_conds, query_leaves, origin_dp_tables = DP.getPreCondition(sqllist[i])
-                dp_tables1 = copy.deepcopy(origin_dp_tables)
+            if dp_Signs[i] and planWorkers <= 1:
+                # getPreCondition 每次都构建新的 dp_tables, 无需拷贝
+                join_graph, all_join_conds, query_leaves, dp_tables1 = DP.getPreCondition(sqllist[i])
                 '''
                 对某一个 sql 调用 UCB_left_prune_replay_fix_kl 在 search.py 中
 
@@ -575,7 +670,8 @@ if __name__ == '__main__':
                 greedy = greedy - decay
                 timeoutlist[i] = round(timeout, 3)
                 bestplanslist[i].append([bestplanhint, num])
-                getTrainPair(output1, exp, trainpair) # 获得满足条件的 train pair [encoding_j, lantency_j, cost_j, encoding_k, lantency_k, cost_k]
+                trainpair.AddAll(output1, exp) # 新经验与同桶经验组成 train pair (两个经验的下标)
+                exp.Evict() # 新经验有了 pair (priority) 后再淘汰, 'information' 不会先淘汰新经验
                 output1.clear()
             if timeoutlist[i] < pg_latency_train[i] * 0.68:
                 dp_Signs[i] = False
@@ -588,133 +684,71 @@ if __name__ == '__main__':
 
         logger.info('Train start ,iter ={} '.format(iter))
         logger.info(
-            'trainpair num ={},now experience num = {},best exp num  = {} '.format(getexpnum(trainpair), getexpnum(exp),
+            'trainpair num ={},now experience num = {},best exp num  = {} '.format(trainpair.NumPairs(), getexpnum(exp),
                                                                                    getexpnum(finexp))
         )
 
         trainTimes = 0
         testTimes = 0
         FirstTrain = False
-        for modelnum in range(2, len(model_levels)):
-            optimizer = optlist[modelnum] # 获取 当前 level 的 optimizer
-            temtrainpair = copy.deepcopy(trainpair[modelnum]) # 深拷贝 当前 level 的所有 train pairs
-            if len(temtrainpair) < 2:
-                continue
-            for epoch in range(0, 500): # 迭代 500次训练周期
-                ttime = time.time()
-                shuffled_indices = np.random.permutation(len(temtrainpair)) # 创建 shuffle后的索引数组
-                # ----------- train -----------
-                # 数据预处理，前向传播，计算损失函数，反向传播以及优化器的更新
-                current_idx = 0
-                while current_idx < len(shuffled_indices): # 遍历 batches
-                    currentTrainPair = [temtrainpair[idx] for idx in
-                                        shuffled_indices[current_idx: current_idx + batchsize]] # 获取 batch size 的 train pairs (根据shuffled_indices中的索引)
-                    query_feats = []
-                    nodes = []
-                    latencies = []
-                    costs = []
-                    torch.cuda.empty_cache() # 清空 cuda缓存
-                    for i in currentTrainPair: # 遍历 当前batch的 train pairs
-                        query_feats.append(i[0][0]) # encoding_j 的 dp_query_encoding
-                        query_feats.append(i[3][0]) # encoding_k 的 dp_query_encoding
-                        nodes.append(i[0][1]) # encoding_j 的 dp_node
-                        nodes.append(i[3][1]) # encoding_k 的 dp_node
-                        latencies.append(i[1]) # lantency_j
-                        latencies.append(i[4]) # lantency_k
-                        costs.append(i[2]) # cost_j
-                        costs.append(i[5]) # cost_k
-                    query_feats = (torch.cat(query_feats, dim=0)).to(DEVICE)
-                    trees, indexes = TreeConvFeaturize(nodeFeaturizer, nodes)
-                    if torch.cuda.is_available():
-                        trees = trees.to(DEVICE)
-                        indexes = indexes.to(DEVICE)
-                    calibration = []
-                    for i in range(10): # 对于 当前 batch, 运行模型10次
-                        calibration.append(
-                            torch.tanh(model_levels[modelnum](query_feats, trees, indexes).to(DEVICE)).add(1))
-                    calibration = torch.cat(calibration, 1)
-                    calibration = torch.mean(calibration, dim=1) # 计算 10次校准的平均值
-                    temloss = calculateLossForBatch(latencies, costs, calibration) # 计算 loss
-                    loss = torch.mean(temloss, 0) # 计算 平均loss
-                    optimizer.zero_grad()
-                    loss.backward()
-                    optimizer.step() # 计算梯度 更新模型参数
-                    current_idx += batchsize
-                trainTimes = trainTimes + time.time() - ttime
-                
-                # ----------- validate -----------
-                # 数据预处理，前向传播，accuracy性能评估
-                tetime = time.time()
-                acc = 0 # 计数 pair预测结果与ground truth 一致的数量
-                cout = 0
-                current_idx = 0
-                while current_idx < len(shuffled_indices):
-
-                    currentTrainPair = [temtrainpair[idx] for idx in
-                                        shuffled_indices[current_idx: current_idx + batchsize]]
-                    query_feats = []
-                    nodes = []
-                    latencies = []
-                    costs = []
-                    for i in currentTrainPair:
-                        cout = cout + 1
-                        query_feats.append(i[0][0])
-                        query_feats.append(i[3][0])
-                        nodes.append(i[0][1])
-                        nodes.append(i[3][1])
-                        latencies.append(i[1])
-                        latencies.append(i[4])
-                        costs.append(i[2])
-                        costs.append(i[5])
-                    query_feats = (torch.cat(query_feats, dim=0)).to(DEVICE)
-                    trees, indexes = TreeConvFeaturize(nodeFeaturizer, nodes)
-                    if torch.cuda.is_available():
-                        trees = trees.to(DEVICE)
-                        indexes = indexes.to(DEVICE)
-                    calibration = []
-                    for m in range(10):
-                        with torch.no_grad():
-                            calibration.append(
-                                torch.tanh(model_levels[modelnum](query_feats, trees, indexes)).add(1))
-                    calibration = torch.cat(calibration, 1) # (batch_size, 10)
-                    calibration = torch.mean(calibration, dim=1) # （batch_size）
-                    calibration = calibration.unsqueeze(1) # 增加一个维度 (batch_size, 1)
-                    calibration = calibration.view(-1, 2) # reshape 为两个一行 (batch_size/2, 2)
-                    costs = torch.tensor(costs, device=DEVICE).view(-1, 2)
-                    calibratedCost = calibration * costs # 获得 校准后的cost
-                    softm = nn.functional.softmax(calibratedCost, dim=1) # 计算 概率, calibratedCost越大 概率越大
-                    prediction = torch.max(softm, dim=1)[1] # 获得 一个pair中概率大的对应索引 0 或者 1
-                    res = []
-                    for i in range(0, len(latencies), 2):
-                        if latencies[i] > latencies[i + 1]: # 计算 一个pair的ground truth 正负例, 添加 latency 大的对应的索引
-                            res.append(0)
-                        else:
-                            res.append(1)
-                    res = torch.tensor(res, device=DEVICE)
-                    current_idx += batchsize
-                    acc += torch.sum(res == prediction).data.cpu().numpy().squeeze()
-                testTimes = testTimes + time.time() - tetime
-                logger.info("iter:{},model:{},train iters:{}, acc:{} ".format(iter, modelnum, epoch + 1, acc / cout))
-                if acc / cout > 0.96 or epoch > 13:
-                    break
+        trainGroups = [(modelnum, levels) for modelnum, levels in getTrainGroups(model_levels, sharedModel)
+                       if len(trainpair.Pairs(levels)[2]) >= 2]
+        if trainCores > 1 and not sharedModel and len(trainGroups) > 1:
+            # 各 level 的模型在进程池中并行训练: 每个 level 的 train pairs 特征化一次, 交给 worker; 大的 level 先训练
+            datasets = [level_training.PairDataset(trainpair, levels, nodeFeaturizer, featureStore)
+                        for _, levels in trainGroups]
+            results = level_training.TrainInPool(
+                model_levels, optlist, trainGroups, datasets, trainCores, batchsize, DEVICE,
+                threads_per_model=trainThreads, prioritized=prioritizedReplay,
+                progress=lambda modelnum, epoch, acc: logger.info(
+                    "iter:{},model:{},train iters:{}, acc:{} ".format(iter, modelnum, epoch, acc)),
+                prefetch_workers=prefetchWorkers, prefetch_depth=prefetchDepth)
+            for (modelnum, levels), dataset in zip(trainGroups, datasets):
+                priorities, stats = results[modelnum]
+                trainpair.UpdatePriorities(dataset.pair_levels, dataset.pair_ids, dataset.js, dataset.ks, priorities)
+                trainTimes, testTimes = trainTimes + stats['train_seconds'], testTimes + stats['test_seconds']
+                logger.info('model:{}, steps:{}, data time per step:{:.4f}s, compute time per step:{:.4f}s'.format(
+                    modelnum, stats['steps'], stats['data_seconds'] / max(stats['steps'], 1),
+                    stats['compute_seconds'] / max(stats['steps'], 1)))
+            trainGroups = []
+        for modelnum, levels in trainGroups:
+            # 当前 level 的所有 train pairs: 每个 pair 只是 (level, pair id, j, k) 四个 int32 下标, 按 batch 再取特征, 无需拷贝
+            pairlevels, pairIds, pairJ, pairK = trainpair.Pairs(levels)
+            # 每个 pair 的 cost 与 label (latency 大的一侧的下标) 只算一次, 按 batch 取
+            pairCosts, pairLabels = pair_loss.PairTargets(*trainpair.Targets(pairlevels, pairJ, pairK))
+            torch.cuda.empty_cache() # 清空 cuda缓存, 每个模型一次
+            stats = level_training.TrainModel(
+                model_levels, optlist[levels[0]], pairlevels,
+                lambda batch: pairBatch(trainpair, featureStore, nodeFeaturizer, pairlevels[batch], pairJ[batch],
+                                        pairK[batch], pairCosts[batch], pairLabels[batch]),
+                batchsize, DEVICE,
+                # 按 priority 有放回采样, 模型还没学会的 pair 更常出现
+                weights=(lambda: trainpair.Weights(pairlevels, pairIds)) if prioritizedReplay else None,
+                # pair 的 priority: 1 - 模型给 ground truth 的概率 (下限 1e-3), 也是 'information' 淘汰的依据
+                on_validated=lambda batch, values: trainpair.UpdatePriorities(
+                    pairlevels[batch], pairIds[batch], pairJ[batch], pairK[batch], values),
+                progress=lambda epoch, acc: logger.info(
+                    "iter:{},model:{},train iters:{}, acc:{} ".format(iter, modelnum, epoch, acc)),
+                prefetch_workers=prefetchWorkers, prefetch_depth=prefetchDepth)
+            trainTimes, testTimes = trainTimes + stats['train_seconds'], testTimes + stats['test_seconds']
+            logger.info('model:{}, steps:{}, data time per step:{:.4f}s, compute time per step:{:.4f}s'.format(
+                modelnum, stats['steps'], stats['data_seconds'] / max(stats['steps'], 1),
+                stats['compute_seconds'] / max(stats['steps'], 1)))
 
         logger.info('train time ={} test time = {}'.format(trainTimes, testTimes))
         testtime = time.time()
 
         nowtraingmrl = getGMRL(Ttrainquery, model_levels, pg_latency_train, nodeFeaturizer, costCache, workload,
-                               exp=exp, old=pg_latency_train)
+                               exp=exp, old=pg_latency_train, planWorkers=planWorkers, planBudget=planBudget)
         if nowtraingmrl < bestTrainGmrl:
             bestTrainGmrl = nowtraingmrl
-            for modelnum in range(2, len(model_levels)):
-                modelname = log_dir + '/BestTrainModel_' + logs_name + '_' + str(modelnum) + '.pth'
-                torch.save(model_levels[modelnum], modelname)
+            saveModels(model_levels, log_dir + '/BestTrainModel_' + logs_name + '_')
         train_gmrl.append(nowtraingmrl)
-        nowtestgmrl = getGMRL(testquery, model_levels, pg_latency_test, nodeFeaturizer, costCache, workload)
+        nowtestgmrl = getGMRL(testquery, model_levels, pg_latency_test, nodeFeaturizer, costCache, workload,
+                              planWorkers=planWorkers, planBudget=planBudget)
         if nowtestgmrl < bestTestGmrl:
             bestTestGmrl = nowtestgmrl
-            for modelnum in range(2, len(model_levels)):
-                modelname = log_dir + '/BestTestModel_' + logs_name + '_' + str(modelnum) + '.pth'
-                torch.save(model_levels[modelnum], modelname)
+            saveModels(model_levels, log_dir + '/BestTestModel_' + logs_name + '_')
         test_gmrl.append(nowtestgmrl)
 
         logger.info('GMRL test  time ={}'.format(time.time() - testtime))
@@ -722,16 +756,17 @@ if __name__ == '__main__':
         logger.info('test_gmrl ={}'.format(test_gmrl))
         levelList.clear()
         gc.collect()
-        a_file = open(log_dir + '/Bestplans_' + logs_name + '.pkl', 'wb')
-        b_file = open(log_dir + '/Exp_' + logs_name + '.pkl', 'wb')
-        c_file = open(log_dir + '/cost_' + logs_name + '.pkl', 'wb')
-        d_file = open(log_dir + '/finexp_' + logs_name + '.pkl', 'wb')
-        pickle.dump(exp, b_file)
-        pickle.dump(bestplanslist, a_file)
-        pickle.dump(costCache, c_file)
-        pickle.dump(finexp, d_file)
-        a_file.close()
-        b_file.close()
-        c_file.close()
-        d_file.close()
+        # 只追加本轮新增的 exp / finexp / costCache / best plans, 不再每轮整体重写 pkl
+        expLog.Append(pools={'exp': exp, 'finexp': finexp}, dicts={'cost': costCache},
+                      lists={'bestplans': bestplanslist})
+        # 原子写入完整训练状态; exp 只记录 explog 的位置, train pair 只记录下标
+        checkpoint.Save(os.path.join(log_dir, 'checkpoint.pt'), {
+            'iter': iter, 'FirstTrain': FirstTrain, 'dpsign': dpsign, 'greedy': greedy,
+            'models': modelStates(model_levels), 'optimizers': checkpoint.OptimizerStates(optlist),
+            'explog': expLog.Pointer(), 'trainpair': trainpair.Snapshot(), 'pinned': exp.Pinned(),
+            'seen': [entries.seen for entries in exp],
+            'timeoutlist': timeoutlist, 'dp_Signs': dp_Signs, 'pg_latency_train': pg_latency_train,
+            'pg_latency_test': pg_latency_test, 'train_gmrl': train_gmrl, 'test_gmrl': test_gmrl,
+            'bestTrainGmrl': bestTrainGmrl, 'bestTestGmrl': bestTestGmrl, 'rng': checkpoint.RngState()})
+    expLog.Close()
     logger.info('all time = {} '.format(time.time() - allstime))
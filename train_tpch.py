@@ -4,7 +4,6 @@ import gc
 import logging
 import math
 import os
-import pickle
 import random
 import time
 
@@ -14,7 +13,7 @@ import torch
 from encoding import TreeConvFeaturize
 from torch import nn
 
-from util import postgres, envs, treeconv_dropout
+from util import postgres, envs, treeconv_dropout, experience, explog, pair_loss
 
 
 def getexpnum(exp):
@@ -98,54 +97,6 @@ def getPartTrainPair(alltrainpair, rate=0.2):
     return sortlist[0:int(len(alltrainpair) * rate)]
 
 
-def calculateLossForBatch(latencies: list, costs: list, calibration: torch.Tensor):
-    """
-    :param latencies: real latency
-    :param costs: PG estimated cost
-    :param calibration: ML model's calibration for cost
-    :return: loss to learn the ML model
-    """
-    loss_fn = nn.CrossEntropyLoss(reduction='none')
-    calibration = calibration.view(-1, 2)
-    costs = torch.tensor(costs, device=DEVICE).view(-1, 2)
-    calibratedCost = calibration * costs
-    softm = nn.functional.softmax(calibratedCost, dim=1)
-    assert (2 * len(costs) == len(latencies)) and (len(latencies) % 2 == 0)
-    res = []
-    for i in range(0, len(latencies), 2):
-        if latencies[i] > latencies[i + 1]:
-            res.append(0)
-        else:
-            res.append(1)
-    res = torch.tensor(res, device=DEVICE)
-    return loss_fn(softm, res)
-
-
-def calculateLossForBatch_MR_0(latencies: list, costs: list, calibration: torch.Tensor):
-    """
-    :param latencies: real latency
-    :param costs: PG estimated cost
-    :param calibration: ML model's calibration for cost
-    :return: loss to learn the ML model
-    """
-    loss_fn = nn.MarginRankingLoss()
-    calibration = calibration.view(-1, 2)
-    costs = torch.tensor(costs, device=DEVICE).view(-1, 2)
-    calibratedCost = calibration * costs
-    c1, c2 = torch.chunk(calibratedCost, 2, dim=1)
-    c1 = torch.squeeze(c1)
-    c2 = torch.squeeze(c2)
-    assert (2 * len(costs) == len(latencies)) and (len(latencies) % 2 == 0)
-    res = []
-    for i in range(0, len(latencies), 2):
-        if latencies[i] > latencies[i + 1]:
-            res.append(1)
-        else:
-            res.append(-1)
-    res = torch.tensor(res, device=DEVICE)
-    return loss_fn(c1, c2, res)
-
-
 def geometric_mean(data):
     total = 1
     for i in data:
@@ -210,11 +161,7 @@ def collects(finnode, workload, exp, timeout):
                                      with_select_exprs=True)
 
         temhint = currentChild.hint_str()
-        found = False
-        for i in exp[temlevel]:
-            if (i[1] == temsql and i[2] == temhint):
-                found = True
-                break
+        found = experience.FindEntry(exp[temlevel], temsql, temhint) is not None
         if not found:
             tem = []
             tem.append(math.log(currentChild.info["cost"]))
@@ -240,11 +187,7 @@ def collects(finnode, workload, exp, timeout):
                 temsql = currentChild.to_sql(currentChild.info["join_conds"],
                                              with_select_exprs=True)
                 temhint = currentChild.hint_str()
-                found = False
-                for i in exp[temlevel]:
-                    if (i[1] == temsql and i[2] == temhint):
-                        found = True
-                        break
+                found = experience.FindEntry(exp[temlevel], temsql, temhint) is not None
                 if not found:
                     tem = []
                     tem.append(math.log(currentChild.info["cost"]))
@@ -399,6 +342,7 @@ if __name__ == '__main__':
     loglogs = '_'.join((logs_name, timestamp))
     log_dir = os.path.join(config['log_path'], loglogs)
     os.makedirs(log_dir)
+    expLog = explog.ExperienceLog(os.path.join(log_dir, 'explog_' + logs_name + '.log')) # 每轮追加一个 chunk, 见 util/explog.py
     log_file_name = os.path.join(log_dir, "running_log")
     logger = get_logger(log_file_name)
     logger.info(config)
@@ -408,20 +352,15 @@ if __name__ == '__main__':
     ########################################################
     seed_torch()
     if FirstTrain:
-        exp = [[] for _ in range(20)]
-        finexp = [[] for _ in range(20)]
+        exp = experience.ExperiencePool(20)
+        finexp = experience.ExperiencePool(20)
         costCache = {}
     else:
-        b_file = open('', 'rb')
-        exp = pickle.load(b_file)
+        state = explog.Load('') # 上次运行的 explog_*.log, 逐 chunk 重放
+        exp = experience.ExperiencePool(state['pools']['exp'])
         modelpath = ''
-        b_file.close()
-        c_file = open('', 'rb')
-        costCache = pickle.load(c_file)
-        c_file.close()
-        d_file = open('', 'rb')
-        finexp = pickle.load(d_file)
-        d_file.close()
+        costCache = state['dicts']['cost']
+        finexp = experience.ExperiencePool(state['pools']['finexp'])
         getTrainPair(exp, exp, trainpair)
         print('load exp bestsubplans costcache success !!')
     allstime = time.time()
@@ -537,6 +476,10 @@ if __name__ == '__main__':
             if len(temtrainpair) < 2:
                 continue
             temtrainpair.extend(besttrainpair[modelnum])
+            # 每个 pair 的 cost 与 label 只算一次, 放到 DEVICE 上按 batch 取
+            pairCosts, pairLabels = pair_loss.PairTargets([[i[1], i[4]] for i in temtrainpair],
+                                                          [[i[2], i[5]] for i in temtrainpair])
+            pairCosts, pairLabels = pairCosts.to(DEVICE), pairLabels.to(DEVICE)
             oridistribution = {}
             getOriDistribution(levelList[modelnum], model_levels[modelnum], oridistribution)
             for epoch in range(0, 500):
@@ -545,22 +488,17 @@ if __name__ == '__main__':
                 # train
                 current_idx = 0
                 while current_idx < len(shuffled_indices):
-                    currentTrainPair = [temtrainpair[idx] for idx in
-                                        shuffled_indices[current_idx: current_idx + batchsize]]
+                    batchIdx = shuffled_indices[current_idx: current_idx + batchsize]
+                    currentTrainPair = [temtrainpair[idx] for idx in batchIdx]
+                    batchIdx = torch.from_numpy(batchIdx).to(DEVICE)
                     query_feats = []
                     nodes = []
-                    latencies = []
-                    costs = []
                     torch.cuda.empty_cache()
                     for i in currentTrainPair:
                         query_feats.append(i[0][0])
                         query_feats.append(i[3][0])
                         nodes.append(i[0][1])
                         nodes.append(i[3][1])
-                        latencies.append(i[1])
-                        latencies.append(i[4])
-                        costs.append(i[2])
-                        costs.append(i[5])
                     query_feats = (torch.cat(query_feats, dim=0)).to(DEVICE)
                     trees, indexes = TreeConvFeaturize(nodeFeaturizer, nodes)
                     if torch.cuda.is_available():
@@ -574,7 +512,7 @@ if __name__ == '__main__':
                     calibration = torch.cat(calibration, 1)
                     calibration = torch.mean(calibration, dim=1)
 
-                    temloss = calculateLossForBatch(latencies, costs, calibration)
+                    temloss = pair_loss.CrossEntropyLoss(calibration, pairCosts[batchIdx], pairLabels[batchIdx])
                     if epoch > 0:
 
                         reg = getKLreg(levelList[modelnum], model_levels[modelnum], oridistribution)
@@ -587,27 +525,22 @@ if __name__ == '__main__':
                     current_idx += batchsize
                 trainTimes = trainTimes + time.time() - ttime
                 tetime = time.time()
-                acc = 0
+                acc = torch.zeros((), dtype=torch.long, device=DEVICE) # 在 DEVICE 上累加, 每个 epoch 读一次
                 cout = 0
                 current_idx = 0
                 while current_idx < len(shuffled_indices):
 
-                    currentTrainPair = [temtrainpair[idx] for idx in
-                                        shuffled_indices[current_idx: current_idx + batchsize]]
+                    batchIdx = shuffled_indices[current_idx: current_idx + batchsize]
+                    currentTrainPair = [temtrainpair[idx] for idx in batchIdx]
+                    batchIdx = torch.from_numpy(batchIdx).to(DEVICE)
                     query_feats = []
                     nodes = []
-                    latencies = []
-                    costs = []
                     for i in currentTrainPair:
                         cout = cout + 1
                         query_feats.append(i[0][0])
                         query_feats.append(i[3][0])
                         nodes.append(i[0][1])
                         nodes.append(i[3][1])
-                        latencies.append(i[1])
-                        latencies.append(i[4])
-                        costs.append(i[2])
-                        costs.append(i[5])
                     query_feats = (torch.cat(query_feats, dim=0)).to(DEVICE)
                     trees, indexes = TreeConvFeaturize(nodeFeaturizer, nodes)
                     if torch.cuda.is_available():
@@ -620,21 +553,10 @@ if __name__ == '__main__':
                                 torch.tanh(model_levels[modelnum](query_feats, trees, indexes)).add(1))
                     calibration = torch.cat(calibration, 1)
                     calibration = torch.mean(calibration, dim=1)
-                    calibration = calibration.unsqueeze(1)
-                    calibration = calibration.view(-1, 2)
-                    costs = torch.tensor(costs, device=DEVICE).view(-1, 2)
-                    calibratedCost = calibration * costs
-                    softm = nn.functional.softmax(calibratedCost, dim=1)
-                    prediction = torch.max(softm, dim=1)[1]
-                    res = []
-                    for i in range(0, len(latencies), 2):
-                        if latencies[i] > latencies[i + 1]:
-                            res.append(0)
-                        else:
-                            res.append(1)
-                    res = torch.tensor(res, device=DEVICE)
+                    softm = pair_loss.Probabilities(calibration, pairCosts[batchIdx])
                     current_idx += batchsize
-                    acc += torch.sum(res == prediction).data.cpu().numpy().squeeze()
+                    acc += pair_loss.NumCorrect(softm, pairLabels[batchIdx])
+                acc = acc.item()
                 testTimes = testTimes + time.time() - tetime
                 logger.info("iter:{},model:{},train iters：{}，acc:{} ".format(iter, modelnum, epoch + 1, acc / cout))
                 # logger.info("iter:{},model:{},训练次数：{}".format(iter, modelnum, epoch + 1))
@@ -666,16 +588,8 @@ if __name__ == '__main__':
         logger.info('test_gmrl ={}'.format(test_gmrl))
         levelList.clear()
         gc.collect()
-        a_file = open(log_dir + '/Bestplans_' + logs_name + '.pkl', 'wb')
-        b_file = open(log_dir + '/Exp_' + logs_name + '.pkl', 'wb')
-        c_file = open(log_dir + '/cost_' + logs_name + '.pkl', 'wb')
-        d_file = open(log_dir + '/finexp_' + logs_name + '.pkl', 'wb')
-        pickle.dump(exp, b_file)
-        pickle.dump(bestplanslist, a_file)
-        pickle.dump(costCache, c_file)
-        pickle.dump(finexp, d_file)
-        a_file.close()
-        b_file.close()
-        c_file.close()
-        d_file.close()
+        # 只追加本轮新增的 exp / finexp / costCache / best plans, 不再每轮整体重写 pkl
+        expLog.Append(pools={'exp': exp, 'finexp': finexp}, dicts={'cost': costCache},
+                      lists={'bestplans': bestplanslist})
+    expLog.Close()
     logger.info('all time = {} '.format(time.time() - allstime))
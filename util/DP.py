@@ -1,7 +1,7 @@
 import collections
 
 import reSQL
-from util import plans_lib, postgres, search
+from util import plans_lib, postgres, relsets, search
 
 sqlFiles = ''
 p = search.DynamicProgramming.Params()
@@ -46,8 +46,8 @@ def oneSqlDP(sqlFiles, model, exp):
 def getPreCondition(sqlFiles):
     '''
     return 
-    dp_tables 是字典 key是level和表的别名, value是 tuple 含有到达当前node 的最小 cost
-    e.g. 当优化器考虑将 A 和 B 连接起来时, 会查看dp_tables[1]['A']和dp_tables[1]['B'], 计算连接的成本, 并将结果存储在 dp_tables[2]['AB']
+    dp_tables 是字典 key是level和表集合的 bitmask (见 relsets.RelationSets), value是 tuple 含有到达当前node 的最小 cost
+    e.g. 当优化器考虑将 A 和 B 连接起来时, 会查看dp_tables[1][0b01]和dp_tables[1][0b10], 计算连接的成本, 并将结果存储在 dp_tables[2][0b11]
     '''
     with open(sqlFiles, 'r') as f:
         data = f.read().splitlines()
@@ -80,9 +80,10 @@ def getPreCondition(sqlFiles):
     query_leaves = rootNode.CopyLeaves()
     dp_tables = collections.defaultdict(dict)  # level -> dp_table
     # Fill in level 1.
+    rel_sets = relsets.RelationSets(query_leaves)
     for leaf_node in query_leaves:
         leaf_node.info["currentLevel"] = 1
-        dp_tables[1][leaf_node.table_alias] = (0, leaf_node)
+        dp_tables[1][rel_sets.Bit(leaf_node.table_alias)] = (0, leaf_node)
     return join_graph, all_join_conds, query_leaves, dp_tables
 
 
@@ -0,0 +1,89 @@
+"""Caches model calibrations of DP candidates across planning passes.
+
+The DP scores every candidate (sub-query, physical plan) with the mean and
+variance of tanh(model) + 1 over several MC-dropout passes.  getGMRL replans
+every train/test query each iteration and UCB_left_prune_replay_fix_kl
+revisits the same low levels, so the same candidates are scored again and
+again with weights that have not changed since.  CalibrationCache memoizes
+those (mean, var) pairs per model, keyed by the candidate's (sql, hint).
+
+Entries are dropped automatically once the model's weights change: every
+in-place update of a parameter (optimizer.step(), load_state_dict(), ...)
+bumps its version counter, which is part of the cache state.
+
+Usage:
+    cache = CalibrationCache()
+    mean, var = cache.Calibrate(model, keys, compute, num_samples=10)
+"""
+import weakref
+
+import torch
+
+
+def ModelVersion(model):
+    """Returns a token that changes whenever model's weights are updated."""
+    return tuple(p._version for p in model.parameters())
+
+
+def MeanVar(samples):
+    """Per-row mean and variance of [n, num_samples] samples.
+
+    The variance of a single sample is 0 (instead of NaN).
+    """
+    mean = torch.mean(samples, dim=1)
+    if samples.shape[1] < 2:
+        return mean, torch.zeros_like(mean)
+    return mean, torch.var(samples, dim=1)
+
+
+class CalibrationCache(object):
+    """Memoizes per-candidate (mean, var) calibrations for each model."""
+
+    def __init__(self):
+        # model -> (state, {key: (mean, var)}).  Weak, so that dropping a
+        # model (e.g. reloading it from disk) also drops its entries.
+        self._tables = weakref.WeakKeyDictionary()
+        self.hits = 0
+        self.misses = 0
+
+    def _Table(self, model, num_samples):
+        state = (ModelVersion(model), model.training, num_samples)
+        entry = self._tables.get(model)
+        if entry is None or entry[0] != state:
+            entry = (state, {})
+            self._tables[model] = entry
+        return entry[1]
+
+    def Calibrate(self, model, keys, compute, num_samples, device='cpu'):
+        """Returns calibrations of the candidates identified by keys.
+
+        Args:
+          model: the nn.Module scoring the candidates.
+          keys: list of hashable candidate fingerprints, e.g. (sql, hint).
+            Equal keys must denote equal model inputs.
+          compute: fn(indices) -> Tensor [len(indices), num_samples] of
+            calibration samples for the candidates keys[i], i in indices.
+            Only called for cache misses.
+          num_samples: number of MC-dropout passes per candidate.
+          device: where to place the returned tensors.
+
+        Returns:
+          (mean, var): float Tensors sized [len(keys)].
+        """
+        table = self._Table(model, num_samples)
+        misses = [i for i, key in enumerate(keys) if key not in table]
+        self.hits += len(keys) - len(misses)
+        self.misses += len(misses)
+        if misses:
+            samples = compute(misses)
+            means, variances = MeanVar(samples)
+            means = means.tolist()
+            variances = variances.tolist()
+            for i, mean, var in zip(misses, means, variances):
+                table[keys[i]] = (mean, var)
+        means, variances = zip(*[table[key] for key in keys])
+        return (torch.tensor(means, device=device),
+                torch.tensor(variances, device=device))
+
+    def Clear(self):
+        self._tables = weakref.WeakKeyDictionary()
@@ -0,0 +1,89 @@
+"""Atomic checkpoints of the complete training state.
+
+A training run used to be resumable only partially: exp, costCache and
+finexp from hard-coded paths, the pairs rebuilt from exp, models through
+getModelsFromFile, and timeouts, dp_Signs, optimizer and RNG states lost.
+
+A checkpoint is one torch.save() of a dict holding everything the next
+iteration reads.  The experience is not copied into it: the checkpoint keeps
+the explog.ExperienceLog.Pointer() of the log written every iteration, and
+PairIndex.Snapshot() keeps the pairs as row indices into that experience,
+so resuming neither re-pickles nor re-pairs the experience.
+
+Save() writes a temporary file, fsyncs it and renames it over the previous
+checkpoint, so a crash leaves either the old or the new checkpoint.
+
+Usage:
+    Save(log_dir + '/checkpoint.pt', {'iter': iter, 'rng': RngState(), ...})
+    state = Load(log_dir + '/checkpoint.pt')
+    SetRngState(state['rng'])
+"""
+import os
+import random
+
+import numpy as np
+import torch
+
+
+def RngState():
+    """The states of Python's, numpy's and torch's random generators."""
+    return {
+        'random': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+    }
+
+
+def SetRngState(state):
+    random.setstate(state['random'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def OptimizerStates(optimizers):
+    """state_dict() of every optimizer of a list like optlist.
+
+    Entries that are not optimizers (optlist's 'blank's) are kept as is; an
+    optimizer repeated in the list (a shared model) is saved once.
+    """
+    states = []
+    seen = {}
+    for optimizer in optimizers:
+        if not isinstance(optimizer, torch.optim.Optimizer):
+            states.append(optimizer)
+        elif id(optimizer) in seen:
+            states.append(seen[id(optimizer)])
+        else:
+            seen[id(optimizer)] = len(states)
+            states.append(optimizer.state_dict())
+    return states
+
+
+def LoadOptimizerStates(optimizers, states):
+    """Inverse of OptimizerStates(), into optimizers built the same way."""
+    for optimizer, state in zip(optimizers, states):
+        if isinstance(optimizer, torch.optim.Optimizer):
+            optimizer.load_state_dict(states[state] if isinstance(state, int) else state)
+
+
+def Save(path, state):
+    """Atomically replaces the checkpoint at path with state."""
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        torch.save(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+
+
+def Load(path, map_location=None):
+    """The state saved at path.  Models come back on map_location if set."""
+    return torch.load(path, map_location=map_location, weights_only=False)
@@ -23,6 +23,46 @@ def TreeConvFeaturize(plan_featurizer, subplans):
     return trees, indexes
 
 
+def ShareQueryEncoding(query_encodings, device):
+    """Returns (query feats, query index) for candidates of one join set.
+
+    All candidates enumerated for the same join_ids are sub-queries over the
+    same relations and filters, hence carry an identical query vector.  Only
+    the first one is kept; query_index broadcasts it to every candidate.
+    """
+    query_feats = query_encodings[0].to(device)
+    query_index = torch.zeros(len(query_encodings), dtype=torch.long,
+                              device=device)
+    return query_feats, query_index
+
+
+def PairQueryEncoding(query_encodings, device, query_keys=None):
+    """Returns (query feats, query index) for a batch of train pairs.
+
+    query_encodings holds one vector per plan, laid out as
+    [pair0_j, pair0_k, pair1_j, pair1_k, ...].  The two sides of a pair share
+    join_ids but not necessarily the query: pairs are bucketed by the alias
+    string, so e.g. 'mc,t' plans of 1a and 5a meet, and their filters (hence
+    vectors) differ.  If query_keys (one per plan, e.g. its sql) is given,
+    plans with equal keys share one vector; else every plan keeps its own.
+    """
+    if query_keys is None:
+        query_feats = torch.cat(query_encodings, dim=0).to(device)
+        query_index = torch.arange(len(query_encodings), device=device)
+        return query_feats, query_index
+    # query key -> row of query_feats.
+    rows = {}
+    distinct, index = [], []
+    for query_encoding, key in zip(query_encodings, query_keys):
+        if key not in rows:
+            rows[key] = len(distinct)
+            distinct.append(query_encoding)
+        index.append(rows[key])
+    query_feats = torch.cat(distinct, dim=0).to(device)
+    query_index = torch.tensor(index, dtype=torch.long, device=device)
+    return query_feats, query_index
+
+
 def getencoding_Balsa(sql, hint, workload):
     with pg_executor.Cursor() as cursor: # 将 sql 转换为 plan node 
         node0 = postgres.SqlToPlanNode(sql, comment=hint, verbose=False,
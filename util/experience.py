@@ -0,0 +1,639 @@
+"""Experience pool with hash indexes over the measured plans.
+
+The experience exp is organized by level: exp[level] is a list of entries
+
+    [logcost, sql, hint, latency, [query_encoding, node], join, join_ids]
+
+(entries collected by search.collectSubplans() stop after the encoding).
+Before executing a plan, the planners and trainers check whether its
+(sql, hint) was measured already.  Scanning exp[level] for that costs
+O(|exp[level]|) per candidate, which grows with every training iteration.
+
+ExperiencePool keeps the same list-of-lists view -- exp[level] is still a
+list that can be iterated, indexed, appended to and pickled -- but every
+level also indexes its entries by (sql, hint) and by join_ids, so lookups
+are O(1).  The indexes follow every list mutation.
+
+Usage:
+    exp = ExperiencePool()                      # 20 empty levels.
+    exp = ExperiencePool(pickle.load(f))        # From a saved exp.
+    exp[level].append(entry)
+    entry = exp[level].Find(sql, hint)          # Or None.
+    entry = FindEntry(entries, sql, hint)       # Also for plain lists.
+
+A pool may also be bounded, as a replay buffer: with a capacity, every level
+keeps at most that many entries and evicts the others by a policy --
+'oldest' first, 'reservoir' sampling, or lowest 'information' (see
+ExperiencePool; the trainer calls Evict() once new entries are paired).
+Pinned (sql, hint), e.g. the current best plans, are never evicted.
+
+PairIndex turns the experience into the trainers' train pairs incrementally;
+see its docstring.
+"""
+import array
+import collections
+import random
+
+import numpy as np
+
+
+def _Fingerprint(entry):
+    return entry[1], entry[2]
+
+
+def _JoinIds(entry):
+    return entry[6] if len(entry) > 6 else None
+
+
+def FindEntry(entries, sql, hint):
+    """The first entry of entries measuring (sql, hint), or None.
+
+    Uses the index of an ExperienceLevel; scans other lists.
+    """
+    if isinstance(entries, ExperienceLevel):
+        return entries.Find(sql, hint)
+    for entry in entries:
+        if entry[2] == hint and entry[1] == sql:
+            return entry
+    return None
+
+
+class ExperienceLevel(list):
+    """The entries of one level, indexed by (sql, hint) and join_ids.
+
+    Levels of a bounded ExperiencePool (pool, level) ask the pool to admit
+    and evict entries as they are appended.
+    """
+
+    def __init__(self, entries=(), pool=None, level=None):
+        super().__init__()
+        self._pool = pool
+        self.level = level
+        # Entries ever appended, for reservoir sampling.
+        self.seen = 0
+        # (sql, hint) -> first entry measuring it.
+        self._by_fingerprint = {}
+        # join_ids -> entries, in insertion order.
+        self._by_join_ids = collections.defaultdict(list)
+        self.extend(entries)
+
+    def __reduce__(self):
+        # Pickle/copy the entries only; the indexes are rebuilt.
+        return self.__class__, (list(self),)
+
+    def _Index(self, entry):
+        self._by_fingerprint.setdefault(_Fingerprint(entry), entry)
+        self._by_join_ids[_JoinIds(entry)].append(entry)
+
+    def _Unindex(self, entry):
+        fingerprint = _Fingerprint(entry)
+        bucket = self._by_join_ids[_JoinIds(entry)]
+        for i, other in enumerate(bucket):
+            if other is entry:
+                del bucket[i]
+                break
+        if self._by_fingerprint.get(fingerprint) is entry:
+            del self._by_fingerprint[fingerprint]
+            for other in bucket:
+                if _Fingerprint(other) == fingerprint:
+                    self._by_fingerprint[fingerprint] = other
+                    break
+
+    def _Replace(self, index, entry):
+        """self[index] = entry, updating the indexes of these two only."""
+        old = self[index]
+        super().__setitem__(index, entry)
+        self._Unindex(old)
+        self._Index(entry)
+        return old
+
+    def _Keep(self, entries):
+        """Replaces the contents by entries (a subsequence) and reindexes."""
+        super().__setitem__(slice(None), entries)
+        self._Reindex()
+
+    def _Reindex(self):
+        self._by_fingerprint = {}
+        self._by_join_ids = collections.defaultdict(list)
+        for entry in self:
+            self._Index(entry)
+
+    def append(self, entry):
+        self.seen += 1
+        if self._pool is not None and not self._pool._Admit(self, entry):
+            return
+        super().append(entry)
+        self._Index(entry)
+        if self._pool is not None:
+            self._pool._Appended(self.level, entry)
+            if self._pool.policy != 'information':
+                self._pool._Evict(self)
+
+    def extend(self, entries):
+        for entry in entries:
+            self.append(entry)
+
+    def __iadd__(self, entries):
+        self.extend(entries)
+        return self
+
+    # Mutations other than appending are rare (e.g. rolling back a planning
+    # pass): rebuild the indexes.
+
+    def insert(self, index, entry):
+        super().insert(index, entry)
+        self._Reindex()
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._Reindex()
+
+    def __delitem__(self, key):
+        size = len(self)
+        super().__delitem__(key)
+        if len(self) != size:
+            self._Reindex()
+
+    def pop(self, index=-1):
+        entry = super().pop(index)
+        self._Reindex()
+        return entry
+
+    def remove(self, entry):
+        super().remove(entry)
+        self._Reindex()
+
+    def clear(self):
+        super().clear()
+        self._Reindex()
+
+    def sort(self, *args, **kwargs):
+        super().sort(*args, **kwargs)
+        self._Reindex()
+
+    def reverse(self):
+        super().reverse()
+        self._Reindex()
+
+    def Find(self, sql, hint):
+        """The first entry measuring (sql, hint), or None."""
+        return self._by_fingerprint.get((sql, hint))
+
+    def Contains(self, sql, hint):
+        return (sql, hint) in self._by_fingerprint
+
+    def ByJoinIds(self, join_ids):
+        """The entries of the sub-query join_ids (do not modify)."""
+        return self._by_join_ids.get(join_ids, [])
+
+
+class ExperiencePool(list):
+    """exp: a list of ExperienceLevel, one per level.
+
+    Args:
+      levels: a number of empty levels, or per-level lists of entries.
+      capacity: None (unbounded), or the maximum number of entries per
+        level: an int, or a list indexed by level whose last entry applies
+        to higher levels.
+      policy: which unpinned entries a full level evicts:
+        'oldest': the oldest ones.
+        'reservoir': a uniform sample of all entries ever appended is kept;
+          a new entry replaces a random one with probability
+          capacity / (entries seen), else it is dropped.
+        'information': those with the lowest self.information(level, entry),
+          e.g. PairIndex.Information; the oldest ones if that is not set.
+          New entries have no pairs, hence no information, until they are
+          added to the PairIndex: this policy does not evict on append, but
+          in Evict(), to call once the new entries are paired.
+        'oldest' and 'information' evict in batches, once a level exceeds
+        its capacity by 10%.
+      pinned: {level: set of (sql, hint)} never to evict; see Pin().
+
+    Attributes:
+      information: fn(level, entry) -> float, for policy 'information'.
+      on_append: callbacks fn(level, entry), called for every entry
+        admitted, e.g. to store its features.
+      on_evict: callbacks fn(level, entry), called for every entry evicted
+        (or dropped on arrival), e.g. PairIndex.Remove.
+
+    None of these attributes is pickled.
+    """
+
+    def __init__(self, levels=20, capacity=None, policy='oldest', pinned=None):
+        assert policy in ('oldest', 'reservoir', 'information'), policy
+        self.capacity = capacity
+        self.policy = policy
+        self.information = None
+        self.on_append = []
+        self.on_evict = []
+        self._pinned = collections.defaultdict(set)
+        for level, fingerprints in (pinned or {}).items():
+            self._pinned[level].update(fingerprints)
+        if isinstance(levels, int):
+            levels = [[] for _ in range(levels)]
+        super().__init__()
+        for level, entries in enumerate(levels):
+            # Appended empty first, so that evictions see self[level].
+            super().append(ExperienceLevel(pool=self, level=level))
+            self[level].extend(entries)
+
+    def __reduce__(self):
+        return self.__class__, ([list(entries) for entries in self], self.capacity, self.policy,
+                                dict(self._pinned))
+
+    def _Capacity(self, level):
+        capacity = self.capacity
+        if isinstance(capacity, (list, tuple)):
+            capacity = capacity[min(level, len(capacity) - 1)]
+        return capacity
+
+    def _Unpinned(self, entries):
+        pinned = self._pinned[entries.level]
+        return [i for i, entry in enumerate(entries) if _Fingerprint(entry) not in pinned]
+
+    def _Appended(self, level, entry):
+        for fn in self.on_append:
+            fn(level, entry)
+
+    def _Evicted(self, level, entry):
+        for fn in self.on_evict:
+            fn(level, entry)
+
+    def _Admit(self, entries, entry):
+        """Reservoir sampling: whether entry is appended to a full level.
+
+        May put entry in place of a random unpinned entry instead.
+        """
+        capacity = self._Capacity(entries.level)
+        if self.policy != 'reservoir' or capacity is None or len(entries) < capacity:
+            return True
+        unpinned = self._Unpinned(entries)
+        if unpinned and random.randrange(entries.seen) < capacity:
+            self._Appended(entries.level, entry)
+            self._Evicted(entries.level, entries._Replace(random.choice(unpinned), entry))
+        else:
+            self._Evicted(entries.level, entry)
+        return False
+
+    def _Evict(self, entries):
+        """Evicts down to capacity once a level is 10% over it."""
+        capacity = self._Capacity(entries.level)
+        if self.policy == 'reservoir' or capacity is None or len(entries) <= capacity + capacity // 10:
+            return
+        unpinned = self._Unpinned(entries)
+        if self.policy == 'information' and self.information is not None:
+            # Stable: the oldest first among equal information.
+            unpinned.sort(key=lambda i: self.information(entries.level, entries[i]))
+        victims = set(unpinned[:len(entries) - capacity])
+        evicted = [entries[i] for i in sorted(victims)]
+        entries._Keep([entry for i, entry in enumerate(entries) if i not in victims])
+        for entry in evicted:
+            self._Evicted(entries.level, entry)
+
+    def Evict(self):
+        """Evicts the levels over capacity.
+
+        Policy 'information' only evicts here: call it after the entries
+        appended since the last call were added to the PairIndex.
+        """
+        for entries in self:
+            self._Evict(entries)
+
+    def Pin(self, level, sql, hint):
+        """Never evict (sql, hint) from level, until ClearPins()."""
+        self._pinned[level].add((sql, hint))
+
+    def ClearPins(self):
+        self._pinned = collections.defaultdict(set)
+
+    def Pinned(self):
+        """{level: set of (sql, hint)} pinned, e.g. for the pinned argument."""
+        return {level: set(fingerprints) for level, fingerprints in self._pinned.items()}
+
+    def Find(self, sql, hint, level=None):
+        """The entry measuring (sql, hint), at level if given, or None."""
+        if level is not None:
+            return self[level].Find(sql, hint)
+        for entries in self:
+            entry = entries.Find(sql, hint)
+            if entry is not None:
+                return entry
+        return None
+
+    def NumEntries(self):
+        return sum(len(entries) for entries in self)
+
+
+class _PairTable(object):
+    """Columnar experience of one level, and its pairs as row indices."""
+
+    def __init__(self):
+        # Row r: one (sql, hint).  features[r] is its [query_encoding, node],
+        # shared with the exp entry, not copied; None once removed.
+        self.features = []
+        self.keys = []
+        self.costs = array.array('d')
+        self.latencies = array.array('d')
+        self.alive = bytearray()
+        # Sum of the priorities of the row's pairs.
+        self.information = array.array('d')
+        # Pair p is rows (pairs[2p], pairs[2p + 1]), 4 bytes each, with
+        # priority priorities[p].
+        self.pairs = array.array('i')
+        self.priorities = array.array('f')
+        # Rows removed since the last Compact().
+        self.num_removed = 0
+
+    def AddRow(self, entry):
+        self.features.append(entry[4])
+        self.keys.append(_Fingerprint(entry))
+        self.costs.append(entry[0])
+        self.latencies.append(entry[3])
+        self.alive.append(1)
+        self.information.append(0)
+        return len(self.features) - 1
+
+    def AddPair(self, j, k, priority):
+        self.pairs.append(j)
+        self.pairs.append(k)
+        self.priorities.append(priority)
+        self.information[j] += priority
+        self.information[k] += priority
+
+    def RemoveRow(self, row):
+        self.features[row] = None
+        self.keys[row] = None
+        self.alive[row] = 0
+        self.information[row] = 0
+        self.num_removed += 1
+
+    def Compact(self):
+        """Drops the pairs of removed rows; renumbers the pairs."""
+        pairs = np.array(self.pairs, dtype=np.int32).reshape(-1, 2)
+        priorities = np.array(self.priorities, dtype=np.float32)
+        alive = np.frombuffer(bytes(self.alive), dtype=np.uint8).astype(bool)
+        keep = alive[pairs[:, 0]] & alive[pairs[:, 1]]
+        pairs, priorities = pairs[keep], priorities[keep]
+        information = np.bincount(pairs.ravel(), weights=np.repeat(priorities, 2), minlength=len(alive))
+        self.pairs = array.array('i', pairs.ravel().tobytes())
+        self.priorities = array.array('f', priorities.tobytes())
+        self.information = array.array('d', information.astype(np.float64).tobytes())
+        self.num_removed = 0
+
+    def NumPairs(self):
+        return len(self.priorities)
+
+
+class PairIndex(object):
+    """trainpair: train pairs per level, generated incrementally.
+
+    A train pair compares two plans of the same sub-query: entries of the
+    same level and join_ids, with different (sql, hint) and different
+    latencies.
+
+    Entries are bucketed by (level, join_ids).  Add() pairs a new entry with
+    the entries of its bucket only, and each (sql, hint) joins a bucket once,
+    so every unordered pair is generated once however often its plans are
+    re-added.  Entries without join_ids are not paired.
+
+    Storage is columnar: every level keeps one row (features, cost, latency)
+    per distinct plan, and a pair is two int32 row indices.  The training
+    loop draws pair indices (Pairs()) and gathers the rows of a batch
+    (Gather()).
+
+    Every pair has a priority, 1 when new, that the trainer may lower with
+    UpdatePriorities() (e.g. to the model's disagreement with the pair's
+    label) and sample by (Weights()).  Information() of an entry is the sum
+    of its pairs' priorities: an ExperiencePool evicting by 'information'
+    first drops plans that form no pair, then those the model already ranks
+    right.  Remove() drops an evicted entry and its pairs.
+
+    Args:
+      num_levels: number of levels.
+      max_pairs_per_bucket: if set, a bucket stops producing pairs once it
+        produced this many.
+      sample_rate: keep each new pair with this probability.
+
+    Usage:
+        trainpair = PairIndex(20)
+        trainpair.AddAll(trainBuffer)
+        pair_levels, pair_ids, js, ks = trainpair.Pairs(levels)
+        costs, labels = pair_loss.PairTargets(
+            *trainpair.Targets(pair_levels, js, ks))
+        batch = ...  # Indices into the four arrays.
+        query_feats, nodes, latencies, costs = trainpair.Gather(
+            pair_levels[batch], js[batch], ks[batch])
+        keys = trainpair.Keys(pair_levels[batch], js[batch], ks[batch])  # See FeatureStore.
+        query_feats, query_index = encoding.PairQueryEncoding(
+            query_feats, device,
+            trainpair.QueryKeys(pair_levels[batch], js[batch], ks[batch]))
+    """
+
+    def __init__(self, num_levels=20, max_pairs_per_bucket=None, sample_rate=1.0):
+        self.tables = [_PairTable() for _ in range(num_levels)]
+        self.max_pairs_per_bucket = max_pairs_per_bucket
+        self.sample_rate = sample_rate
+        # (level, join_ids) -> {(sql, hint): row}.
+        self._buckets = collections.defaultdict(dict)
+        # (level, join_ids) -> pairs produced.
+        self._num_pairs = collections.Counter()
+
+    def _Row(self, level, entry):
+        join_ids = _JoinIds(entry)
+        if join_ids is None:
+            return None
+        return self._buckets[(level, join_ids)].get(_Fingerprint(entry))
+
+    def Add(self, level, entry):
+        """Adds one entry of exp[level]; returns the number of new pairs."""
+        join_ids = _JoinIds(entry)
+        if join_ids is None:
+            return 0
+        key = (level, join_ids)
+        bucket = self._buckets[key]
+        fingerprint = _Fingerprint(entry)
+        if fingerprint in bucket:
+            return 0
+        table = self.tables[level]
+        row = table.AddRow(entry)
+        added = 0
+        for other in bucket.values():
+            if self.max_pairs_per_bucket is not None and self._num_pairs[key] >= self.max_pairs_per_bucket:
+                break
+            if table.latencies[other] == table.latencies[row]:
+                continue
+            if self.sample_rate < 1 and random.random() >= self.sample_rate:
+                continue
+            table.AddPair(row, other, 1.0)
+            self._num_pairs[key] += 1
+            added += 1
+        bucket[fingerprint] = row
+        return added
+
+    def AddAll(self, levels, pool=None):
+        """Adds the entries of levels (e.g. trainBuffer or exp), level by level.
+
+        pool: if given, entries no longer in the ExperiencePool (evicted or
+          dropped on arrival) are skipped.
+        """
+        added = 0
+        for level, entries in enumerate(levels):
+            for entry in entries:
+                if pool is not None and not pool[level].Contains(entry[1], entry[2]):
+                    continue
+                added += self.Add(level, entry)
+        return added
+
+    def Remove(self, level, entry):
+        """Drops entry and its pairs; an ExperiencePool.on_evict callback."""
+        join_ids = _JoinIds(entry)
+        if join_ids is None:
+            return
+        row = self._buckets[(level, join_ids)].pop(_Fingerprint(entry), None)
+        if row is not None:
+            self.tables[level].RemoveRow(row)
+
+    def Information(self, level, entry):
+        """Sum of the priorities of entry's pairs (0 if it has none)."""
+        row = self._Row(level, entry)
+        return 0.0 if row is None else self.tables[level].information[row]
+
+    def Snapshot(self):
+        """The state of the index without the features, for a checkpoint.
+
+        Rows refer to exp entries by (sql, hint); see FromSnapshot().
+        """
+        tables = []
+        for table in self.tables:
+            state = dict(table.__dict__)
+            del state['features']
+            tables.append(state)
+        return {
+            'tables': tables,
+            'max_pairs_per_bucket': self.max_pairs_per_bucket,
+            'sample_rate': self.sample_rate,
+            'buckets': dict(self._buckets),
+            'num_pairs': self._num_pairs,
+        }
+
+    @classmethod
+    def FromSnapshot(cls, snapshot, exp):
+        """Restores a Snapshot(), sharing the features of exp's entries.
+
+        Rows whose entry is no longer in exp are removed.
+        """
+        index = cls(len(snapshot['tables']), snapshot['max_pairs_per_bucket'], snapshot['sample_rate'])
+        index._buckets.update(snapshot['buckets'])
+        index._num_pairs = snapshot['num_pairs']
+        missing = set()
+        for level, (table, state) in enumerate(zip(index.tables, snapshot['tables'])):
+            table.__dict__.update(state)
+            table.features = []
+            for key in table.keys:
+                entry = None if key is None else exp[level].Find(*key)
+                table.features.append(None if entry is None else entry[4])
+                if key is not None and entry is None:
+                    missing.add((level, key))
+        if missing:
+            for (level, _), bucket in index._buckets.items():
+                for key in [key for key in bucket if (level, key) in missing]:
+                    index.tables[level].RemoveRow(bucket.pop(key))
+        return index
+
+    def NumPairs(self, level=None):
+        if level is not None:
+            return self.tables[level].NumPairs()
+        return sum(table.NumPairs() for table in self.tables)
+
+    def Pairs(self, levels):
+        """All pairs of the given levels, as int32 arrays.
+
+        Returns:
+          (pair_levels, pair_ids, js, ks): pair pair_ids[i] of level
+          pair_levels[i] joins rows js[i] and ks[i].  pair_ids are valid
+          until the next call.
+        """
+        pair_levels, pair_ids, js, ks = [], [], [], []
+        for level in levels:
+            table = self.tables[level]
+            if table.num_removed:
+                table.Compact()
+            pairs = np.array(table.pairs, dtype=np.int32).reshape(-1, 2)
+            pair_levels.append(np.full(len(pairs), level, dtype=np.int32))
+            pair_ids.append(np.arange(len(pairs), dtype=np.int32))
+            js.append(pairs[:, 0])
+            ks.append(pairs[:, 1])
+        if not pair_levels:
+            empty = np.zeros(0, dtype=np.int32)
+            return empty, empty, empty, empty
+        return (np.concatenate(pair_levels), np.concatenate(pair_ids), np.concatenate(js),
+                np.concatenate(ks))
+
+    def Weights(self, pair_levels, pair_ids):
+        """The priorities of the given pairs, as a float array."""
+        return np.array([self.tables[level].priorities[p]
+                         for level, p in zip(pair_levels.tolist(), pair_ids.tolist())], dtype=np.float64)
+
+    def UpdatePriorities(self, pair_levels, pair_ids, js, ks, priorities):
+        """Sets the priorities of the given pairs (as returned by Pairs())."""
+        for level, p, j, k, priority in zip(pair_levels.tolist(), pair_ids.tolist(), js.tolist(), ks.tolist(),
+                                            list(priorities)):
+            table = self.tables[level]
+            delta = priority - table.priorities[p]
+            table.priorities[p] = priority
+            table.information[j] += delta
+            table.information[k] += delta
+
+    def Gather(self, pair_levels, js, ks):
+        """The model inputs of the given pairs.
+
+        Returns:
+          query_feats, nodes, latencies, costs: per pair, j's then k's.  j and
+            k share join_ids, but may be sub-queries of different SQL (with
+            different filters), so each keeps its own query encoding; see
+            encoding.PairQueryEncoding and QueryKeys().
+        """
+        query_feats, nodes, latencies, costs = [], [], [], []
+        for level, j, k in zip(pair_levels.tolist(), js.tolist(), ks.tolist()):
+            table = self.tables[level]
+            query_feats.append(table.features[j][0])
+            query_feats.append(table.features[k][0])
+            nodes.append(table.features[j][1])
+            nodes.append(table.features[k][1])
+            latencies.append(table.latencies[j])
+            latencies.append(table.latencies[k])
+            costs.append(table.costs[j])
+            costs.append(table.costs[k])
+        return query_feats, nodes, latencies, costs
+
+    def Targets(self, pair_levels, js, ks):
+        """The latencies and costs of the given pairs, level by level.
+
+        Returns:
+          (latencies, costs): [n, 2] float arrays, j's then k's per pair; see
+          pair_loss.PairTargets().
+        """
+        latencies = np.zeros((len(js), 2))
+        costs = np.zeros((len(js), 2))
+        for level in np.unique(pair_levels).tolist():
+            table = self.tables[level]
+            mask = pair_levels == level
+            rows = np.stack([js[mask], ks[mask]], axis=1)
+            latencies[mask] = np.array(table.latencies)[rows]
+            costs[mask] = np.array(table.costs)[rows]
+        return latencies, costs
+
+    def Keys(self, pair_levels, js, ks):
+        """The (sql, hint) of the given pairs' plans, j's then k's per pair."""
+        keys = []
+        for level, j, k in zip(pair_levels.tolist(), js.tolist(), ks.tolist()):
+            keys.append(self.tables[level].keys[j])
+            keys.append(self.tables[level].keys[k])
+        return keys
+
+    def QueryKeys(self, pair_levels, js, ks):
+        """The sql of the given pairs' plans, j's then k's per pair.
+
+        Plans with equal query keys have equal query encodings.
+        """
+        return [sql for sql, _ in self.Keys(pair_levels, js, ks)]
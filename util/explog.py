@@ -0,0 +1,217 @@
+"""Append-only log of the trainer's experience, PG costs and best plans.
+
+train_Job.py used to pickle exp, finexp, costCache and bestplanslist from
+scratch at the end of every iteration.  Their entries hold Node trees and
+tensors, so every dump re-serialized everything measured so far and took
+longer each iteration.
+
+ExperienceLog appends one chunk per iteration instead, holding only what
+changed since the previous chunk:
+
+  - pools (ExperiencePool or lists of per-level lists): the entries whose
+    (sql, hint) were not written yet, and the (sql, hint) evicted since;
+  - dicts (e.g. costCache, which only grows): the keys added since;
+  - lists of lists (e.g. bestplanslist): the new tail of every list.
+
+A chunk is a pickle prefixed by its length and CRC32.  Load() memory-maps
+the log and replays the chunks in order; a chunk cut short by a crash ends
+the log.
+
+Usage:
+    log = ExperienceLog(log_dir + '/explog.log')
+    ...
+    log.Append(pools={'exp': exp, 'finexp': finexp},
+               dicts={'cost': costCache}, lists={'bestplans': bestplanslist})
+
+    state = Load(log_dir + '/explog.log')
+    exp = experience.ExperiencePool(state['pools']['exp'])
+    costCache = state['dicts']['cost']
+
+A checkpoint records Pointer() of the log; Load(*pointer) replays the log
+up to that point and ExperienceLog(path, resume=state) truncates it there
+and keeps appending (see util/checkpoint.py).
+"""
+import collections
+import itertools
+import mmap
+import os
+import pickle
+import struct
+import zlib
+
+# Payload length and CRC32 of the payload.
+_HEADER = struct.Struct('<QI')
+
+
+def _Fingerprint(entry):
+    return entry[1], entry[2]
+
+
+def ReadChunks(path, size=None):
+    """Yields (chunk, end offset) of the chunks of the log at path, in order.
+
+    size: if set, only the first size bytes are read.
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size if size is None else size
+        if size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            offset = 0
+            while offset + _HEADER.size <= size:
+                length, crc = _HEADER.unpack_from(view, offset)
+                start = offset + _HEADER.size
+                if start + length > size:
+                    break
+                payload = view[start:start + length]
+                if zlib.crc32(payload) != crc:
+                    break
+                offset = start + length
+                yield pickle.loads(payload), offset
+
+
+def Load(path, size=None):
+    """Replays the log at path, or its first size bytes.
+
+    Entries come back in the order they were first written, which is not
+    the pool's order if entries were replaced in place (e.g. 'reservoir').
+
+    Returns:
+      {'pools': {name: per-level lists of entries},
+       'dicts': {name: dict}, 'lists': {name: list of lists},
+       'iterations': number of chunks, 'size': bytes replayed}.
+    """
+    # name -> per-level {(sql, hint): entry}, in insertion order.
+    pools = {}
+    dicts = {}
+    lists = {}
+    iterations = 0
+    end = 0
+    for chunk, end in ReadChunks(path, size):
+        iterations += 1
+        for name, (num_levels, levels) in chunk['pools'].items():
+            pool = pools.setdefault(name, [])
+            while len(pool) < num_levels:
+                pool.append(collections.OrderedDict())
+            for level, (added, removed) in levels.items():
+                for fingerprint in removed:
+                    pool[level].pop(fingerprint, None)
+                for entry in added:
+                    pool[level][_Fingerprint(entry)] = entry
+        for name, items in chunk['dicts'].items():
+            dicts.setdefault(name, {}).update(items)
+        for name, tails in chunk['lists'].items():
+            current = lists.setdefault(name, [])
+            for i, tail in tails.items():
+                while len(current) <= i:
+                    current.append([])
+                current[i].extend(tail)
+    return {
+        'pools': {name: [list(level.values()) for level in pool] for name, pool in pools.items()},
+        'dicts': dicts,
+        'lists': lists,
+        'iterations': iterations,
+        'size': end,
+    }
+
+
+class ExperienceLog(object):
+    """Writes the per-iteration deltas of the trainer's state to a log.
+
+    Args:
+      path: the log; created, or truncated unless resuming.
+      resume: Load(path, size) of the log: it is cut at that size, and the
+        next Append() writes what changed since that state.
+    """
+
+    def __init__(self, path, resume=None):
+        self.path = path
+        # name -> per-level set of the (sql, hint) written and not evicted.
+        self._written = {}
+        # name -> number of dict items / per-list lengths written.
+        self._dict_sizes = {}
+        self._list_sizes = {}
+        self.bytes_written = 0
+        if resume is None:
+            self._file = open(path, 'wb')
+            self.size = 0
+            return
+        os.truncate(path, resume['size'])
+        self._file = open(path, 'ab')
+        self.size = resume['size']
+        for name, pool in resume['pools'].items():
+            self._written[name] = [set(_Fingerprint(entry) for entry in entries) for entries in pool]
+        for name, items in resume['dicts'].items():
+            self._dict_sizes[name] = len(items)
+        for name, lists in resume['lists'].items():
+            self._list_sizes[name] = [len(current) for current in lists]
+
+    def Pointer(self):
+        """(path, size) of the log so far; see Load()."""
+        return self.path, self.size
+
+    def _PoolDelta(self, name, pool):
+        written = self._written.setdefault(name, [])
+        delta = {}
+        for level, entries in enumerate(pool):
+            if len(written) <= level:
+                written.append(set())
+            seen = written[level]
+            current = set()
+            added = []
+            for entry in entries:
+                fingerprint = _Fingerprint(entry)
+                current.add(fingerprint)
+                if fingerprint not in seen:
+                    seen.add(fingerprint)
+                    added.append(entry)
+            removed = seen - current
+            seen -= removed
+            if added or removed:
+                delta[level] = (added, list(removed))
+        return len(pool), delta
+
+    def _DictDelta(self, name, items):
+        # Insertion ordered, and only ever added to.
+        size = self._dict_sizes.get(name, 0)
+        self._dict_sizes[name] = len(items)
+        return dict(itertools.islice(items.items(), size, None))
+
+    def _ListDelta(self, name, lists):
+        sizes = self._list_sizes.setdefault(name, [])
+        delta = {}
+        for i, current in enumerate(lists):
+            if len(sizes) <= i:
+                sizes.append(0)
+            if len(current) > sizes[i]:
+                delta[i] = list(current[sizes[i]:])
+                sizes[i] = len(current)
+        return delta
+
+    def Append(self, pools=None, dicts=None, lists=None):
+        """Appends one chunk with the changes since the previous Append().
+
+        Args:
+          pools: {name: exp-like list of per-level entry lists}.
+          dicts: {name: dict}.  Existing keys must not change.
+          lists: {name: list of lists}.  Lists may only grow.
+
+        Returns:
+          the number of bytes appended.
+        """
+        chunk = {
+            'pools': {name: self._PoolDelta(name, pool) for name, pool in (pools or {}).items()},
+            'dicts': {name: self._DictDelta(name, items) for name, items in (dicts or {}).items()},
+            'lists': {name: self._ListDelta(name, lists_) for name, lists_ in (lists or {}).items()},
+        }
+        payload = pickle.dumps(chunk, protocol=pickle.HIGHEST_PROTOCOL)
+        self._file.write(_HEADER.pack(len(payload), zlib.crc32(payload)))
+        self._file.write(payload)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.bytes_written += _HEADER.size + len(payload)
+        self.size += _HEADER.size + len(payload)
+        return _HEADER.size + len(payload)
+
+    def Close(self):
+        self._file.close()
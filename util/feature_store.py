@@ -0,0 +1,255 @@
+"""Memory-mapped store of the featurized plans of the experience.
+
+Every experience row carries its query vector and a full plans_lib.Node,
+and the Node used to be featurized again (treeconv.featurize_tree) each time
+it was trained on or scored.  A (sql, hint) always featurizes to the same
+arrays, so FeatureStore computes them once, when the row enters the
+experience, and appends them to flat files under one directory:
+
+    trees.f32     node features of every plan, [n + 1, d] rows each
+    indexes.i64   tree conv indexes of every plan, [3n, 1] each
+    queries.f32   query vectors, [1, q] each, one per (sql, join_ids)
+    offsets.i64   per row: tree offset, rows, columns; index offset, rows;
+                  query offset, columns
+    keys.pkl      per row: digests of its (sql, hint) and (sql, join_ids),
+                  pickled one after the other
+    removed.bin   rows removed since: digest of the (sql, hint), then row
+
+Only experience rows are stored (see train_Job.trackFeatures): Put() them
+as they are appended and Remove() them as they are evicted.  Featurize()
+serves the stored plans of a batch and featurizes the others in memory,
+without storing them, so the DP's scored candidates do not grow the store.
+In memory, a store keeps per live row its 16-byte key digest and offsets;
+the files are append-only.
+
+Reads are zero-copy slices of np.memmap views of those files; only the
+batch handed to the model is materialized.  One process writes a store;
+other processes (e.g. planning workers, or trainers of other levels) may
+open it with readonly=True and Refresh() to see the rows appended since.
+A store holds the features of one node featurizer, i.e. one workload.
+
+Usage:
+    store = FeatureStore(log_dir + '/features')
+    row = store.Put(key, node, query_encoding, nodeFeaturizer, query_key)
+    trees, indexes = store.Featurize(nodeFeaturizer, keys, nodes)
+    trees, indexes = store.Trees(rows)
+    store.Remove(key)
+"""
+import hashlib
+import os
+import pickle
+import threading
+
+import numpy as np
+
+from util import treeconv
+
+_DTYPES = {
+    'trees.f32': np.float32,
+    'indexes.i64': np.int64,
+    'queries.f32': np.float32,
+    'offsets.i64': np.int64,
+}
+_NUM_OFFSETS = 7
+_DIGEST_SIZE = 16
+_REMOVED_SIZE = _DIGEST_SIZE + 8
+
+
+def Digest(key):
+    """16-byte digest of a key, e.g. (sql, hint)."""
+    return hashlib.blake2b(repr(key).encode(), digest_size=_DIGEST_SIZE).digest()
+
+
+class FeatureStore(object):
+    """(sql, hint) -> featurized plan, in memory-mapped files under path."""
+
+    def __init__(self, path, readonly=False):
+        self.path = path
+        self.readonly = readonly
+        # Key digest -> row, per live row its _NUM_OFFSETS offsets, and
+        # (sql, join_ids) digest -> (query offset, columns).
+        self._rows = {}
+        self._offsets = {}
+        self._queries = {}
+        # Rows and removed keys read or written so far.
+        self._num_rows = 0
+        self._num_removed = 0
+        # name -> (elements mapped, np.memmap).
+        self._maps = {}
+        self._keys_file = None
+        self._files = {}
+        # Put() may be called from prefetching threads.
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if not readonly:
+            os.makedirs(path, exist_ok=True)
+            for name in list(_DTYPES) + ['keys.pkl', 'removed.bin']:
+                open(self._Path(name), 'ab').close()
+        self.Refresh()
+        if not readonly:
+            # Drop what a writer that crashed mid-Put left past the last row.
+            self._keys_file.truncate(self._keys_file.tell())
+            os.truncate(self._Path('offsets.i64'), self._num_rows * _NUM_OFFSETS * 8)
+            os.truncate(self._Path('removed.bin'), self._num_removed * _REMOVED_SIZE)
+            self._files = {name: open(self._Path(name), 'ab') for name in _DTYPES}
+            self._files['keys.pkl'] = self._keys_file
+            self._files['removed.bin'] = open(self._Path('removed.bin'), 'ab')
+
+    def __len__(self):
+        return len(self._rows)
+
+    def _Path(self, name):
+        return os.path.join(self.path, name)
+
+    def _Size(self, name):
+        """Number of elements in the data file name."""
+        return os.path.getsize(self._Path(name)) // np.dtype(_DTYPES[name]).itemsize
+
+    def Refresh(self):
+        """Loads the rows appended (by another process) since the last call."""
+        if self._keys_file is None:
+            self._keys_file = open(self._Path('keys.pkl'), 'rb' if self.readonly else 'rb+')
+        num_rows = self._Size('offsets.i64') // _NUM_OFFSETS
+        if num_rows > self._num_rows:
+            offsets = np.fromfile(self._Path('offsets.i64'), dtype=np.int64,
+                                  count=(num_rows - self._num_rows) * _NUM_OFFSETS,
+                                  offset=self._num_rows * _NUM_OFFSETS * 8)
+            # A row's keys are written before its offsets.
+            for row_offsets in offsets.reshape(-1, _NUM_OFFSETS).tolist():
+                digest, query_digest = pickle.load(self._keys_file)
+                self._rows[digest] = self._num_rows
+                self._offsets[self._num_rows] = row_offsets
+                self._queries[query_digest] = tuple(row_offsets[5:])
+                self._num_rows += 1
+        num_removed = os.path.getsize(self._Path('removed.bin')) // _REMOVED_SIZE
+        if num_removed > self._num_removed:
+            with open(self._Path('removed.bin'), 'rb') as f:
+                f.seek(self._num_removed * _REMOVED_SIZE)
+                removed = f.read((num_removed - self._num_removed) * _REMOVED_SIZE)
+            for i in range(0, len(removed), _REMOVED_SIZE):
+                self._Forget(removed[i:i + _DIGEST_SIZE],
+                             int.from_bytes(removed[i + _DIGEST_SIZE:i + _REMOVED_SIZE], 'little'))
+            self._num_removed = num_removed
+
+    def _Forget(self, digest, row):
+        # The key may have been Put again since, as a later row.
+        if self._rows.get(digest) == row:
+            del self._rows[digest]
+            del self._offsets[row]
+
+    def _View(self, name, start, stop):
+        """Zero-copy view of elements [start, stop) of the data file name."""
+        mapped, view = self._maps.get(name, (0, None))
+        if stop > mapped:
+            if name in self._files:
+                self._files[name].flush()
+            mapped = self._Size(name)
+            view = np.memmap(self._Path(name), dtype=_DTYPES[name], mode='r', shape=(mapped,))
+            self._maps[name] = (mapped, view)
+        return view[start:stop]
+
+    def _Append(self, name, values):
+        offset = self._files[name].tell() // np.dtype(_DTYPES[name]).itemsize
+        self._files[name].write(np.ascontiguousarray(values, dtype=_DTYPES[name]).tobytes())
+        return offset
+
+    def Row(self, key):
+        """The row of key, or None."""
+        return self._rows.get(Digest(key))
+
+    def Put(self, key, node, query_encoding, node_featurizer, query_key):
+        """Featurizes node under key unless stored already; returns its row.
+
+        query_key: e.g. (sql, join_ids); the query vector is stored once per
+          query_key.
+
+        Returns None if key is missing from a readonly store.
+        """
+        digest = Digest(key)
+        row = self._rows.get(digest)
+        if row is not None or self.readonly:
+            return row
+        with self._lock:
+            return self._Put(digest, node, query_encoding, node_featurizer, Digest(query_key))
+
+    def _Put(self, digest, node, query_encoding, node_featurizer, query_digest):
+        row = self._rows.get(digest)
+        if row is not None:
+            return row
+        tree, index = treeconv.featurize_tree(node, node_featurizer)
+        query = self._queries.get(query_digest)
+        if query is None:
+            values = query_encoding.detach().cpu().numpy().reshape(-1)
+            query = (self._Append('queries.f32', values), len(values))
+            self._queries[query_digest] = query
+        tree_offset = self._Append('trees.f32', tree)
+        index_offset = self._Append('indexes.i64', index)
+        row_offsets = [tree_offset, tree.shape[0], tree.shape[1], index_offset, index.shape[0], query[0],
+                       query[1]]
+        pickle.dump((digest, query_digest), self._files['keys.pkl'])
+        self._files['keys.pkl'].flush()
+        self._Append('offsets.i64', row_offsets)
+        self._files['offsets.i64'].flush()
+        row = self._num_rows
+        self._num_rows += 1
+        self._rows[digest] = row
+        self._offsets[row] = row_offsets
+        return row
+
+    def Remove(self, key):
+        """Forgets the row of key, e.g. evicted from the experience."""
+        assert not self.readonly
+        digest = Digest(key)
+        with self._lock:
+            row = self._rows.get(digest)
+            if row is None:
+                return
+            self._Forget(digest, row)
+            self._files['removed.bin'].write(digest + row.to_bytes(8, 'little'))
+            self._files['removed.bin'].flush()
+            self._num_removed += 1
+
+    def Tree(self, row):
+        """(node features [n + 1, d], indexes [3n, 1]) of row, as views."""
+        tree_offset, tree_rows, tree_cols, index_offset, index_rows, _, _ = self._offsets[row]
+        tree = self._View('trees.f32', tree_offset, tree_offset + tree_rows * tree_cols)
+        index = self._View('indexes.i64', index_offset, index_offset + index_rows)
+        return tree.reshape(tree_rows, tree_cols), index.reshape(index_rows, 1)
+
+    def QueryEncoding(self, row):
+        """The query vector of row as a [1, q] view."""
+        query_offset, query_cols = self._offsets[row][5:]
+        return self._View('queries.f32', query_offset, query_offset + query_cols).reshape(1, query_cols)
+
+    def Trees(self, rows):
+        """(trees, indexes) tensors of rows, as encoding.TreeConvFeaturize."""
+        features, indexes = zip(*[self.Tree(row) for row in rows])
+        return treeconv.batch_trees(list(features), list(indexes))
+
+    def Featurize(self, node_featurizer, keys, nodes):
+        """encoding.TreeConvFeaturize(node_featurizer, nodes), from the store.
+
+        nodes[i] is read from the row of keys[i] if there is one, else
+        featurized in memory; nothing is stored.
+        """
+        rows = [self._rows.get(Digest(key)) for key in keys]
+        if self.readonly and None in rows:
+            self.Refresh()
+            rows = [self._rows.get(Digest(key)) for key in keys]
+        features, indexes = [], []
+        for row, node in zip(rows, nodes):
+            tree, index = treeconv.featurize_tree(node, node_featurizer) if row is None else self.Tree(row)
+            features.append(tree)
+            indexes.append(index)
+        self.misses += rows.count(None)
+        self.hits += len(rows) - rows.count(None)
+        return treeconv.batch_trees(features, indexes)
+
+    def Close(self):
+        for f in self._files.values():
+            f.close()
+        if self._keys_file is not None and not self._files:
+            self._keys_file.close()
+        self._files = {}
+        self._keys_file = None
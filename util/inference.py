@@ -0,0 +1,345 @@
+"""CPU inference engine for the per-level calibration models."""
+import collections
+import copy
+import io
+import os
+import time
+
+import numpy as np
+import torch
+from torch import nn
+
+
+def SetNumThreads(num_threads=None, num_interop_threads=None):
+    """Pins torch's intra-op (and optionally inter-op) CPU thread pools."""
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads is not None:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError:
+            # Can only be set once, before any inter-op parallel work.
+            pass
+
+
+def _ExampleInputs(model, batch_size=4, num_nodes=7):
+    """Dummy (query_feats, trees, indexes, query_index) for tracing."""
+    # Level views of a shared trunk (treeconv_dropout.LevelView).
+    model = getattr(model, 'model', model)
+    query_dims = model.query_mlp[0].in_features
+    plan_dims = model.conv[0]._in_dims - model.query_mlp[-1].out_features
+    query_feats = torch.zeros(1, query_dims)
+    trees = torch.zeros(batch_size, plan_dims, num_nodes + 1)
+    # A valid (if meaningless) preorder index layout: 3 slots per node.
+    indexes = torch.arange(1, num_nodes + 1).repeat_interleave(3).view(
+        1, -1, 1).expand(batch_size, -1, -1).contiguous()
+    query_index = torch.zeros(batch_size, dtype=torch.long)
+    return query_feats, trees, indexes, query_index
+
+
+class _WindowLinear(nn.Module):
+    """A Conv1d with kernel_size == stride, rewritten as a Linear.
+
+    TreeConv1d convolves non-overlapping (node, left, right) windows, which
+    is a Linear over the flattened windows.  Unlike Conv1d, Linear is
+    supported by dynamic quantization.
+    """
+
+    def __init__(self, conv):
+        super().__init__()
+        out_dims, in_dims, width = conv.weight.shape
+        assert conv.stride[0] == width, conv
+        self.width = width
+        self.linear = nn.Linear(in_dims * width, out_dims)
+        with torch.no_grad():
+            self.linear.weight.copy_(conv.weight.reshape(out_dims, -1))
+            self.linear.bias.copy_(conv.bias)
+
+    def forward(self, x):
+        # [batch, dims, width * nodes] -> [batch, nodes, dims * width].
+        windows = x.reshape(x.shape[0], x.shape[1], -1, self.width)
+        windows = windows.permute(0, 2, 1, 3).flatten(2)
+        return self.linear(windows).transpose(1, 2)
+
+
+def Quantize(model):
+    """Returns a dynamic int8 copy of a TreeConvolution for CPU inference.
+
+    Weights of all Linear layers (including the tree convolutions, see
+    _WindowLinear) are stored in int8; activations are quantized on the fly.
+    LayerNorm and TreeStandardize stay in fp32.
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    for module in list(model.modules()):
+        if isinstance(getattr(module, 'weights', None), nn.Conv1d):
+            module.weights = _WindowLinear(module.weights)
+    return torch.quantization.quantize_dynamic(model, {nn.Linear},
+                                               dtype=torch.qint8)
+
+
+def SizeMb(module):
+    """Serialized size of a model's weights."""
+    buf = io.BytesIO()
+    if isinstance(module, torch.jit.ScriptModule):
+        torch.jit.save(module, buf)
+    else:
+        torch.save(module.state_dict(), buf)
+    return buf.tell() / 1024 / 1024
+
+
+def Compile(model, example_inputs=None, quantize=False):
+    """Returns a frozen TorchScript copy of a TreeConvolution on CPU.
+
+    The copy is put in eval mode, so dropout is disabled: one forward pass
+    replaces the mean over MC-dropout samples taken by the eager DP.  With
+    quantize=True the copy is dynamically quantized to int8 first.
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    if quantize:
+        model = Quantize(model)
+    if example_inputs is None:
+        example_inputs = _ExampleInputs(model)
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example_inputs, check_trace=False)
+    if hasattr(torch.jit, 'freeze'):
+        traced = torch.jit.freeze(traced)
+    return traced
+
+
+class _CompiledLevel(nn.Module):
+    """Calls a compiled model on CPU, whatever device the inputs live on."""
+
+    def __init__(self, compiled):
+        super().__init__()
+        self.compiled = compiled
+
+    def forward(self, query_feats, trees, indexes, query_index=None):
+        if query_index is None:
+            query_index = torch.arange(trees.shape[0])
+        with torch.no_grad():
+            return self.compiled(query_feats.cpu(), trees.cpu(), indexes.cpu(),
+                                 query_index.cpu())
+
+
+class InferenceEngine(object):
+    """Frozen TorchScript copies of the per-level models for CPU planning.
+
+    Indexable like the model_levels list of train_Job.py (entries 0 and 1
+    stay placeholders), so it can be passed as 'model' to the test-time DP:
+
+        engine = InferenceEngine(model_levels, num_threads=4)
+        DP.dp.TEST_left_prune_bayes(..., engine, nodeFeaturizer, costCache)
+
+    Models are compiled in eval mode; mc_samples tells the DP that a single
+    pass is enough since the output is deterministic.  quantize=True opts
+    into dynamic int8 weights (see Quantize and QuantizationReport).
+    """
+
+    mc_samples = 1
+
+    def __init__(self, models, num_threads=None, num_interop_threads=None,
+                 quantize=False):
+        SetNumThreads(num_threads, num_interop_threads)
+        self.quantize = quantize
+        self.models = [
+            m if not isinstance(m, nn.Module) else _CompiledLevel(
+                Compile(m, quantize=quantize)) for m in models
+        ]
+
+    def __getitem__(self, level):
+        return self.models[level]
+
+    def __len__(self):
+        return len(self.models)
+
+    def Calibrate(self, level, query_feats, trees, indexes, query_index=None):
+        """Returns tanh(model) + 1, sized [batch size]."""
+        out = self.models[level](query_feats, trees, indexes, query_index)
+        return torch.tanh(out).add(1).squeeze(1)
+
+
+def _RandomBatch(model, batch_size, num_rels):
+    """A batch of left-deep plans over num_rels relations, one query."""
+    num_nodes = 2 * num_rels - 1
+    query_feats, _, _, _ = _ExampleInputs(model)
+    model = getattr(model, 'model', model)
+    plan_dims = model.conv[0]._in_dims - model.query_mlp[-1].out_features
+    trees = torch.rand(batch_size, plan_dims, num_nodes + 1)
+    indexes = torch.randint(0, num_nodes + 1, (batch_size, 3 * num_nodes, 1))
+    query_index = torch.zeros(batch_size, dtype=torch.long)
+    return torch.rand_like(query_feats), trees, indexes, query_index
+
+
+def _Time(fn, repeat):
+    fn()  # Warm up.
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        fn()
+        times.append(time.time() - start)
+    return np.median(times) * 1e3
+
+
+def Benchmark(model, batch_sizes=(6, 12, 24, 96, 384), num_rels=(4, 8, 12, 17),
+              num_threads=1, repeat=20):
+    """Latency (ms) of scoring one query's candidates: eager vs. compiled.
+
+    'eager x10' is what the DP does today (10 MC-dropout passes in train
+    mode); 'eager' is one eval-mode pass; 'compiled' is the frozen trace;
+    'int8' is the frozen trace of the quantized model.
+    """
+    SetNumThreads(num_threads)
+    model = model.cpu()
+    compiled = _CompiledLevel(Compile(model))
+    quantized = _CompiledLevel(Compile(model, quantize=True))
+    print('threads={} fp32={:.2f}MB int8={:.2f}MB'.format(
+        torch.get_num_threads(), SizeMb(compiled.compiled),
+        SizeMb(quantized.compiled)))
+    print('{:>6} {:>6} {:>12} {:>10} {:>10} {:>10}'.format(
+        'rels', 'batch', 'eager x10', 'eager', 'compiled', 'int8'))
+    for n in num_rels:
+        for b in batch_sizes:
+            inputs = _RandomBatch(model, b, n)
+
+            def _EagerMc():
+                model.train()
+                with torch.no_grad():
+                    for _ in range(10):
+                        model(*inputs)
+
+            def _Eager():
+                model.eval()
+                with torch.no_grad():
+                    model(*inputs)
+
+            t_mc = _Time(_EagerMc, repeat)
+            t_eager = _Time(_Eager, repeat)
+            t_compiled = _Time(lambda: compiled(*inputs), repeat)
+            t_quantized = _Time(lambda: quantized(*inputs), repeat)
+            print('{:>6} {:>6} {:>12.3f} {:>10.3f} {:>10.3f} {:>10.3f}'.format(
+                n, b, t_mc, t_eager, t_compiled, t_quantized))
+
+
+def _ExperiencePairs(entries):
+    """Index pairs (j, k) of a level's experience that a trainer would use.
+
+    Same rule as experience.PairIndex: same join_ids, different plans,
+    different latencies.  Each unordered pair is returned once.
+    """
+    groups = collections.defaultdict(list)
+    for idx, entry in enumerate(entries):
+        if len(entry) > 6:
+            groups[entry[6]].append(idx)
+    pairs = []
+    for members in groups.values():
+        for a in range(len(members)):
+            for b in range(a + 1, len(members)):
+                j, k = entries[members[a]], entries[members[b]]
+                if (j[1] == k[1] and j[2] == k[2]) or j[3] == k[3]:
+                    continue
+                pairs.append((members[a], members[b]))
+    return pairs
+
+
+def _Calibrate(model, entries, nodeFeaturizer, batch_size):
+    from util.encoding import TreeConvFeaturize
+
+    out = []
+    for start in range(0, len(entries), batch_size):
+        batch = entries[start:start + batch_size]
+        query_feats = torch.cat([e[4][0].cpu() for e in batch], dim=0)
+        trees, indexes = TreeConvFeaturize(nodeFeaturizer,
+                                           [e[4][1] for e in batch])
+        with torch.no_grad():
+            out.append(torch.tanh(model(query_feats, trees, indexes)).add(1))
+    return torch.cat(out, dim=0).squeeze(1)
+
+
+def LoadModels(prefix, num_levels):
+    """Loads the models saved by train_Job.saveModels under prefix, on CPU.
+
+    Returns a list indexed by level, like train_Job's model_levels, of
+    num_levels entries: levels without a model (0, 1, and any whose .pth is
+    missing) are 'blank'.  A shared model (prefix + 'shared.pth') is
+    returned as its per-level views.
+    """
+    models = ['blank'] * num_levels
+    if os.path.exists(prefix + 'shared.pth'):
+        shared = torch.load(prefix + 'shared.pth', map_location='cpu')
+        for level in range(2, min(num_levels, shared.max_level + 1)):
+            models[level] = shared.ForLevel(level)
+        return models
+    for level in range(2, num_levels):
+        path = prefix + str(level) + '.pth'
+        if os.path.exists(path):
+            models[level] = torch.load(path, map_location='cpu')
+    return models
+
+
+def QuantizationReport(models, exp, nodeFeaturizer, num_threads=1,
+                       batch_size=256):
+    """Compares the int8 engine against fp32 on stored experience.
+
+    For every level with experience, reports on the train pairs of that
+    level: 'agree' is the fraction of pairs ranked the same way by both
+    models; 'acc' is each model's pairwise accuracy against the measured
+    latencies.  Also reports size and the time to score the whole level.
+    """
+    SetNumThreads(num_threads)
+    print('{:>5} {:>7} {:>7} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9}'.format(
+        'level', 'pairs', 'agree', 'fp32 acc', 'int8 acc', 'fp32 MB',
+        'int8 MB', 'fp32 ms', 'int8 ms'))
+    for level in range(2, min(len(models), len(exp))):
+        if not isinstance(models[level], nn.Module) or not exp[level]:
+            continue
+        entries = exp[level]
+        pairs = _ExperiencePairs(entries)
+        if not pairs:
+            continue
+        fp32 = _CompiledLevel(Compile(models[level]))
+        int8 = _CompiledLevel(Compile(models[level], quantize=True))
+        start = time.time()
+        calib_fp32 = _Calibrate(fp32, entries, nodeFeaturizer, batch_size)
+        t_fp32 = time.time() - start
+        start = time.time()
+        calib_int8 = _Calibrate(int8, entries, nodeFeaturizer, batch_size)
+        t_int8 = time.time() - start
+
+        j, k = torch.tensor(pairs).t()
+        costs = torch.tensor([e[0] for e in entries])
+        latencies = torch.tensor([e[3] for e in entries])
+        truth = latencies[j] > latencies[k]
+        pred_fp32 = calib_fp32[j] * costs[j] > calib_fp32[k] * costs[k]
+        pred_int8 = calib_int8[j] * costs[j] > calib_int8[k] * costs[k]
+        print('{:>5} {:>7} {:>7.4f} {:>9.4f} {:>9.4f} {:>9.2f} {:>9.2f} '
+              '{:>9.1f} {:>9.1f}'.format(
+                  level, len(pairs),
+                  (pred_fp32 == pred_int8).float().mean().item(),
+                  (pred_fp32 == truth).float().mean().item(),
+                  (pred_int8 == truth).float().mean().item(),
+                  SizeMb(fp32.compiled), SizeMb(int8.compiled), t_fp32 * 1e3,
+                  t_int8 * 1e3))
+
+
+if __name__ == '__main__':
+    from util import explog, treeconv_dropout
+
+    # Random weights: latency does not depend on the trained values.
+    Benchmark(treeconv_dropout.TreeConvolution(820, 123, 1))
+
+    # Set these to a training run's model prefix and explog_*.log to check the
+    # int8 models' ranking agreement (needs a connection to PostgreSQL for
+    # the workload's featurizer).
+    modelpath = ''
+    exppath = ''
+    if modelpath and exppath:
+        from util import envs, plans_lib, postgres
+
+        exp = explog.Load(exppath)['pools']['exp']
+        models = LoadModels(modelpath, len(exp))
+        workload = envs.JoinOrderBenchmark(envs.JoinOrderBenchmark.Params())
+        workload.workload_info.table_num_rows = postgres.GetAllTableNumRows(
+            workload.workload_info.rel_names)
+        nodeFeaturizer = plans_lib.PhysicalTreeNodeFeaturizer(
+            workload.workload_info)
+        QuantizationReport(models, exp, nodeFeaturizer)
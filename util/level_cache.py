@@ -0,0 +1,97 @@
+"""Reuses the model-independent low levels of the DP across planning passes.
+
+train_Job.py replans every training query each iteration with
+UCB_left_prune_replay_fix_kl, and getGMRL replans the train/test queries with
+TEST_left_prune_bayes.  Both build dp_tables level by level, but their low
+levels are scored with the raw PG cost only: until the first level that the
+model scores (or prunes), dp_tables do not depend on the model nor on the
+experience, so every pass recomputes the very same tables.
+
+LevelCache keeps, per query and DP configuration, dp_tables[1..k] of the
+highest such level k.  A later pass restores them and starts the DP at level
+k + 1; see DynamicProgramming._RunDP() and DPStages.ReusableLevels().
+
+The cached plans are shared, not copied: the DP only reads dp_tables entries
+of finished levels, and builds new Nodes on top of them.
+
+Usage:
+    cache = LevelCache()
+    top = cache.Restore('left_deep', query_leaves, all_join_conds, dp_tables,
+                        max_level)
+    ...
+    cache.Store('left_deep', query_leaves, all_join_conds, dp_tables, level)
+"""
+
+
+def QueryKey(query_leaves, all_join_conds):
+    """Identifies a query by its base relations, filters and join clauses."""
+    leaves = sorted((leaf.table_alias, leaf.table_name,
+                     leaf.info.get('filter'), leaf.info.get('select_exprs'))
+                    for leaf in query_leaves)
+    return tuple(leaves), tuple(sorted(all_join_conds))
+
+
+class LevelCache(object):
+    """Memoizes the low dp_tables levels of each (configuration, query)."""
+
+    def __init__(self):
+        # (configuration, query key) -> {level: dp_table}, levels 1..k.
+        self._entries = {}
+        # Keys stored since the last Flush().
+        self._new_keys = set()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def Restore(self, config, query_leaves, all_join_conds, dp_tables,
+                max_level):
+        """Fills dp_tables[1..k] from the cache, k <= max_level.
+
+        Args:
+          config: name of the DP configuration that computed the tables.
+            Configurations sharing a name must compute their reusable levels
+            the same way.
+          max_level: highest level that may be restored.
+
+        Returns:
+          k, the highest restored level; 1 (nothing restored) on a miss.
+        """
+        tables = self._entries.get((config, QueryKey(query_leaves,
+                                                     all_join_conds)))
+        if tables is None:
+            self.misses += 1
+            return 1
+        self.hits += 1
+        top = min(max(tables), max_level)
+        # Level 1 too, so that all restored plans share the same leaves.
+        for level in range(1, top + 1):
+            dp_tables[level] = dict(tables[level])
+        return top
+
+    def Store(self, config, query_leaves, all_join_conds, dp_tables, level):
+        """Caches dp_tables[1..level] unless more levels are cached already."""
+        key = (config, QueryKey(query_leaves, all_join_conds))
+        tables = self._entries.get(key)
+        if tables is not None and max(tables) >= level:
+            return
+        self._entries[key] = {l: dict(dp_tables[l]) for l in range(1, level + 1)}
+        self._new_keys.add(key)
+
+    def Flush(self):
+        """Returns the entries stored since the last call (see Update())."""
+        delta = {key: self._entries[key] for key in self._new_keys}
+        self._new_keys = set()
+        return delta
+
+    def Update(self, entries):
+        """Merges entries of another cache, e.g. a worker's Flush()."""
+        for key, tables in entries.items():
+            current = self._entries.get(key)
+            if current is None or max(current) < max(tables):
+                self._entries[key] = tables
+
+    def Clear(self):
+        self._entries = {}
+        self._new_keys = set()
@@ -0,0 +1,329 @@
+"""Trains the per-level models on their train pairs, serially or in parallel.
+
+Each iteration, train_Job.py fits every level's model on the pairs of that
+level (see experience.PairIndex): up to 500 epochs of a train pass and a
+validation pass, until the validation accuracy exceeds 0.96.  The levels'
+models and optimizers are independent, so the wall time of training them one
+after another is the sum over all levels.
+
+TrainModel() is that loop, for one model (or the shared model of all
+levels).  TrainInPool() runs it for several levels at once, in a process
+pool sized to a core budget: every worker pins its torch thread count to its
+share of the cores, rebuilds its model and optimizer from the parent's
+state, trains on a PairDataset, and sends back the new states, the pairs'
+priorities and its statistics; per-epoch progress is forwarded to the
+parent while the workers run.  The largest levels are scheduled first.
+
+A PairDataset holds the pairs of some levels with every plan featurized once
+(numpy arrays, picklable), so workers neither need the experience's Nodes
+nor featurize plans again every epoch.
+
+Usage:
+    stats = TrainModel(model_levels, optimizer, pair_levels, make_batch,
+                       batch_size, device)
+    datasets = [PairDataset(trainpair, levels, nodeFeaturizer) for ...]
+    for name, stats in TrainInPool(model_levels, optlist, groups, datasets,
+                                   num_cores=16, ...):
+        ...
+"""
+import collections
+import multiprocessing
+import copy
+import inspect
+import queue
+import random
+import threading
+import time
+
+import numpy as np
+import torch
+from util import pair_loss, prefetch, treeconv, treeconv_dropout
+
+
+def ForwardPairs(model_levels, pair_levels, query_feats, trees, indexes, query_index):
+    """The model of pair_levels[0] on a batch of pairs.
+
+    A shared model (treeconv_dropout.LevelView) scores the pairs of all
+    levels of the batch in one forward pass.
+    """
+    model = model_levels[pair_levels[0]]
+    if isinstance(model, treeconv_dropout.LevelView):
+        levels = torch.tensor(pair_levels, device=trees.device).repeat_interleave(2)
+        return model.model(query_feats, trees, indexes, levels, query_index)
+    return model(query_feats, trees, indexes, query_index)
+
+
+def _Calibration(model_levels, pair_levels, inputs, num_samples, device):
+    query_feats, query_index, trees, indexes = inputs
+    calibration = []
+    for _ in range(num_samples):
+        calibration.append(
+            torch.tanh(ForwardPairs(model_levels, pair_levels, query_feats, trees, indexes,
+                                    query_index).to(device)).add(1))
+    return torch.mean(torch.cat(calibration, 1), dim=1)
+
+
+def TrainModel(model_levels, optimizer, pair_levels, make_batch, batch_size, device, max_epochs=500,
+               target_accuracy=0.96, max_epoch_index=13, num_samples=10, weights=None, on_validated=None,
+               progress=None, prefetch_workers=1, prefetch_depth=2):
+    """Fits the model of some levels on their pairs.
+
+    Args:
+      model_levels, optimizer: the model(s) and the optimizer to step.
+      pair_levels: int array, the level of every pair.
+      make_batch: fn(pair indices) -> (query_feats, query_index, trees,
+        indexes, costs, labels), with CPU tensors; costs and labels as
+        pair_loss.PairTargets().  See prefetch.BatchPrefetcher.
+      weights: if set, fn() -> per-pair sampling weights (prioritized
+        replay); a train pass then draws len(pair_levels) pairs with
+        replacement, and a validation pass covers every pair.
+      on_validated: fn(pair indices, per-pair disagreement with the label),
+        called for every validation batch.
+      progress: fn(epoch, accuracy), called after every epoch.
+
+    Returns:
+      dict of statistics: epochs, accuracy, train/test/data/compute seconds
+      and steps.
+    """
+    stats = collections.Counter()
+    num_pairs = len(pair_levels)
+
+    def Batches(indices):
+        loader = prefetch.BatchPrefetcher(make_batch,
+                                          [indices[i: i + batch_size] for i in range(0, len(indices), batch_size)],
+                                          device, num_workers=prefetch_workers, depth=prefetch_depth)
+        yield from loader
+        stats['data_seconds'] += loader.data_seconds
+        stats['compute_seconds'] += loader.compute_seconds
+        stats['steps'] += loader.steps
+
+    accuracy = 0
+    for epoch in range(max_epochs):
+        # ----------- train -----------
+        if weights is not None:
+            w = weights()
+            indices = np.random.choice(num_pairs, num_pairs, p=w / w.sum())
+        else:
+            indices = np.random.permutation(num_pairs)
+        start = time.time()
+        for batch, (query_feats, query_index, trees, indexes, costs, labels) in Batches(indices):
+            calibration = _Calibration(model_levels, pair_levels[batch].tolist(),
+                                       (query_feats, query_index, trees, indexes), num_samples, device)
+            loss = torch.mean(pair_loss.CrossEntropyLoss(calibration, costs, labels), 0)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+        stats['train_seconds'] += time.time() - start
+
+        # ----------- validate -----------
+        start = time.time()
+        if weights is not None:
+            indices = np.arange(num_pairs)
+        # Summed on the device, read once per epoch.
+        correct = torch.zeros((), dtype=torch.long, device=device)
+        count = 0
+        for batch, (query_feats, query_index, trees, indexes, costs, labels) in Batches(indices):
+            count += len(batch)
+            with torch.no_grad():
+                calibration = _Calibration(model_levels, pair_levels[batch].tolist(),
+                                           (query_feats, query_index, trees, indexes), num_samples, device)
+                softm = pair_loss.Probabilities(calibration, costs)
+                correct += pair_loss.NumCorrect(softm, labels)
+                if on_validated is not None:
+                    on_validated(batch, pair_loss.Disagreement(softm, labels).tolist())
+        stats['test_seconds'] += time.time() - start
+        accuracy = correct.item() / count
+        stats['epochs'] = epoch + 1
+        if progress is not None:
+            progress(epoch + 1, accuracy)
+        if accuracy > target_accuracy or epoch > max_epoch_index:
+            break
+    stats = dict(stats)
+    stats['accuracy'] = accuracy
+    return stats
+
+
+class PairDataset(object):
+    """The pairs of some levels, with their plans featurized once.
+
+    Picklable: holds numpy arrays only, no Nodes.
+    """
+
+    def __init__(self, trainpair, levels, node_featurizer, store=None):
+        """
+        Args:
+          trainpair: an experience.PairIndex.
+          levels: the levels whose pairs to take (see PairIndex.Pairs()).
+          store: a feature_store.FeatureStore to read the plans from, if set.
+        """
+        self.pair_levels, self.pair_ids, self.js, self.ks = trainpair.Pairs(levels)
+        # (level, PairIndex row) -> dataset row; sql -> query row.  j and k
+        # may be plans of different queries (see encoding.PairQueryEncoding).
+        rows = {}
+        query_rows = {}
+        self.trees, self.indexes, self.query_rows, queries = [], [], [], []
+        local = np.zeros((len(self.js), 2), dtype=np.int32)
+        for i, (level, j, k) in enumerate(zip(self.pair_levels.tolist(), self.js.tolist(), self.ks.tolist())):
+            table = trainpair.tables[level]
+            for side, row in enumerate((j, k)):
+                key = (level, row)
+                if key not in rows:
+                    rows[key] = len(self.trees)
+                    query_encoding, node = table.features[row]
+                    sql = table.keys[row][0]
+                    store_row = None if store is None else store.Row(table.keys[row])
+                    if store_row is None:
+                        tree, index = treeconv.featurize_tree(node, node_featurizer)
+                    else:
+                        tree, index = (np.array(part) for part in store.Tree(store_row))
+                    if sql not in query_rows:
+                        query_rows[sql] = len(queries)
+                        if store_row is None:
+                            queries.append(query_encoding.detach().cpu().numpy().reshape(-1))
+                        else:
+                            queries.append(np.array(store.QueryEncoding(store_row)).reshape(-1))
+                    self.trees.append(tree)
+                    self.indexes.append(index)
+                    self.query_rows.append(query_rows[sql])
+                local[i, side] = rows[key]
+        self.queries = np.stack(queries) if queries else np.zeros((0, 0), dtype=np.float32)
+        self.query_rows = np.array(self.query_rows, dtype=np.int32)
+        self.local = local
+        self.costs, self.labels = pair_loss.PairTargets(*trainpair.Targets(self.pair_levels, self.js, self.ks))
+        self.priorities = trainpair.Weights(self.pair_levels, self.pair_ids)
+
+    def __len__(self):
+        return len(self.pair_levels)
+
+    def Batch(self, indices):
+        """Same as train_Job.pairBatch, for pairs indices of this dataset."""
+        rows = self.local[indices].reshape(-1)
+        # The distinct queries of the 2n plans, j's then k's per pair.
+        query_rows, query_index = np.unique(self.query_rows[rows], return_inverse=True)
+        query_feats = torch.from_numpy(self.queries[query_rows])
+        query_index = torch.from_numpy(query_index.reshape(-1).astype(np.int64))
+        trees, indexes = treeconv.batch_trees([self.trees[row] for row in rows],
+                                              [self.indexes[row] for row in rows])
+        indices = torch.as_tensor(indices)
+        return query_feats, query_index, trees, indexes, self.costs[indices], self.labels[indices]
+
+
+# Per-worker state of TrainInPool(), set by _InitWorker().
+_STATE = {}
+
+
+def _InitWorker(progress_queue, num_threads):
+    torch.set_num_threads(num_threads)
+    _STATE['progress'] = progress_queue
+
+
+def _TrainTask(task):
+    """Trains one group's model in a worker; returns its new states."""
+    name, model_levels, levels, optimizer_cls, optimizer_defaults, optimizer_state, dataset, seed, kwargs = task
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    device = kwargs['device']
+    model = model_levels[levels[0]]
+    module = model.model if isinstance(model, treeconv_dropout.LevelView) else model
+    module.to(device)
+    # defaults may hold entries that are not arguments of optimizer_cls.
+    arguments = inspect.signature(optimizer_cls).parameters
+    optimizer = optimizer_cls(module.parameters(),
+                              **{key: value for key, value in optimizer_defaults.items() if key in arguments})
+    optimizer.load_state_dict(optimizer_state)
+    priorities = dataset.priorities
+
+    def OnValidated(batch, values):
+        priorities[batch] = values
+
+    stats = TrainModel(model_levels, optimizer, dataset.pair_levels, dataset.Batch,
+                       weights=(lambda: priorities) if kwargs.pop('prioritized') else None,
+                       on_validated=OnValidated,
+                       progress=lambda epoch, accuracy: _STATE['progress'].put((name, epoch, accuracy)),
+                       **kwargs)
+    module.cpu()
+    return name, module.state_dict(), _Cpu(optimizer.state_dict()), priorities, stats
+
+
+def _Forward(progress_queue, progress, done):
+    while not done.is_set() or not progress_queue.empty():
+        try:
+            item = progress_queue.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if progress is not None:
+            progress(*item)
+
+
+def TrainInPool(model_levels, optlist, groups, datasets, num_cores, batch_size, device, threads_per_model=None,
+                prioritized=False, progress=None, **kwargs):
+    """Trains the models of several groups of levels concurrently.
+
+    Args:
+      model_levels, optlist: as built by train_Job.getModels().  Updated in
+        place: the models' and optimizers' states are loaded back.
+      groups: [(name, levels)], e.g. train_Job.getTrainGroups().
+      datasets: one PairDataset per group.
+      num_cores: total core budget, split over the workers.
+      threads_per_model: torch threads per worker; by default the budget
+        over the number of groups, at least 1.
+      prioritized: sample train pairs by their priorities.
+      progress: fn(name, epoch, accuracy), called in the parent.
+      kwargs: other TrainModel() arguments.
+
+    Returns:
+      {name: (per-pair priorities after training, TrainModel() statistics)}.
+    """
+    threads = threads_per_model or max(1, num_cores // max(1, len(groups)))
+    num_workers = max(1, min(len(groups), num_cores // threads))
+    tasks = []
+    for (name, levels), dataset in zip(groups, datasets):
+        optimizer = optlist[levels[0]]
+        kwargs_ = dict(kwargs, batch_size=batch_size, device=device, prioritized=prioritized)
+        tasks.append((name, _Group(model_levels, levels), levels, type(optimizer), optimizer.defaults,
+                      _Cpu(optimizer.state_dict()), dataset, np.random.randint(2 ** 31), kwargs_))
+    # Longest first.
+    tasks.sort(key=lambda task: -len(task[6]))
+    ctx = multiprocessing.get_context('spawn')
+    progress_queue = ctx.Queue()
+    done = threading.Event()
+    forwarder = threading.Thread(target=_Forward, args=(progress_queue, progress, done), daemon=True)
+    forwarder.start()
+    results = {}
+    try:
+        with ctx.Pool(num_workers, initializer=_InitWorker, initargs=(progress_queue, threads)) as pool:
+            for name, model_state, optimizer_state, priorities, stats in pool.imap_unordered(_TrainTask, tasks,
+                                                                                             chunksize=1):
+                levels = dict(groups)[name]
+                model = model_levels[levels[0]]
+                (model.model if isinstance(model, treeconv_dropout.LevelView) else model).load_state_dict(model_state)
+                optlist[levels[0]].load_state_dict(optimizer_state)
+                results[name] = (priorities, stats)
+    finally:
+        done.set()
+        forwarder.join()
+    return results
+
+
+def _Group(model_levels, levels):
+    """A CPU copy of model_levels with only the models of levels, to pickle."""
+    group = ['blank'] * len(model_levels)
+    for level in levels:
+        group[level] = model_levels[level]
+    group = copy.deepcopy(group)
+    for model in group:
+        if not isinstance(model, str):
+            (model.model if isinstance(model, treeconv_dropout.LevelView) else model).cpu()
+    return group
+
+
+def _Cpu(state):
+    """state (e.g. an optimizer's state_dict()) with its tensors on the CPU."""
+    if isinstance(state, torch.Tensor):
+        return state.cpu()
+    if isinstance(state, dict):
+        return {key: _Cpu(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(_Cpu(value) for value in state)
+    return state
@@ -0,0 +1,72 @@
+"""Pairwise losses and metrics of the calibration models, in tensor ops.
+
+The trainers used to build, for every batch, the labels of the pairs with a
+Python loop over their latencies and a cost tensor from a Python list.
+PairTargets() computes both once for all the pairs a model trains on; a
+batch then only indexes them, and the losses and metrics below work on the
+[n, 2] costs and [n] labels of its n pairs.
+
+The label of a pair (j, k) is the index of its slower plan: 0 if
+latency_j > latency_k, else 1.  A model's calibration scales the PG costs
+of both plans; the pair's probabilities are the softmax of the calibrated
+costs, so the slower plan should get the larger calibrated cost.
+
+Usage:
+    costs, labels = PairTargets(latencies, costs)  # Once.
+    ...
+    loss = torch.mean(CrossEntropyLoss(calibration, costs[batch],
+                                       labels[batch]), 0)
+    softm = Probabilities(calibration, costs[batch])
+    correct += NumCorrect(softm, labels[batch])
+"""
+import numpy as np
+import torch
+from torch import nn
+
+
+def PairTargets(latencies, costs):
+    """(costs, labels) tensors of n pairs.
+
+    Args:
+      latencies, costs: per pair, j's then k's; [n, 2] or flat [2n].
+
+    Returns:
+      costs: float32 [n, 2]; labels: int64 [n], the index of the slower plan.
+    """
+    latencies = np.asarray(latencies, dtype=np.float64).reshape(-1, 2)
+    costs = torch.from_numpy(np.asarray(costs, dtype=np.float32).reshape(-1, 2))
+    assert len(costs) == len(latencies)
+    labels = torch.from_numpy((latencies[:, 0] <= latencies[:, 1]).astype(np.int64))
+    return costs, labels
+
+
+def Probabilities(calibration, costs):
+    """[n, 2] softmax of the calibrated costs of n pairs."""
+    return nn.functional.softmax(calibration.view(-1, 2) * costs, dim=1)
+
+
+def CrossEntropyLoss(calibration, costs, labels):
+    """Per-pair cross-entropy of the pairs' probabilities and labels.
+
+    As the trainers always did, the cross-entropy is taken on the
+    probabilities (not the calibrated costs).
+    """
+    return nn.functional.cross_entropy(Probabilities(calibration, costs), labels, reduction='none')
+
+
+def MarginRankingLoss(calibration, costs, labels):
+    """Mean margin ranking loss: j's calibrated cost should exceed k's iff
+    j is the slower plan."""
+    calibrated = calibration.view(-1, 2) * costs
+    return nn.functional.margin_ranking_loss(calibrated[:, 0], calibrated[:, 1], 1 - 2 * labels.to(calibrated.dtype))
+
+
+def NumCorrect(probabilities, labels):
+    """Number of pairs whose more probable plan is the slower one, as a
+    0-d tensor on their device."""
+    return torch.sum(torch.argmax(probabilities, dim=1) == labels)
+
+
+def Disagreement(probabilities, labels, floor=1e-3):
+    """Per pair, 1 - the probability of its label, at least floor."""
+    return (1 - probabilities.gather(1, labels.view(-1, 1)).view(-1)).clamp(min=floor)
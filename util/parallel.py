@@ -0,0 +1,227 @@
+"""Plans independent queries in a process pool.
+
+Each iteration, train_Job.py plans every training query with
+UCB_left_prune_replay_fix_kl and getGMRL replans the train/test queries with
+TEST_left_prune_bayes.  The queries only interact through the experience
+pool exp, the PG cost cache and search.trainBuffer, so they can be planned
+in parallel:
+
+  - Every worker receives one snapshot of (models, exp, costCache) for the
+    whole planning phase.  Models are CPU copies and are only read.
+  - A worker plans each query against that same snapshot: experience added
+    while planning one query is handed back and rolled back before the
+    next, so results do not depend on how queries are spread over workers.
+  - The parent merges the returned experience deltas, new cost-cache
+    entries and new DP.dp.level_cache entries in query order.  A (sql, hint) measured for several queries is
+    kept once, the first in query order wins.
+
+Caveat: workers measure latencies concurrently on the same Postgres server,
+which may skew them compared with the serial loop.  Use this for cost-bound
+planning phases, or with a server (pool) that has enough spare cores.
+
+Usage:
+    results = PlanTrainQueries(num_workers, tasks, workload, nodeFeaturizer,
+                               model_levels, exp, costCache, finexp,
+                               FirstTrain=FirstTrain, dpsign=dpsign,
+                               dropbuffer=dropbuffer)
+"""
+import copy
+import multiprocessing
+
+from util import DP, experience, feature_store, search
+
+# Per-worker state, set by _InitWorker().
+_STATE = {}
+
+
+class _RecordingDict(dict):
+    """A dict remembering which keys were added since the last Flush()."""
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self._new_keys = []
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            self._new_keys.append(key)
+        super().__setitem__(key, value)
+
+    def Flush(self):
+        """Returns {key: value} of the keys added since the last call."""
+        delta = {key: self[key] for key in self._new_keys}
+        self._new_keys = []
+        return delta
+
+
+def _CpuModels(model_levels):
+    # One deepcopy for the whole list keeps a shared trunk shared (see
+    # treeconv_dropout.MultiLevelTreeConvolution).
+    models = copy.deepcopy(model_levels)
+    for model in models:
+        if not isinstance(model, str):
+            model.cpu()
+    return models
+
+
+def _InitWorker(state):
+    models = state['models']
+    for model in models:
+        if not isinstance(model, str):
+            model.to(search.DEVICE)
+    state['costCache'] = _RecordingDict(state['costCache'])
+    # The snapshot only grows, and _PlanTrain rolls it back by truncation;
+    # MergeExperience applies the capacity of the parent's exp.
+    state['exp'].capacity = None
+    if state['level_cache'] is not None:
+        DP.dp.level_cache = state['level_cache']
+    if state['feature_store'] is not None:
+        # The parent keeps writing the store; workers only read it.
+        DP.dp.feature_store = feature_store.FeatureStore(state['feature_store'], readonly=True)
+    _STATE.update(state)
+
+
+def _FlushLevelCache():
+    if DP.dp.level_cache is None:
+        return {}
+    return DP.dp.level_cache.Flush()
+
+
+def _PlanTrain(task):
+    """Runs UCB_left_prune_replay_fix_kl on one query of the snapshot."""
+    sqlfile, sql, timeout, greedy = task
+    exp = _STATE['exp']
+    sizes = [len(entries) for entries in exp]
+    join_graph, all_join_conds, query_leaves, dp_tables = DP.getPreCondition(
+        sqlfile)
+    train_buffer, bestplanhint, num, timeout = \
+        DP.dp.UCB_left_prune_replay_fix_kl(
+            join_graph, all_join_conds, query_leaves, dp_tables,
+            _STATE['workload'], exp, _STATE['FirstTrain'], _STATE['models'],
+            timeout,
+            dropbuffer=_STATE['dropbuffer'],
+            nodeFeaturizer=_STATE['nodeFeaturizer'],
+            greedy=greedy,
+            subplans_fin=_STATE['finexp'],
+            finsql=sql,
+            costCache=_STATE['costCache'],
+            dpsign=_STATE['dpsign'],
+            levelList=[{} for _ in range(20)])
+    # Hand back, then roll back, what this query added to the snapshot.
+    exp_delta = [entries[size:] for entries, size in zip(exp, sizes)]
+    for entries, size in zip(exp, sizes):
+        del entries[size:]
+    train_buffer_copy = [list(entries) for entries in train_buffer]
+    train_buffer.clear()
+    return (exp_delta, train_buffer_copy, _STATE['costCache'].Flush(),
+            _FlushLevelCache(), bestplanhint, num, timeout)
+
+
+def _PlanTest(sqlfile):
+    """Runs DP.dp.PlanTest (TEST_left_prune_bayes or TEST_beam) on one query."""
+    join_graph, all_join_conds, query_leaves, dp_tables = DP.getPreCondition(
+        sqlfile)
+    bestplanhint, finnode = DP.dp.PlanTest(
+        join_graph, all_join_conds, query_leaves, dp_tables,
+        _STATE['workload'], _STATE['models'], _STATE['nodeFeaturizer'],
+        _STATE['costCache'])
+    return (bestplanhint, finnode, _STATE['costCache'].Flush(),
+            _FlushLevelCache())
+
+
+def _Map(num_workers, fn, tasks, state):
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(num_workers, initializer=_InitWorker,
+                  initargs=(state,)) as pool:
+        # Ordered results; chunksize 1 balances queries of very different
+        # sizes.
+        return pool.map(fn, tasks, chunksize=1)
+
+
+def _SnapshotLevelCache():
+    cache = DP.dp.level_cache
+    if cache is not None:
+        # Entries already known to the parent are not sent back.
+        cache.Flush()
+    return cache
+
+
+def _FeatureStorePath():
+    store = DP.dp.feature_store
+    return None if store is None else store.path
+
+
+def _MergeLevelCache(delta):
+    if DP.dp.level_cache is not None:
+        DP.dp.level_cache.Update(delta)
+
+
+def MergeExperience(exp, exp_delta):
+    """Appends the entries of exp_delta to exp, skipping known (sql, hint)."""
+    for level, entries in enumerate(exp_delta):
+        if not entries:
+            continue
+        for e in entries:
+            if experience.FindEntry(exp[level], e[1], e[2]) is None:
+                exp[level].append(e)
+
+
+def PlanTrainQueries(num_workers, tasks, workload, nodeFeaturizer,
+                     model_levels, exp, costCache, finexp, FirstTrain, dpsign,
+                     dropbuffer):
+    """Plans queries with UCB_left_prune_replay_fix_kl in parallel.
+
+    Args:
+      num_workers: number of worker processes.
+      tasks: list of (sql file, sql string, timeout, greedy), one per query.
+      model_levels, exp, costCache, finexp: as passed to the serial call.
+        exp and costCache are updated in place, in task order.
+
+    Returns:
+      A list with one (trainBuffer, bestplanhint, num, timeout) per task.
+    """
+    state = {
+        'workload': workload,
+        'nodeFeaturizer': nodeFeaturizer,
+        'models': _CpuModels(model_levels),
+        'exp': exp,
+        'costCache': costCache,
+        'finexp': finexp,
+        'FirstTrain': FirstTrain,
+        'dpsign': dpsign,
+        'dropbuffer': dropbuffer,
+        'level_cache': _SnapshotLevelCache(),
+        'feature_store': _FeatureStorePath(),
+    }
+    results = []
+    for (exp_delta, train_buffer, cost_delta, level_delta, bestplanhint, num,
+         timeout) in _Map(num_workers, _PlanTrain, tasks, state):
+        MergeExperience(exp, exp_delta)
+        costCache.update(cost_delta)
+        _MergeLevelCache(level_delta)
+        results.append((train_buffer, bestplanhint, num, timeout))
+    return results
+
+
+def PlanTestQueries(num_workers, sqlfiles, workload, nodeFeaturizer,
+                    model_levels, costCache):
+    """Plans queries with DP.dp.PlanTest in parallel.
+
+    Returns:
+      A list with one (bestplanhint, final plan Node) per sql file.
+      costCache is updated in place.
+    """
+    state = {
+        'workload': workload,
+        'nodeFeaturizer': nodeFeaturizer,
+        'models': _CpuModels(model_levels),
+        'costCache': costCache,
+        'level_cache': _SnapshotLevelCache(),
+        'feature_store': _FeatureStorePath(),
+    }
+    results = []
+    for bestplanhint, finnode, cost_delta, level_delta in _Map(
+            num_workers, _PlanTest, sqlfiles, state):
+        costCache.update(cost_delta)
+        _MergeLevelCache(level_delta)
+        results.append((bestplanhint, finnode))
+    return results
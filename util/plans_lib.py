@@ -222,11 +222,19 @@ class Node(object):
         return len(self.GetEqualityFilters()) > 0
 
     def ToScanOp(self, scan_op):
-        """Retrieves a deep copy of self with scan_op assigned."""
+        """Retrieves a copy of self with scan_op assigned.
+
+        The copy is shallow: it gets its own info dict and caches but shares
+        the (immutable) info values with self, so that enumerating scan ops
+        does not duplicate e.g. filters or parsed join graphs.
+        """
         assert not self.children, 'This node must be a leaf.'
         copied = self._leaf_scan_op_copies.get(scan_op)
         if copied is None:
-            copied = copy.deepcopy(self)
+            copied = copy.copy(self)
+            copied.info = dict(self.info)
+            copied.children = []
+            copied._leaf_scan_op_copies = {}
             copied.node_type = scan_op
             self._leaf_scan_op_copies[scan_op] = copied
         return copied
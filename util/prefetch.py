@@ -0,0 +1,141 @@
+"""Builds training batches ahead of the step that consumes them.
+
+The pairwise training loop of train_Job.py used to assemble every batch
+synchronously -- gather the pairs, featurize the plans, concatenate the
+query vectors, copy everything to the GPU -- while the model sat idle.
+
+BatchPrefetcher builds the next batches on worker threads while the current
+step runs.  On CUDA, the CPU tensors of a batch are copied into pinned
+buffers that are reused batch after batch, and moved to the device with
+non_blocking copies; a buffer is only refilled once the copy out of it has
+completed.  Threads, not processes: a batch refers to Nodes of the
+experience, which are not worth pickling, and the featurization mostly
+overlaps GPU work that runs without the GIL.
+
+The prefetcher also splits the wall-clock time of the loop into data time
+(waiting for the next batch) and compute time (the consumer's step).  On
+CUDA the device is synchronized at the end of every step, so that the
+kernels the step queued count as its compute time rather than landing in
+whichever later call waits for them.
+
+Usage:
+    loader = BatchPrefetcher(make_batch, batches, device)
+    for indices, (query_feats, trees, ...) in loader:
+        ...  # One step.
+    print(loader.data_seconds, loader.compute_seconds, loader.steps)
+"""
+import concurrent.futures
+import collections
+import time
+
+import torch
+
+
+class _Slot(object):
+    """Reusable pinned buffers for the tensors of one batch in flight."""
+
+    def __init__(self):
+        self.buffers = {}
+        self.copied = None
+
+    def Pin(self, position, tensor):
+        """A pinned copy of tensor in this slot's buffer for position."""
+        buffer = self.buffers.get(position)
+        if buffer is None or buffer.dtype != tensor.dtype or buffer.numel() < tensor.numel():
+            buffer = torch.empty(tensor.numel(), dtype=tensor.dtype).pin_memory()
+            self.buffers[position] = buffer
+        pinned = buffer[:tensor.numel()].view(tensor.shape)
+        pinned.copy_(tensor)
+        return pinned
+
+    def WaitCopied(self):
+        """Blocks until the device copies out of the buffers are done."""
+        if self.copied is not None:
+            self.copied.synchronize()
+            self.copied = None
+
+
+class BatchPrefetcher(object):
+    """Iterates over (batch, make_batch(batch)) for batch in batches.
+
+    Args:
+      make_batch: fn(batch) -> tuple of model inputs; its CPU tensors are
+        moved to device, other values are passed through.  Called on worker
+        threads, concurrently if num_workers > 1.
+      batches: e.g. arrays of pair indices.
+      device: where the tensors go.
+      num_workers: number of threads; 0 builds every batch synchronously.
+      depth: number of batches built ahead.
+    """
+
+    def __init__(self, make_batch, batches, device, num_workers=1, depth=2):
+        self.make_batch = make_batch
+        self.batches = list(batches)
+        self.device = torch.device(device)
+        self.num_workers = num_workers
+        self.depth = max(1, depth)
+        self.data_seconds = 0.0
+        self.compute_seconds = 0.0
+        self.steps = 0
+
+    def __len__(self):
+        return len(self.batches)
+
+    def _Pinned(self):
+        return self.device.type == 'cuda' and torch.cuda.is_available()
+
+    def _Build(self, slot, batch):
+        values = self.make_batch(batch)
+        if slot is None:
+            return values
+        slot.WaitCopied()
+        return tuple(slot.Pin(i, value)
+                     if isinstance(value, torch.Tensor) and value.device.type == 'cpu' else value
+                     for i, value in enumerate(values))
+
+    def _ToDevice(self, slot, values):
+        values = tuple(value.to(self.device, non_blocking=slot is not None)
+                       if isinstance(value, torch.Tensor) else value
+                       for value in values)
+        if slot is not None:
+            slot.copied = torch.cuda.Event()
+            slot.copied.record()
+        return values
+
+    def _Results(self):
+        """Yields (slot, batch, values) in order."""
+        slots = [_Slot() for _ in range(self.depth + 1)] if self._Pinned() else None
+
+        def Slot(i):
+            return None if slots is None else slots[i % len(slots)]
+
+        if self.num_workers == 0:
+            for i, batch in enumerate(self.batches):
+                yield Slot(i), batch, self._Build(Slot(i), batch)
+            return
+        with concurrent.futures.ThreadPoolExecutor(self.num_workers) as pool:
+            futures = collections.deque()
+            for i in range(min(self.depth, len(self.batches))):
+                futures.append(pool.submit(self._Build, Slot(i), self.batches[i]))
+            for i, batch in enumerate(self.batches):
+                # Batch i + depth reuses the slot of batch i - 1, done with.
+                if i + self.depth < len(self.batches):
+                    futures.append(pool.submit(self._Build, Slot(i + self.depth), self.batches[i + self.depth]))
+                yield Slot(i), batch, futures.popleft().result()
+
+    def __iter__(self):
+        results = self._Results()
+        while True:
+            start = time.time()
+            try:
+                slot, batch, values = next(results)
+            except StopIteration:
+                return
+            values = self._ToDevice(slot, values)
+            self.data_seconds += time.time() - start
+            start = time.time()
+            yield batch, values
+            if self._Pinned():
+                torch.cuda.synchronize(self.device)
+            self.compute_seconds += time.time() - start
+            self.steps += 1
@@ -0,0 +1,263 @@
+"""Relation sets as integer bitmasks over a query's aliases."""
+import collections
+import itertools
+import time
+
+
+def PopCount(mask):
+    """Number of relations in mask."""
+    return bin(mask).count('1')
+
+
+def _Subsets(mask):
+    """Yields the non-empty subsets of mask."""
+    sub = mask
+    while sub:
+        yield sub
+        sub = (sub - 1) & mask
+
+
+class RelationSets(object):
+    """Maps the relations (aliases) of one query to bits.
+
+    The DP keys dp_tables[level] by the bitmask of the relations a subplan
+    joins, so that overlap and union of two sides are a single '&' / '|'.
+    The comma-joined alias string ("join_ids") used by experience and train
+    pairs is only produced at that boundary, via ToIds().
+
+    Aliases are numbered in sorted order: ToIds() thus matches the former
+    ','.join(sorted(aliases)) keys, and instances built from the same leaves
+    agree on every mask.
+
+    Given the query's join graph, the neighbour bitmask of every alias is
+    precomputed, so "is there a join edge between sets S and T" is a single
+    AND (Connected()) instead of plans_lib.ExistsJoinEdgeInGraph()'s walk
+    over all alias pairs.
+
+    Usage:
+        rel_sets = RelationSets(query_leaves, join_graph)
+        for leaf in query_leaves:
+            dp_tables[1][rel_sets.Bit(leaf.table_alias)] = (0, leaf)
+        ...
+        if not rel_sets.Connected(l_ids, r_ids):  # No join clause.
+            continue
+        if l_ids & r_ids:  # A relation exists in both sides.
+            continue
+        join_ids = rel_sets.ToIds(l_ids | r_ids)
+    """
+
+    def __init__(self, query_leaves, join_graph=None):
+        self.aliases = sorted(leaf.table_alias for leaf in query_leaves)
+        self._bits = {alias: 1 << i for i, alias in enumerate(self.aliases)}
+        # mask -> join_ids string.
+        self._ids = {}
+        # Per-alias neighbour masks, indexed by bit position; and
+        # mask -> union of its members' neighbour masks.
+        self._alias_neighbours = [0] * len(self.aliases)
+        self._neighbours = {0: 0}
+        # CsgCmpPairsByLevel(), once computed.
+        self._pairs = None
+        if join_graph is not None:
+            for i, alias in enumerate(self.aliases):
+                if alias not in join_graph:
+                    continue
+                for other in join_graph.neighbors(alias):
+                    if other != alias and other in self._bits:
+                        self._alias_neighbours[i] |= self._bits[other]
+
+    def __len__(self):
+        return len(self.aliases)
+
+    def All(self):
+        """The mask of all relations of the query."""
+        return (1 << len(self.aliases)) - 1
+
+    def Bit(self, alias):
+        return self._bits[alias]
+
+    def FromIds(self, join_ids):
+        """'a,b,c' -> mask."""
+        mask = 0
+        for alias in join_ids.split(','):
+            mask |= self._bits[alias]
+        return mask
+
+    def Neighbours(self, mask):
+        """Relations joined by an edge to some relation of mask.
+
+        May overlap mask itself; use Neighbours(S) & ~S for the relations
+        that can extend S into a larger connected set.
+        """
+        neighbours = self._neighbours.get(mask)
+        if neighbours is None:
+            # Split off the lowest bit; the rest is (typically) memoized.
+            low = mask & -mask
+            neighbours = (self._alias_neighbours[low.bit_length() - 1] |
+                          self.Neighbours(mask ^ low))
+            self._neighbours[mask] = neighbours
+        return neighbours
+
+    def Connected(self, mask1, mask2):
+        """Is there a join edge between the two relation sets?"""
+        return (self.Neighbours(mask1) & mask2) != 0
+
+    def _EnumerateCsgRec(self, S, X):
+        neighbours = self.Neighbours(S) & ~X
+        if not neighbours:
+            return
+        for sub in _Subsets(neighbours):
+            yield S | sub
+        for sub in _Subsets(neighbours):
+            yield from self._EnumerateCsgRec(S | sub, X | neighbours)
+
+    def EnumerateCsg(self):
+        """Yields every connected subset of the join graph once."""
+        for i in reversed(range(len(self.aliases))):
+            v = 1 << i
+            yield v
+            yield from self._EnumerateCsgRec(v, (v << 1) - 1)
+
+    def _EnumerateCmp(self, S):
+        low = S & -S
+        X = S | (low - 1)
+        neighbours = self.Neighbours(S) & ~X
+        for i in reversed(range(len(self.aliases))):
+            v = 1 << i
+            if not neighbours & v:
+                continue
+            yield v
+            yield from self._EnumerateCsgRec(v, X | (neighbours & ((v << 1) - 1)))
+
+    def EnumerateCsgCmpPairs(self):
+        """Yields each csg-cmp pair (S1, S2) once, DPccp-style.
+
+        S1 and S2 are connected, disjoint and joined by at least one edge;
+        i.e., exactly the pairs the DP loops used to find by testing every
+        (dp_table_i, dp_table_j) combination.  The orientation is arbitrary:
+        S2 is never the mirror image of an emitted S1 (cf. Moerkotte &
+        Neumann, "Analysis of Two Existing and One New Dynamic Programming
+        Algorithm for the Generation of Optimal Bushy Join Trees without Cross
+        Products", VLDB 2006).
+        """
+        for S1 in self.EnumerateCsg():
+            for S2 in self._EnumerateCmp(S1):
+                yield S1, S2
+
+    def CsgCmpPairsByLevel(self):
+        """Returns {level: [(l_ids, r_ids)]}, both orientations of each pair.
+
+        level is the number of relations joined, |l_ids| + |r_ids|.
+        Memoized; the lists must not be modified.
+        """
+        if self._pairs is None:
+            self._pairs = collections.defaultdict(list)
+            for S1, S2 in self.EnumerateCsgCmpPairs():
+                level = PopCount(S1 | S2)
+                self._pairs[level].append((S1, S2))
+                self._pairs[level].append((S2, S1))
+        return self._pairs
+
+    def ToIds(self, mask):
+        """mask -> 'a,b,c' (sorted aliases)."""
+        ids = self._ids.get(mask)
+        if ids is None:
+            ids = ','.join(alias for i, alias in enumerate(self.aliases)
+                           if mask >> i & 1)
+            self._ids[mask] = ids
+        return ids
+
+
+class _Graph(object):
+    """Minimal join graph (alias -> set of aliases) for Benchmark()."""
+
+    def __init__(self, edges):
+        self.adj = collections.defaultdict(set)
+        for a, b in edges:
+            self.adj[a].add(b)
+            self.adj[b].add(a)
+
+    def __contains__(self, alias):
+        return alias in self.adj
+
+    def neighbors(self, alias):
+        return self.adj[alias]
+
+
+_Leaf = collections.namedtuple('_Leaf', ['table_alias'])
+
+
+def _MakeQuery(shape, num_rels):
+    aliases = ['t{:02d}'.format(i) for i in range(num_rels)]
+    if shape == 'chain':
+        edges = zip(aliases, aliases[1:])
+    elif shape == 'star':
+        edges = [(aliases[0], a) for a in aliases[1:]]
+    else:
+        assert shape == 'clique', shape
+        edges = itertools.combinations(aliases, 2)
+    return [_Leaf(a) for a in aliases], _Graph(edges)
+
+
+def _NaivePairs(rel_sets, max_checks):
+    """The former (dp_table_i x dp_table_j) loop; returns #pairs tested.
+
+    Stops (returning None) once more than max_checks pairs were tested.
+    """
+    num_rels = len(rel_sets)
+    dp_tables = collections.defaultdict(set)
+    for alias in rel_sets.aliases:
+        dp_tables[1].add(rel_sets.Bit(alias))
+    checks = 0
+    for level in range(2, num_rels + 1):
+        for level_i in range(1, level):
+            for l_ids in dp_tables[level_i]:
+                for r_ids in dp_tables[level - level_i]:
+                    checks += 1
+                    if not rel_sets.Connected(l_ids, r_ids):
+                        continue
+                    if l_ids & r_ids:
+                        continue
+                    dp_tables[level].add(l_ids | r_ids)
+            if checks > max_checks:
+                return None
+    return checks
+
+
+def Benchmark(shapes=('chain', 'star', 'clique'),
+              num_rels=(5, 8, 10, 12, 15, 17, 20),
+              max_pairs=2 * 10**6):
+    """Pair enumeration: DPccp vs. the former nested table loops.
+
+    Counts are for pair generation only (no costing).  Runs whose pair count
+    exceeds max_pairs are skipped ('-'); this covers large stars and cliques,
+    whose number of csg-cmp pairs grows as ~n*2^n resp. ~3^n.
+    """
+    print('{:>7} {:>4} {:>12} {:>11} {:>14} {:>11} {:>8}'.format(
+        'graph', 'n', 'ccp pairs', 'dpccp ms', 'naive tested', 'naive ms',
+        'speedup'))
+    for shape in shapes:
+        for n in num_rels:
+            leaves, graph = _MakeQuery(shape, n)
+            rel_sets = RelationSets(leaves, graph)
+            start = time.time()
+            pairs = sum(1 for _ in itertools.islice(
+                rel_sets.EnumerateCsgCmpPairs(), max_pairs + 1))
+            dpccp_ms = (time.time() - start) * 1e3
+            if pairs > max_pairs:
+                print('{:>7} {:>4} {:>12}'.format(shape, n, '-'))
+                continue
+            rel_sets = RelationSets(leaves, graph)
+            start = time.time()
+            checks = _NaivePairs(rel_sets, 20 * max_pairs)
+            naive_ms = (time.time() - start) * 1e3
+            if checks is None:
+                print('{:>7} {:>4} {:>12} {:>11.1f} {:>14}'.format(
+                    shape, n, pairs, dpccp_ms, '-'))
+                continue
+            print('{:>7} {:>4} {:>12} {:>11.1f} {:>14} {:>11.1f} {:>7.1f}x'.
+                  format(shape, n, pairs, dpccp_ms, checks, naive_ms,
+                         naive_ms / max(dpccp_ms, 1e-3)))
+
+
+if __name__ == '__main__':
+    Benchmark()
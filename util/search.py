@@ -5,16 +5,19 @@ import math
 import random
 import time
 
-import numpy as np
 import torch
 from sklearn.cluster import KMeans
 
 import encoding
 import util.plans_lib as plans_lib
-from encoding import TreeConvFeaturize
+from encoding import ShareQueryEncoding, TreeConvFeaturize
+from util import calibration
 from util import costing
+from util import experience
 from util import hyperparams
+from util import level_cache
 from util import postgres, envs
+from util import relsets
 
 # Nest Loop lhs/rhs whitelist. Empirically determined from Postgres plans.  A
 # more general solution is to delve into PG source code.
@@ -47,11 +50,7 @@ def collectSubplans(root, subplans_fin, workload, exp):
                                      with_select_exprs=True)
 
         temhint = currentChild.hint_str()
-        found = False
-        for i in subplans_fin[temlevel]:
-            if (i[1] == temsql and i[2] == temhint):
-                found = True
-                break
+        found = experience.FindEntry(subplans_fin[temlevel], temsql, temhint) is not None
         if not found:
             tem = []
             tem.append(math.log(currentChild.info["cost"]))
@@ -60,23 +59,21 @@ def collectSubplans(root, subplans_fin, workload, exp):
             nodelatency = currentChild.info.get("latency")
 
             if nodelatency == None:
-                for i in exp[currentChild.info.get("currentLevel")]:
-                    if (i[1] == temsql and i[2] == temhint):
-                        nodelatency = i[3]
-
-                        break
+                i = experience.FindEntry(exp[currentChild.info.get("currentLevel")], temsql, temhint)
+                if i is not None:
+                    nodelatency = i[3]
 
             if nodelatency == None:
                 nodelatency = postgres.GetLatencyFromPg(temsql, temhint, verbose=False, check_hint_used=False,
                                                         timeout=10000, dropbuffer=False)
                 tem.append(nodelatency)
                 tem.append(encoding.getencoding_Balsa(temsql, temhint, workload))
-                subplans_fin[temlevel].append(copy.deepcopy(tem))
-                exp[temlevel].append(copy.deepcopy(tem))
+                subplans_fin[temlevel].append(tem)
+                exp[temlevel].append(tem)
             else:
                 tem.append(nodelatency)
                 tem.append(encoding.getencoding_Balsa(temsql, temhint, workload))
-                subplans_fin[temlevel].append(copy.deepcopy(tem))
+                subplans_fin[temlevel].append(tem)
     while (allPlans):
         currentNode = allPlans.pop()
         allPlans.extend(currentNode.children)
@@ -89,11 +86,7 @@ def collectSubplans(root, subplans_fin, workload, exp):
                                              with_select_exprs=True)
                 #    print(temsql)
                 temhint = currentChild.hint_str()
-                found = False
-                for i in subplans_fin[temlevel]:
-                    if (i[1] == temsql and i[2] == temhint):
-                        found = True
-                        break
+                found = experience.FindEntry(subplans_fin[temlevel], temsql, temhint) is not None
                 if not found:
                     tem = []
                     tem.append(math.log(currentChild.info["cost"]))
@@ -102,22 +95,21 @@ def collectSubplans(root, subplans_fin, workload, exp):
                     nodelatency = currentChild.info.get("latency")
 
                     if nodelatency == None:
-                        for i in exp[currentChild.info.get("currentLevel")]:
-                            if (i[1] == temsql and i[2] == temhint):
-                                nodelatency = i[3]
-                                break
+                        i = experience.FindEntry(exp[currentChild.info.get("currentLevel")], temsql, temhint)
+                        if i is not None:
+                            nodelatency = i[3]
 
                     if nodelatency == None:
                         nodelatency = postgres.GetLatencyFromPg(temsql, temhint, verbose=False, check_hint_used=False,
                                                                 timeout=30000, dropbuffer=False)
                         tem.append(nodelatency)
                         tem.append(encoding.getencoding_Balsa(temsql, temhint, workload))
-                        subplans_fin[temlevel].append(copy.deepcopy(tem))
-                        exp[temlevel].append(copy.deepcopy(tem))
+                        subplans_fin[temlevel].append(tem)
+                        exp[temlevel].append(tem)
                     else:
                         tem.append(nodelatency)
                         tem.append(encoding.getencoding_Balsa(temsql, temhint, workload))
-                        subplans_fin[temlevel].append(copy.deepcopy(tem))
+                        subplans_fin[temlevel].append(tem)
 
 
 def slackTimeout(exp):
@@ -130,6 +122,67 @@ def slackTimeout(exp):
     return True
 
 
+def _NumMcSamples(model):
+    """MC-dropout passes per scoring call; compiled engines need only one."""
+    return getattr(model, 'mc_samples', 10)
+
+
+def _Featurize(store, nodeFeaturizer, keys, nodes):
+    """TreeConvFeaturize, reading the experience's plans from a
+    feature_store.FeatureStore if set; candidates are not stored.
+
+    keys: the (sql, hint) of each node.
+    """
+    if store is None:
+        return TreeConvFeaturize(nodeFeaturizer, nodes)
+    return store.Featurize(nodeFeaturizer, keys, nodes)
+
+
+def _McCalibrations(model, query_encodings, nodes, nodeFeaturizer, num_samples,
+                    share_query, store=None, keys=None, deadline=None):
+    """Returns [len(nodes), num_samples] samples of tanh(model) + 1.
+
+    share_query: all candidates share join_ids (hence the query vector); see
+      encoding.ShareQueryEncoding.
+    store, keys: see _Featurize.
+    deadline: optional time.time() value; checked before every sample, raises
+      _DeadlineExceeded once it has passed.
+    """
+    if share_query:
+        query_feats, query_index = ShareQueryEncoding(query_encodings, DEVICE)
+    else:
+        query_feats = (torch.cat(query_encodings, dim=0)).to(DEVICE)
+        query_index = None
+    trees, indexes = _Featurize(store, nodeFeaturizer, keys, nodes)
+    if torch.cuda.is_available():
+        trees = trees.to(DEVICE)
+        indexes = indexes.to(DEVICE)
+    samples = []
+    for i in range(num_samples):
+        _CheckDeadline(deadline)
+        with torch.no_grad():
+            samples.append(
+                torch.tanh(model(query_feats, trees, indexes, query_index).to(DEVICE)).add(1))
+    return torch.cat(samples, 1)
+
+
+class _DeadlineExceeded(Exception):
+    """A DP pass ran out of planning time while building dp_tables[level].
+
+    level is None when raised outside _RunDP(), which then sets it.
+    """
+
+    def __init__(self, level=None):
+        super().__init__(level)
+        self.level = level
+
+
+def _CheckDeadline(deadline, level=None):
+    """Raises _DeadlineExceeded if deadline (a time.time() value) has passed."""
+    if deadline is not None and time.time() > deadline:
+        raise _DeadlineExceeded(level)
+
+
 def random_dic(dicts):
     dict_key_ls = list(dicts.keys())
     random.shuffle(dict_key_ls)
@@ -261,6 +314,610 @@ def EnumerateJoinWithOps(left,
                 yield join
 
 
+# --------------------------------------------------------------------------
+# Left-deep DP engine.
+#
+# The learned planners (UCB_left_prune*, KM_left_prune, TEST_*, ...) all run
+# the same bottom-up loop: for each level, join every dp_tables[level - 1]
+# entry with every connected base relation, cost all physical variants,
+# score them, maybe measure some latencies, keep the best per join set and
+# prune the level.  DynamicProgramming._RunDP() is that loop; a DPStages
+# object supplies the parts that differ between planners:
+#
+#   pairs:    enumerates the (left, right) sides joined at a level.
+#   costing:  turns one pair into Candidates (PG cost, sql, hint, encoding).
+#   scoring:  sets Candidates.scores, the DP cost of each candidate, and
+#             optionally Candidates.priorities for exploration.
+#   explore:  measures latencies of high-priority candidates (UCB, KMeans).
+#   collect:  measures the latency of candidates that improve dp_table.
+#   prune:    shrinks dp_tables[level] once the level is complete.
+#   on_pair:  extra callbacks fn(query, candidates), e.g. for logging.
+#
+# Scoring, collection and pruning stages also tell, via ModelFree(query,
+# level), whether a level's outcome is independent of the model and of exp.
+# The low levels for which all of them agree are reused across passes when
+# DPStages.reuse names the configuration (see util/level_cache.py).
+#
+# The planners are thin configurations of these stages, so a speed-up of a
+# stage (or of _RunDP) reaches training, evaluation and testing alike.
+# --------------------------------------------------------------------------
+
+
+class Candidates(object):
+    """The costed physical joins of one (left, right) pair."""
+
+    def __init__(self, level, join_set, join_ids):
+        self.level = level
+        self.join_set = join_set
+        self.join_ids = join_ids
+        self.joins = []
+        self.costs = []  # log(PG cost).
+        self.sqls = []
+        self.hints = []
+        self.query_encodings = []
+        self.nodes = []
+        # Set by the scoring stage.
+        self.scores = None
+        self.priorities = None
+
+    def __len__(self):
+        return len(self.joins)
+
+    def Add(self, join, cost, sql, hint, query_encoding, node):
+        self.joins.append(join)
+        self.costs.append(cost)
+        self.sqls.append(sql)
+        self.hints.append(hint)
+        self.query_encodings.append(query_encoding)
+        self.nodes.append(node)
+
+    def Entry(self, i, latency=0):
+        """The exp / trainBuffer entry of candidate i.
+
+        [logcost, sql, hint, latency, [query_encoding, node], join, join_ids]
+        """
+        return [self.costs[i], self.sqls[i], self.hints[i], latency,
+                [self.query_encodings[i], self.nodes[i]], self.joins[i],
+                self.join_ids]
+
+
+# Work done at one DP level: (left, right) pairs costed, candidates scored,
+# and the wall-clock seconds it took.
+LevelStats = collections.namedtuple('LevelStats', ['pairs', 'candidates', 'seconds'])
+
+
+class DPQuery(object):
+    """Per-query state of one DynamicProgramming._RunDP() call.
+
+    exp, timeout and dropbuffer are only needed by stages measuring
+    latencies; model and nodeFeaturizer only by model-based stages.
+    costCache=None costs every candidate with PG (no caching).
+    """
+
+    def __init__(self, dp, join_graph, all_join_conds, query_leaves, dp_tables, workload, model=None,
+                 nodeFeaturizer=None, costCache=None, exp=None, FirstTrain=False, dpsign=False,
+                 timeout=None, dropbuffer=False, deadline=None):
+        self.dp = dp
+        self.join_graph = join_graph
+        self.all_join_conds = all_join_conds
+        self.query_leaves = query_leaves
+        self.dp_tables = dp_tables
+        self.workload = workload
+        self.model = model
+        self.nodeFeaturizer = nodeFeaturizer
+        self.costCache = costCache
+        self.exp = exp
+        self.FirstTrain = FirstTrain
+        self.dpsign = dpsign
+        self.timeout = timeout
+        self.dropbuffer = dropbuffer
+        # time.time() after which _RunDP() raises _DeadlineExceeded, and the
+        # level it is building.
+        self.deadline = deadline
+        self.level = None
+        self.num_rels = len(query_leaves)
+        self.rel_sets = relsets.RelationSets(query_leaves, join_graph)
+        # Number of plans executed by exploration (and counting collection).
+        self.num = 0
+        # Latest latency measured during the run.
+        self.last_latency = 0
+        # level -> LevelStats of the levels computed (not restored) so far.
+        self.level_stats = {}
+
+    def FindLatency(self, level, sql, hint):
+        """Latency of (sql, hint) recorded in exp[level], or None."""
+        entry = experience.FindEntry(self.exp[level], sql, hint)
+        return None if entry is None else entry[3]
+
+    def Measure(self, level, sql, hint, slack):
+        """Executes (sql, hint); slack raises the timeout to 12s."""
+        latency = postgres.GetLatencyFromPg(sql, hint, verbose=False, check_hint_used=False,
+                                            timeout=12000 if slack else self.timeout,
+                                            dropbuffer=self.dropbuffer)
+        self.last_latency = latency
+        return latency
+
+    def Record(self, candidates, i, latency):
+        """Adds candidate i with its latency to exp and trainBuffer."""
+        entry = candidates.Entry(i, latency)
+        candidates.nodes[i].info["latency"] = latency
+        candidates.nodes[i].info["join_ids"] = candidates.join_ids
+        candidates.joins[i].info["latency"] = latency
+        trainBuffer[candidates.level].append(entry)
+        self.exp[candidates.level].append(entry)
+
+    def IsSlack(self, level, last_level_only):
+        if last_level_only and level <= self.num_rels - 1:
+            return False
+        return slackTimeout(self.exp[level])
+
+
+class LeftDeepPairs(object):
+    """(dp_tables[level - 1] entry, base relation) pairs with a join edge.
+
+    shuffle: visit both tables in random order (random_dic), as the learned
+      planners always did; ties in cost then break randomly.
+
+    Unlike the bushy DPs, this does not walk RelationSets.CsgCmpPairsByLevel():
+    pruned or beam tables keep a few entries per level, and enumerating every
+    connected subset of a 17-relation JOB query up front costs more than the
+    whole greedy pass.
+    """
+
+    def __init__(self, shuffle=True):
+        self.shuffle = shuffle
+
+    def Pairs(self, query, level):
+        dp_table_i = query.dp_tables[level - 1]
+        dp_table_j = query.dp_tables[1]
+        if self.shuffle:
+            dp_table_i = random_dic(dp_table_i)
+            dp_table_j = random_dic(dp_table_j)
+        for l_ids, l_tup in dp_table_i.items():
+            for r_ids, r_tup in dp_table_j.items():
+                if not query.rel_sets.Connected(l_ids, r_ids):
+                    # No join clause linking two sides.  Skip.
+                    continue
+                if l_ids & r_ids:
+                    # A relation exists in both sides.  Skip.
+                    continue
+                yield l_ids, l_tup[1], r_ids, r_tup[1]
+
+
+class PgCosting(object):
+    """Costs every physical join of a pair with PG and encodes it."""
+
+    def Cost(self, query, level, l, r, join_set):
+        dp = query.dp
+        candidates = Candidates(level, join_set, query.rel_sets.ToIds(join_set))
+        for join in EnumerateJoinWithOps(
+                l,
+                r,
+                dp.join_ops,
+                dp.scan_ops,
+                use_plan_restrictions=dp.use_plan_restrictions
+        ):
+            join_conds = join.KeepRelevantJoins(query.all_join_conds)
+            if query.costCache is None:
+                cost, sql, hint = dp.cost_model(join, join_conds)
+            else:
+                cost, sql, hint = dp.cost_model.getCost_cache(join, join_conds, query.costCache)
+            data = encoding.getencoding_Balsa(sql, hint, query.workload)
+            join.info["currentLevel"] = level
+            join.info["join_conds"] = join_conds
+            join.info["join_ids"] = candidates.join_ids
+            join.info["cost"] = cost
+            join.info["fingerprint"] = (sql, hint)
+            join.info["encoding"] = data[0]
+            join.info["node"] = data[1]
+            candidates.Add(join, math.log(cost), sql, hint, data[0], data[1])
+        return candidates
+
+
+class UnitCosting(object):
+    """Cost 1 for every join, no PG calls: measures enumeration alone."""
+
+    def __init__(self):
+        self.plans_num = 0
+        # Plans at the top two levels.
+        self.top_plans_num = 0
+
+    def Cost(self, query, level, l, r, join_set):
+        dp = query.dp
+        candidates = Candidates(level, join_set, query.rel_sets.ToIds(join_set))
+        for join in EnumerateJoinWithOps(
+                l,
+                r,
+                dp.join_ops,
+                dp.scan_ops,
+                use_plan_restrictions=dp.use_plan_restrictions
+        ):
+            self.plans_num += 1
+            if level > query.num_rels - 3:
+                self.top_plans_num += 1
+            candidates.Add(join, 1, None, None, None, None)
+        return candidates
+
+
+class CostScoring(object):
+    """DP cost = log PG cost."""
+
+    def ModelFree(self, query, level):
+        return True
+
+    def Score(self, query, candidates):
+        candidates.scores = candidates.costs
+
+
+def _IsTopLevel(query, level, top_levels):
+    """Is level among the top_levels highest ones (all, if None)?"""
+    return top_levels is None or level > query.num_rels - top_levels - 1
+
+
+class CalibratedScoring(object):
+    """DP cost = mean(tanh(model[level]) + 1) * log PG cost.
+
+    The model is only used once FirstTrain is over and, if top_levels is set,
+    at the top top_levels levels (level > num_rels - top_levels - 1);
+    elsewhere the log PG cost is kept.
+
+    priority: exploration priority of each candidate (higher first):
+      None: none.
+      'var': the MC-dropout variance.
+      'ucb': var / max(var) - min / max(min), with min the smallest
+        calibration sample of a candidate.  Needs the samples, so it bypasses
+        the calibration cache.
+      'enumeration': enumeration order.
+    num_samples: MC-dropout passes; None asks the model (_NumMcSamples).
+    train_mode: put model[level] in train mode (dropout on) first.
+    """
+
+    def __init__(self, top_levels=None, num_samples=None, train_mode=False, priority=None):
+        self.top_levels = top_levels
+        self.num_samples = num_samples
+        self.train_mode = train_mode
+        self.priority = priority
+
+    def ModelFree(self, query, level):
+        """Whether level is scored with the log PG cost only."""
+        return query.FirstTrain or not _IsTopLevel(query, level, self.top_levels)
+
+    def Score(self, query, candidates):
+        level = candidates.level
+        if self.ModelFree(query, level):
+            candidates.scores = candidates.costs
+            return
+        model = query.model[min(level, len(query.model) - 1)]
+        if self.train_mode:
+            model.train()
+        num_samples = self.num_samples or _NumMcSamples(query.model)
+        if self.priority == 'ucb':
+            samples = _McCalibrations(model, candidates.query_encodings, candidates.nodes,
+                                      query.nodeFeaturizer, num_samples, share_query=True,
+                                      store=query.dp.feature_store,
+                                      keys=list(zip(candidates.sqls, candidates.hints)),
+                                      deadline=query.deadline)
+            mean = torch.mean(samples, dim=1)
+            var = torch.var(samples, dim=1)
+            cost_min, _ = torch.min(samples, dim=1)
+            candidates.priorities = (var / var.max() - cost_min / cost_min.max()).tolist()
+        else:
+            mean, var = query.dp._Calibrate(model, candidates.joins, candidates.query_encodings,
+                                            candidates.nodes, query.nodeFeaturizer, num_samples,
+                                            share_query=True, deadline=query.deadline)
+            if self.priority == 'var':
+                candidates.priorities = var.tolist()
+            elif self.priority == 'enumeration':
+                candidates.priorities = [0.0] * len(candidates)
+        candidates.scores = torch.mul(mean, torch.tensor(candidates.costs, device=DEVICE)).tolist()
+
+
+class UcbExploration(object):
+    """Executes the highest-priority candidates that are not in exp yet.
+
+    Runs after FirstTrain, unless the query is planned in DP mode (dpsign),
+    on the candidates the scoring stage gave priorities to: per pair, or over
+    the whole level (per_level).  Of those, the top ceil(fraction * n) are
+    executed (low_level_fraction applies below level 4).
+
+    slack_last_level_only: only allow the slack timeout at the top level.
+    """
+
+    def __init__(self, fraction=0.1, low_level_fraction=None, per_level=False, slack_last_level_only=True):
+        self.fraction = fraction
+        self.low_level_fraction = low_level_fraction
+        self.per_level = per_level
+        self.slack_last_level_only = slack_last_level_only
+
+    def _Fraction(self, level):
+        if level < 4 and self.low_level_fraction is not None:
+            return self.low_level_fraction
+        return self.fraction
+
+    def OnPair(self, query, candidates):
+        if self.per_level or query.dpsign or candidates.priorities is None:
+            return
+        self.Explore(query, candidates.level, [(candidates, i) for i in range(len(candidates))],
+                     candidates.priorities)
+
+    def OnLevel(self, query, level, level_candidates):
+        if not self.per_level or query.dpsign:
+            return
+        items = []
+        priorities = []
+        for candidates in level_candidates:
+            if candidates.priorities is not None:
+                items.extend((candidates, i) for i in range(len(candidates)))
+                priorities.extend(candidates.priorities)
+        if items:
+            self.Explore(query, level, items, priorities)
+
+    def Select(self, query, level, items, priorities):
+        """Returns the indices into items to execute."""
+        order = sorted(range(len(items)), key=lambda i: -priorities[i])
+        return order[:math.ceil(self._Fraction(level) * len(items))]
+
+    def Explore(self, query, level, items, priorities):
+        for k in self.Select(query, level, items, priorities):
+            candidates, i = items[k]
+            if query.FindLatency(level, candidates.sqls[i], candidates.hints[i]) is not None:
+                continue
+            query.num += 1
+            latency = query.Measure(level, candidates.sqls[i], candidates.hints[i],
+                                    query.IsSlack(level, self.slack_last_level_only))
+            query.Record(candidates, i, latency)
+
+
+class KMeansExploration(UcbExploration):
+    """UcbExploration over KMeans clusters of the level's candidates.
+
+    The level's candidates are clustered on their (query, plan) features;
+    in every cluster the top ceil(fraction * size) are executed.
+    """
+
+    def __init__(self, n_clusters=10, fraction=0.15, low_level_fraction=0.4):
+        super().__init__(fraction, low_level_fraction, per_level=True)
+        self.n_clusters = n_clusters
+
+    def Select(self, query, level, items, priorities):
+        query_encodings = [c.query_encodings[i] for c, i in items]
+        query_feats = torch.cat(query_encodings, dim=0).to(DEVICE)
+        trees, indexes = _Featurize(query.dp.feature_store, query.nodeFeaturizer,
+                                    [(c.sqls[i], c.hints[i]) for c, i in items],
+                                    [c.nodes[i] for c, i in items])
+        trees = trees.to(query_feats.device).reshape((trees.shape[0], -1))
+        indexes = indexes.to(query_feats.device).reshape((indexes.shape[0], -1))
+        pool_encodings = torch.cat([query_feats, trees, indexes], dim=1).cpu().numpy()
+        n_clusters = min(self.n_clusters, len(pool_encodings))
+        labels = list(KMeans(n_clusters=n_clusters, random_state=123).fit(pool_encodings).labels_)
+        selected = []
+        for cluster in range(n_clusters):
+            idxs = [idx for idx, label in enumerate(labels) if label == cluster]
+            idxs.sort(key=lambda idx: -priorities[idx])
+            selected.extend(idxs[:math.ceil(self._Fraction(level) * len(idxs))])
+        return selected
+
+
+class LatencyCollection(object):
+    """Executes every candidate that improves its dp_table entry.
+
+    when: 'first_train' (FirstTrain only), 'first_train_or_dp' (FirstTrain or
+      dpsign) or 'always'.
+    top_levels: if set, only at the top top_levels levels.
+    skip_prob: if set, a plan not in exp is skipped with this probability
+      (unless under slack).
+    slack: where the slack timeout is allowed: 'any' level, the 'last'
+      level, or None.
+    count: count executed plans in DPQuery.num.
+    """
+
+    def __init__(self, when='first_train', top_levels=None, skip_prob=None, slack='last', count=False):
+        self.when = when
+        self.top_levels = top_levels
+        self.skip_prob = skip_prob
+        self.slack = slack
+        self.count = count
+
+    def _Active(self, query, level):
+        if not _IsTopLevel(query, level, self.top_levels):
+            return False
+        if self.when == 'first_train':
+            return query.FirstTrain
+        if self.when == 'first_train_or_dp':
+            return query.FirstTrain or query.dpsign
+        return True
+
+    def ModelFree(self, query, level):
+        """Whether nothing is measured (nor read from exp) at level."""
+        return not self._Active(query, level)
+
+    def OnImprove(self, query, candidates, i):
+        level = candidates.level
+        if not self._Active(query, level):
+            return
+        latency = query.FindLatency(level, candidates.sqls[i], candidates.hints[i])
+        if latency is not None:
+            candidates.nodes[i].info["latency"] = latency
+            return
+        slack = self.slack is not None and query.IsSlack(level, self.slack == 'last')
+        if slack:
+            print('slack')
+        elif self.skip_prob is not None and not random.random() > self.skip_prob:
+            return
+        if self.count:
+            query.num += 1
+        latency = query.Measure(level, candidates.sqls[i], candidates.hints[i], slack)
+        query.Record(candidates, i, latency)
+
+
+class LevelPruning(object):
+    """Keeps the best ceil(keep * n) join sets of a middle level.
+
+    Prunes levels with min_level < level < max_level, and, unless top_offset
+    is None, level < num_rels - top_offset.  Join sets are ranked by their DP
+    cost, rescored by rescore:
+      None: as is.
+      'calibrated': times mean(tanh(model[-1]) + 1) over num_samples passes.
+      'raw': times model[num_rels] + 1, one pass in eval mode.
+    Rescoring is skipped during FirstTrain unless rescore_first_train.
+
+    With target_candidates and/or level_budget, the number kept is instead
+    driven by the work it causes at the next level: the best join sets are
+    kept until the candidates they will produce reach target_candidates, or
+    until those candidates would take level_budget seconds to plan.  A join
+    set S produces about |neighbours(S) - S| * (candidates per pair) of them,
+    both measured at this level (DPQuery.level_stats).
+    """
+
+    def __init__(self, min_level, max_level, top_offset=0, keep=0.3, rescore='calibrated', num_samples=None,
+                 rescore_first_train=False, target_candidates=None, level_budget=None):
+        self.min_level = min_level
+        self.max_level = max_level
+        self.top_offset = top_offset
+        self.keep = keep
+        self.rescore = rescore
+        self.num_samples = num_samples
+        self.rescore_first_train = rescore_first_train
+        self.target_candidates = target_candidates
+        self.level_budget = level_budget
+
+    def _Adaptive(self):
+        return self.target_candidates is not None or self.level_budget is not None
+
+    def _NumToKeep(self, query, level, ranked_keys):
+        """How many of ranked_keys (best first) fit the next level's target."""
+        stats = query.level_stats[level]
+        per_pair = stats.candidates / max(stats.pairs, 1)
+        target = math.inf
+        if self.target_candidates is not None:
+            target = self.target_candidates
+        if self.level_budget is not None and stats.seconds > 0:
+            target = min(target, self.level_budget * stats.candidates / stats.seconds)
+        expected = 0
+        num_keep = 0
+        for key in ranked_keys:
+            if num_keep and expected >= target:
+                break
+            extensions = query.rel_sets.Neighbours(key) & ~key
+            expected += relsets.PopCount(extensions) * per_pair
+            num_keep += 1
+        return num_keep
+
+    def _Applies(self, query, level):
+        if not self.min_level < level < self.max_level:
+            return False
+        return self.top_offset is None or level < query.num_rels - self.top_offset
+
+    def ModelFree(self, query, level):
+        """Whether level is left alone or pruned by DP cost alone.
+
+        A level rescored by the model in other passes is not, even if this
+        pass (FirstTrain) prunes it by DP cost.  Neither is a level pruned
+        adaptively, which depends on measured planning times.
+        """
+        if not self._Applies(query, level):
+            return True
+        return self.rescore is None and not self._Adaptive()
+
+    def _Rescore(self, query, joins, costs):
+        torch_costs = torch.tensor(costs, device=DEVICE)
+        if self.rescore == 'raw':
+            model = query.model[query.num_rels]
+            model.eval()
+            query_encodings = [j.info["encoding"] for j in joins]
+            query_feats = torch.cat(query_encodings, dim=0).to(DEVICE)
+            trees, indexes = _Featurize(query.dp.feature_store, query.nodeFeaturizer,
+                                        [j.info["fingerprint"] for j in joins],
+                                        [j.info["node"] for j in joins])
+            with torch.no_grad():
+                bias = model(query_feats, trees.to(DEVICE), indexes.to(DEVICE)).to(DEVICE).add(1).squeeze(1)
+        else:
+            bias, _ = query.dp._Calibrate(query.model[-1], joins, [j.info["encoding"] for j in joins],
+                                          [j.info["node"] for j in joins], query.nodeFeaturizer,
+                                          self.num_samples or _NumMcSamples(query.model),
+                                          deadline=query.deadline)
+        return torch.mul(bias, torch_costs).tolist()
+
+    def Prune(self, query, level):
+        if not self._Applies(query, level):
+            return
+        dp_table = query.dp_tables[level]
+        keys = list(dp_table)
+        costs = [dp_table[key][0] for key in keys]
+        if self.rescore is not None and (self.rescore_first_train or not query.FirstTrain):
+            costs = self._Rescore(query, [dp_table[key][1] for key in keys], costs)
+        ranked = sorted(range(len(keys)), key=lambda i: costs[i])
+        if self._Adaptive():
+            num_keep = self._NumToKeep(query, level, [keys[i] for i in ranked])
+        else:
+            num_keep = math.ceil(len(keys) * self.keep)
+        for i in ranked[num_keep:]:
+            dp_table.pop(keys[i])
+
+
+class BeamPruning(object):
+    """Keeps the width best join sets (by DP cost) of every level.
+
+    width: an int, or a list indexed by level (the last entry applies to
+      higher levels).
+    """
+
+    def __init__(self, width):
+        self.width = width
+
+    def ModelFree(self, query, level):
+        return True
+
+    def Prune(self, query, level):
+        width = self.width
+        if isinstance(width, (list, tuple)):
+            width = width[min(level, len(width) - 1)]
+        dp_table = query.dp_tables[level]
+        if len(dp_table) > width:
+            query.dp_tables[level] = dict(sorted(dp_table.items(), key=lambda x: x[1][0])[:width])
+
+
+class DPStages(object):
+    """The stages of one DP configuration; see _RunDP().
+
+    reuse: if set, the name under which the levels that do not depend on the
+      model are cached across passes (DynamicProgramming.level_cache).
+      Configurations sharing a name must compute those levels alike.
+    """
+
+    def __init__(self, pairs=None, costing=None, scoring=None, explore=None, collect=None, prune=None,
+                 on_pair=(), reuse=None):
+        self.pairs = pairs or LeftDeepPairs()
+        self.costing = costing or PgCosting()
+        self.scoring = scoring or CostScoring()
+        self.explore = explore
+        self.collect = collect
+        self.prune = prune
+        self.on_pair = list(on_pair)
+        self.reuse = reuse
+
+    def ReusableLevels(self, query):
+        """The highest level k < num_rels such that dp_tables[1..k] depend on
+        neither the model nor exp; 1 if there is none.
+
+        Exploration only acts on candidates given priorities by the scoring
+        stage, i.e., on model-scored levels.  on_pair callbacks see every
+        pair, so they disable reuse.
+        """
+        if self.on_pair:
+            return 1
+        level = 1
+        while level + 1 < query.num_rels:
+            if not self.scoring.ModelFree(query, level + 1):
+                break
+            if self.collect is not None and not self.collect.ModelFree(query, level + 1):
+                break
+            if self.prune is not None and not self.prune.ModelFree(query, level + 1):
+                break
+            level += 1
+        return level
+
+
 class DynamicProgramming(object):
     """Bottom-up dynamic programming plan search."""
 
@@ -271,7 +928,38 @@ class DynamicProgramming(object):
         p.Define('cost_model', costing.PostgresCost.Params(),
                  'Params of the cost model to use.')
         p.Define('search_space', 'bushy',
-                 'Options: bushy, dbmsx, bushy_norestrict.')
+                 'Options: bushy, dbmsx, bushy_norestrict, beam.')
+        # Learned left-deep DP (UCB_left_prune_replay_fix_kl and
+        # TEST_left_prune_bayes).
+        p.Define('model_top_levels', 3,
+                 'The model scores the candidates of the top this many levels;'
+                 ' lower levels use the PG cost.')
+        p.Define('explore_fraction', 0.1,
+                 'Fraction of the candidates of a pair executed by UCB'
+                 ' exploration during training.')
+        p.Define('prune_min_level', 6,
+                 'Levels > prune_min_level and < prune_max_level are pruned.')
+        p.Define('prune_max_level', 15, 'See prune_min_level.')
+        p.Define('prune_keep', 0.3,
+                 'Fraction of the join sets kept at a pruned level, unless'
+                 ' prune_target_candidates or prune_level_budget is set.')
+        p.Define(
+            'prune_target_candidates', None,
+            'If set, a pruned level keeps the best join sets until the next'
+            ' level would cost about this many candidates.')
+        p.Define(
+            'prune_level_budget', None,
+            'If set (seconds), a pruned level keeps the best join sets until'
+            ' the next level would take about this long to plan, going by the'
+            ' planning time per candidate measured at this level.')
+        p.Define(
+            'beam_width', 10,
+            'Beam search (TEST_beam): join sets kept per level.  An int, or a'
+            ' list indexed by level whose last entry applies to higher levels.')
+        p.Define(
+            'anytime_greedy_fraction', 0.2,
+            'TEST_anytime: fraction of the planning budget the greedy plan'
+            ' may take; the DP gets the rest.')
 
         # Physical planning.
         p.Define('plan_physical_ops', True, 'Do we plan physical joins/scans?')
@@ -280,6 +968,14 @@ class DynamicProgramming(object):
         p.Define(
             'collect_data_include_suboptimal', True, 'Call on enumeration'
                                                      ' hooks on suboptimal plans for each k-relation?')
+        p.Define(
+            'cache_low_levels', True,
+            'Reuse the dp_tables levels scored without the model across DP'
+            ' runs of the same query?  See util/level_cache.py.')
+        p.Define(
+            'cache_calibrations', True,
+            'Memoize model calibrations of candidates across DP runs until'
+            ' the model is updated?  See util/calibration.py.')
         return p
 
     def __init__(self, params):
@@ -288,12 +984,26 @@ class DynamicProgramming(object):
         self.cost_model = p.cost_model.cls(p.cost_model)
         self.on_enumerated_hooks = []
 
-        assert p.search_space in ('bushy', 'dbmsx',
-                                  'bushy_norestrict'), 'Not implemented.'
+        assert p.search_space in ('bushy', 'dbmsx', 'bushy_norestrict',
+                                  'beam'), 'Not implemented.'
 
         self.join_ops = ['Join']
         self.scan_ops = ['Scan']
         self.use_plan_restrictions = (p.search_space != 'bushy_norestrict')
+        self.calibration_cache = (calibration.CalibrationCache()
+                                  if p.cache_calibrations else None)
+        self.level_cache = (level_cache.LevelCache()
+                            if p.cache_low_levels else None)
+        # A feature_store.FeatureStore of the experience's features, read
+        # when candidates are scored; set by the trainer.
+        self.feature_store = None
+
+    def _LevelPruning(self, top_offset=0, num_samples=None):
+        """LevelPruning of the learned left-deep DP, as set by the Params."""
+        p = self.params
+        return LevelPruning(p.prune_min_level, p.prune_max_level, top_offset=top_offset, keep=p.prune_keep,
+                            num_samples=num_samples, target_candidates=p.prune_target_candidates,
+                            level_budget=p.prune_level_budget)
 
     def SetPhysicalOps(self, join_ops, scan_ops):
         """Must be called once if p.plan_physical_ops is true."""
@@ -302,6 +1012,28 @@ class DynamicProgramming(object):
         self.join_ops = copy.deepcopy(join_ops)
         self.scan_ops = copy.deepcopy(scan_ops)
 
+    def _Calibrate(self, model, joins, query_encodings, nodes, nodeFeaturizer,
+                   num_samples, share_query=False, deadline=None):
+        """Returns (mean, var) of num_samples MC-dropout calibrations per join.
+
+        Candidates already scored by the same model with unchanged weights are
+        served from self.calibration_cache without a forward pass.
+        deadline: see _McCalibrations.
+        """
+        keys = [join.info["fingerprint"] for join in joins]
+
+        def Compute(indices):
+            return _McCalibrations(model, [query_encodings[i] for i in indices],
+                                   [nodes[i] for i in indices], nodeFeaturizer,
+                                   num_samples, share_query, store=self.feature_store,
+                                   keys=[keys[i] for i in indices], deadline=deadline)
+
+        if self.calibration_cache is None:
+            samples = Compute(range(len(nodes)))
+            return calibration.MeanVar(samples)
+        return self.calibration_cache.Calibrate(model, keys, Compute,
+                                                num_samples, device=DEVICE)
+
     def PushOnEnumeratedHook(self, func):
         """Executes func(Node, cost) on each enumerated and costed subplan.
 
@@ -321,11 +1053,13 @@ class DynamicProgramming(object):
            A tuple of:
              best_node: balsa.Node;
              dp_tables: dict of size N (number of table in query), where
-               dp_table[i] is a dict mapping a sorted string of a relation set
-               (e.g., 'mi,t'), to (cost, the best plan that joins this set).
+               dp_table[i] is a dict mapping the bitmask of a relation set (see
+               relsets.RelationSets; e.g., 'mi,t' -> 0b11), to (cost, the best
+               plan that joins this set).
         """
 
         p = self.params
+        assert p.search_space != 'beam', 'Beam search needs a model: use PlanTest().'
         join_graph, all_join_conds = query_node.GetOrParseSql()
         assert len(join_graph.edges) == len(all_join_conds)
         # Base tables to join.
@@ -333,8 +1067,9 @@ class DynamicProgramming(object):
         dp_tables = collections.defaultdict(dict)  # level -> dp_table
 
         # Fill in level 1.
+        rel_sets = relsets.RelationSets(query_leaves)
         for leaf_node in query_leaves:
-            dp_tables[1][leaf_node.table_alias] = (0, leaf_node)
+            dp_tables[1][rel_sets.Bit(leaf_node.table_alias)] = (0, leaf_node)
 
         fns = {
             'bushy': self._dp_getTrainData,
@@ -352,60 +1087,54 @@ class DynamicProgramming(object):
         #   alltime = 0
         # num_rels = len(join_graph.nodes)
         num_rels = len(query_leaves)
+        rel_sets = relsets.RelationSets(query_leaves, join_graph)
+        csg_cmp_pairs = rel_sets.CsgCmpPairsByLevel()
         for level in range(2, num_rels + 1):
             dp_table = dp_tables[level]
-            for level_i in range(1, level):
-                level_j = level - level_i
-                dp_table_i = dp_tables[level_i]
-                dp_table_j = dp_tables[level_j]
-                #                print('dp items'+dp_table_i.items)
-                for l_ids, l_tup in dp_table_i.items():
-                    for r_ids, r_tup in dp_table_j.items():
-                        l = l_tup[1]
-                        r = r_tup[1]
-                        if not plans_lib.ExistsJoinEdgeInGraph(
-                                l, r, join_graph):
-                            # No join clause linking two sides.  Skip.
-                            continue
-                        l_ids_splits = l_ids.split(',')
-                        r_ids_splits = r_ids.split(',')
-                        if len(np.intersect1d(l_ids_splits, r_ids_splits)) > 0:
-                            # A relation exists in both sides.  Skip.
-                            continue
-                        join_ids = ','.join(sorted(l_ids_splits + r_ids_splits))
-
-                        # Otherwise, form a new join.
-                        for join in EnumerateJoinWithOps(
-                                l,
-                                r,
-                                self.join_ops,
-                                self.scan_ops,
-                                use_plan_restrictions=self.use_plan_restrictions
-                        ):
-
-                            join_conds = join.KeepRelevantJoins(all_join_conds)
-                            #  b=b+1
-                            #  print(b)
-                            #  st=time.time()
-                            cost, sql, hint = self.cost_model(join, join_conds)
-                            # costbais = test.getCostbais(sql, hint)
-                            # print(costbais+1)
-                            origincost = cost
-
-                            # cost = cost * costbais
-                            #  en =time.time()
-                            #  tt=en-st
-                            #  print('time =' ,str(tt))
-                            #  alltime =alltime +tt
-                            if p.collect_data_include_suboptimal:
-                                # Call registered hooks on the costed subplan.
-                                for hook in self.on_enumerated_hooks:
-                                    hook(join, cost)
-
-                            # Record if better cost.
-                            if join_ids not in dp_table or dp_table[join_ids][
-                                0] > cost:
-                                dp_table[join_ids] = (cost, join)
+            for l_ids, r_ids in csg_cmp_pairs[level]:
+                # Connected and disjoint by construction (see
+                # relsets.RelationSets.EnumerateCsgCmpPairs).
+                l_tup = dp_tables[relsets.PopCount(l_ids)].get(l_ids)
+                r_tup = dp_tables[relsets.PopCount(r_ids)].get(r_ids)
+                if l_tup is None or r_tup is None:
+                    # No plan for one side.  Skip.
+                    continue
+                l = l_tup[1]
+                r = r_tup[1]
+                join_set = l_ids | r_ids
+
+                # Otherwise, form a new join.
+                for join in EnumerateJoinWithOps(
+                        l,
+                        r,
+                        self.join_ops,
+                        self.scan_ops,
+                        use_plan_restrictions=self.use_plan_restrictions
+                ):
+
+                    join_conds = join.KeepRelevantJoins(all_join_conds)
+                    #  b=b+1
+                    #  print(b)
+                    #  st=time.time()
+                    cost, sql, hint = self.cost_model(join, join_conds)
+                    # costbais = test.getCostbais(sql, hint)
+                    # print(costbais+1)
+                    origincost = cost
+
+                    # cost = cost * costbais
+                    #  en =time.time()
+                    #  tt=en-st
+                    #  print('time =' ,str(tt))
+                    #  alltime =alltime +tt
+                    if p.collect_data_include_suboptimal:
+                        # Call registered hooks on the costed subplan.
+                        for hook in self.on_enumerated_hooks:
+                            hook(join, cost)
+
+                    # Record if better cost.
+                    if join_set not in dp_table or dp_table[join_set][
+                        0] > cost:
+                        dp_table[join_set] = (cost, join)
         # print(alltime/b)
         return list(dp_tables[num_rels].values())[0][1], dp_tables
 
@@ -427,81 +1156,72 @@ class DynamicProgramming(object):
         workload.workload_info.table_num_rows = postgres.GetAllTableNumRows(
             workload.workload_info.rel_names)
         num_rels = len(query_leaves)
+        rel_sets = relsets.RelationSets(query_leaves, join_graph)
+        csg_cmp_pairs = rel_sets.CsgCmpPairsByLevel()
         trainBuffer.append([] * (num_rels + 1))
         for i in range(0, num_rels):
             trainBuffer.append([])
         for level in range(2, num_rels + 1):
             dp_table = dp_tables[level]
             # print(dp_table)
-            for level_i in range(1, level):
-                level_j = level - level_i
-                dp_table_i = dp_tables[level_i]
-                dp_table_j = dp_tables[level_j]
-
-                for l_ids, l_tup in dp_table_i.items():
-
-                    for r_ids, r_tup in dp_table_j.items():
-                        l = l_tup[1]
-                        r = r_tup[1]
-                        if not plans_lib.ExistsJoinEdgeInGraph(
-                                l, r, join_graph):
-                            # No join clause linking two sides.  Skip.
-                            continue
-                        l_ids_splits = l_ids.split(',')
-                        r_ids_splits = r_ids.split(',')
-                        if len(np.intersect1d(l_ids_splits, r_ids_splits)) > 0:
-                            # A relation exists in both sides.  Skip.
-                            continue
-                        join_ids = ','.join(sorted(l_ids_splits + r_ids_splits))
-
-                        # Otherwise, form a new join.
-                        for join in EnumerateJoinWithOps(
-                                l,
-                                r,
-                                self.join_ops,
-                                self.scan_ops,
-                                use_plan_restrictions=self.use_plan_restrictions
-                        ):
-
-                            join_conds = join.KeepRelevantJoins(all_join_conds)
-
-                            cost, sql, hint = self.cost_model(join, join_conds)
-                            origincost = math.log(cost)
-                            # use model to dp
-
-                            data = encoding.getencoding_Balsa(sql, hint, workload)
-                            costbais = torch.tanh(model(data[0], data[1], data[2])) + 1
-                            # # print(costbais)
-                            # # print(costbais)
-                            cost = math.log(cost) * costbais
-
-                            if join_ids not in dp_table or dp_table[join_ids][
-                                0] > cost:
-
-                                # print(num)
-                                tem = []
-                                tem.append(origincost)
-                                tem.append(sql)
-                                tem.append(hint)
-                                # # # collect train data (latency)
-                                usebuffer = False
-                                for j in exp[level]:
-                                    if (j[2] == hint and j[1] == sql):
-                                        # latency=j[3]
-                                        usebuffer = True
-                                        # print('use buffer')
-                                        # tem.append(latency)
-                                        break
-                                if (usebuffer == False):
-                                    num = num + 1
-                                    # latency=postgres.GetLatencyFromPg(sql, hint, verbose=False, check_hint_used=False)
-                                    # tem.append(latency)
-                                    exp[level].append(tem)
-                                # print('latency = ',end='')
-                                #  print(latency)
-                                #   trainBuffer[level].append(tem)
-
-                                dp_table[join_ids] = (cost, join)
+            for l_ids, r_ids in csg_cmp_pairs[level]:
+                # Connected and disjoint by construction (see
+                # relsets.RelationSets.EnumerateCsgCmpPairs).
+                l_tup = dp_tables[relsets.PopCount(l_ids)].get(l_ids)
+                r_tup = dp_tables[relsets.PopCount(r_ids)].get(r_ids)
+                if l_tup is None or r_tup is None:
+                    # No plan for one side.  Skip.
+                    continue
+                l = l_tup[1]
+                r = r_tup[1]
+                join_set = l_ids | r_ids
+
+                # Otherwise, form a new join.
+                for join in EnumerateJoinWithOps(
+                        l,
+                        r,
+                        self.join_ops,
+                        self.scan_ops,
+                        use_plan_restrictions=self.use_plan_restrictions
+                ):
+
+                    join_conds = join.KeepRelevantJoins(all_join_conds)
+
+                    cost, sql, hint = self.cost_model(join, join_conds)
+                    origincost = math.log(cost)
+                    # use model to dp
+
+                    data = encoding.getencoding_Balsa(sql, hint, workload)
+                    costbais = torch.tanh(model(data[0], data[1], data[2])) + 1
+                    # # print(costbais)
+                    # # print(costbais)
+                    cost = math.log(cost) * costbais
+
+                    if join_set not in dp_table or dp_table[join_set][
+                        0] > cost:
+
+                        # print(num)
+                        tem = []
+                        tem.append(origincost)
+                        tem.append(sql)
+                        tem.append(hint)
+                        # # # collect train data (latency)
+                        usebuffer = False
+                        j = experience.FindEntry(exp[level], sql, hint)
+                        if j is not None:
+                            # latency=j[3]
+                            usebuffer = True
+                            # tem.append(latency)
+                        if (usebuffer == False):
+                            num = num + 1
+                            # latency=postgres.GetLatencyFromPg(sql, hint, verbose=False, check_hint_used=False)
+                            # tem.append(latency)
+                            exp[level].append(tem)
+                        # print('latency = ',end='')
+                        #  print(latency)
+                        #   trainBuffer[level].append(tem)
+
+                        dp_table[join_set] = (cost, join)
         # save train data ?
         #  a_file = open("data10_0.pkl", "wb")
         # b_file =open('exp.pkl','wb')
@@ -515,71 +1235,64 @@ class DynamicProgramming(object):
     def _autoGetData(self, join_graph, all_join_conds, query_leaves, dp_tables, workload, exp, FirstTrain, model,
                      timeout, dropbuffer):
         num_rels = len(query_leaves)
+        rel_sets = relsets.RelationSets(query_leaves, join_graph)
+        csg_cmp_pairs = rel_sets.CsgCmpPairsByLevel()
         trainBuffer.append([] * (num_rels + 1))
         num = 0
         for i in range(0, num_rels):
             trainBuffer.append([])
         for level in range(2, num_rels + 1):
             dp_table = dp_tables[level]
-            for level_i in range(1, level):
-                level_j = level - level_i
-                dp_table_i = dp_tables[level_i]
-                dp_table_j = dp_tables[level_j]
-                for l_ids, l_tup in dp_table_i.items():
-                    for r_ids, r_tup in dp_table_j.items():
-                        l = l_tup[1]
-                        r = r_tup[1]
-                        if not plans_lib.ExistsJoinEdgeInGraph(
-                                l, r, join_graph):
-                            # No join clause linking two sides.  Skip.
-                            continue
-                        l_ids_splits = l_ids.split(',')
-                        r_ids_splits = r_ids.split(',')
-                        if len(np.intersect1d(l_ids_splits, r_ids_splits)) > 0:
-                            # A relation exists in both sides.  Skip.
-                            continue
-                        join_ids = ','.join(sorted(l_ids_splits + r_ids_splits))
-                        # Otherwise, form a new join.
-                        for join in EnumerateJoinWithOps(
-                                l,
-                                r,
-                                self.join_ops,
-                                self.scan_ops,
-                                use_plan_restrictions=self.use_plan_restrictions
-                        ):
-
-                            join_conds = join.KeepRelevantJoins(all_join_conds)
-                            cost, sql, hint = self.cost_model(join, join_conds)
-                            logcost = math.log(cost)
-
-                            data = encoding.getencoding_Balsa(sql, hint, workload)
-                            if not FirstTrain:
-                                costbais = torch.tanh(model(data[0], data[1], data[2])) + 1
-                                cost = math.log(cost) * costbais
-                            if join_ids not in dp_table or dp_table[join_ids][
-                                0] > cost:
-
-                                tem = []
-                                tem.append(logcost)
-                                tem.append(sql)
-                                tem.append(hint)
-                                # # # collect train data (latency)
-                                usebuffer = False
-                                for j in exp[level]:
-                                    if (j[2] == hint and j[1] == sql):
-                                        usebuffer = True
-                                        latency = j[3]
-                                        # print('use buffer')
-                                        break
-                                if (usebuffer == False):
-                                    num = num + 1
-                                    latency = postgres.GetLatencyFromPg(sql, hint, verbose=False, check_hint_used=False,
-                                                                        timeout=timeout, dropbuffer=dropbuffer)
-                                    tem.append(latency)
-                                    tem.append(data)
-                                    exp[level].append(tem)
-                                    trainBuffer[level].append(tem)
-                                dp_table[join_ids] = (cost, join)
+            for l_ids, r_ids in csg_cmp_pairs[level]:
+                # Connected and disjoint by construction (see
+                # relsets.RelationSets.EnumerateCsgCmpPairs).
+                l_tup = dp_tables[relsets.PopCount(l_ids)].get(l_ids)
+                r_tup = dp_tables[relsets.PopCount(r_ids)].get(r_ids)
+                if l_tup is None or r_tup is None:
+                    # No plan for one side.  Skip.
+                    continue
+                l = l_tup[1]
+                r = r_tup[1]
+                join_set = l_ids | r_ids
+                # Otherwise, form a new join.
+                for join in EnumerateJoinWithOps(
+                        l,
+                        r,
+                        self.join_ops,
+                        self.scan_ops,
+                        use_plan_restrictions=self.use_plan_restrictions
+                ):
+
+                    join_conds = join.KeepRelevantJoins(all_join_conds)
+                    cost, sql, hint = self.cost_model(join, join_conds)
+                    logcost = math.log(cost)
+
+                    data = encoding.getencoding_Balsa(sql, hint, workload)
+                    if not FirstTrain:
+                        costbais = torch.tanh(model(data[0], data[1], data[2])) + 1
+                        cost = math.log(cost) * costbais
+                    if join_set not in dp_table or dp_table[join_set][
+                        0] > cost:
+
+                        tem = []
+                        tem.append(logcost)
+                        tem.append(sql)
+                        tem.append(hint)
+                        # # # collect train data (latency)
+                        usebuffer = False
+                        j = experience.FindEntry(exp[level], sql, hint)
+                        if j is not None:
+                            usebuffer = True
+                            latency = j[3]
+                        if (usebuffer == False):
+                            num = num + 1
+                            latency = postgres.GetLatencyFromPg(sql, hint, verbose=False, check_hint_used=False,
+                                                                timeout=timeout, dropbuffer=dropbuffer)
+                            tem.append(latency)
+                            tem.append(data)
+                            exp[level].append(tem)
+                            trainBuffer[level].append(tem)
+                        dp_table[join_set] = (cost, join)
         if timeout > latency:
             timeout = latency
         # print('dp now timeout = '+str(timeout))
@@ -589,73 +1302,65 @@ class DynamicProgramming(object):
     def _autoGetDataForbatch(self, join_graph, all_join_conds, query_leaves, dp_tables, workload, exp, FirstTrain,
                              model, timeout, dropbuffer):
         num_rels = len(query_leaves)
+        rel_sets = relsets.RelationSets(query_leaves, join_graph)
+        csg_cmp_pairs = rel_sets.CsgCmpPairsByLevel()
         num = 0
         for i in range(0, num_rels + 1):
             trainBuffer.append([])
         for level in range(2, num_rels + 1):
             dp_table = dp_tables[level]
-            for level_i in range(1, level):
-                level_j = level - level_i
-                dp_table_i = dp_tables[level_i]
-                dp_table_j = dp_tables[level_j]
-
-                for l_ids, l_tup in dp_table_i.items():
-                    for r_ids, r_tup in dp_table_j.items():
-                        l = l_tup[1]
-                        r = r_tup[1]
-                        if not plans_lib.ExistsJoinEdgeInGraph(
-                                l, r, join_graph):
-                            # No join clause linking two sides.  Skip.
-                            continue
-                        l_ids_splits = l_ids.split(',')
-                        r_ids_splits = r_ids.split(',')
-                        if len(np.intersect1d(l_ids_splits, r_ids_splits)) > 0:
-                            # A relation exists in both sides.  Skip.
-                            continue
-                        join_ids = ','.join(sorted(l_ids_splits + r_ids_splits))
-                        # Otherwise, form a new join.
-
-                        for join in EnumerateJoinWithOps(
-                                l,
-                                r,
-                                self.join_ops,
-                                self.scan_ops,
-                                use_plan_restrictions=self.use_plan_restrictions
-                        ):
-
-                            join_conds = join.KeepRelevantJoins(all_join_conds)
-                            cost, sql, hint = self.cost_model(join, join_conds)
-                            logcost = math.log(cost)
-
-                            data = encoding.getencoding_Balsa(sql, hint, workload)
-                            assert len(data) == 2
-                            if not FirstTrain:
-                                costbais = torch.tanh(model(data[0], data[1], data[2])) + 1
-                                cost = math.log(cost) * costbais
-                            if join_ids not in dp_table or dp_table[join_ids][
-                                0] > cost:
-
-                                tem = []
-                                tem.append(logcost)
-                                tem.append(sql)
-                                tem.append(hint)
-                                # # # collect train data (latency)
-                                usebuffer = False
-                                for j in exp[level]:
-                                    if (j[2] == hint and j[1] == sql):
-                                        usebuffer = True
-                                        latency = j[3]
-                                        # print('use buffer')
-                                        break
-                                if (usebuffer == False):
-                                    num = num + 1
-                                    latency = postgres.GetLatencyFromPg(sql, hint, verbose=False, check_hint_used=False,
-                                                                        timeout=timeout, dropbuffer=dropbuffer)
-                                    tem.append(latency)
-                                    tem.append(data)
-                                    exp[level].append(tem)
-                                    trainBuffer[level].append(tem)
-                                dp_table[join_ids] = (cost, join)
+            for l_ids, r_ids in csg_cmp_pairs[level]:
+                # Connected and disjoint by construction (see
+                # relsets.RelationSets.EnumerateCsgCmpPairs).
+                l_tup = dp_tables[relsets.PopCount(l_ids)].get(l_ids)
+                r_tup = dp_tables[relsets.PopCount(r_ids)].get(r_ids)
+                if l_tup is None or r_tup is None:
+                    # No plan for one side.  Skip.
+                    continue
+                l = l_tup[1]
+                r = r_tup[1]
+                join_set = l_ids | r_ids
+                # Otherwise, form a new join.
+
+                for join in EnumerateJoinWithOps(
+                        l,
+                        r,
+                        self.join_ops,
+                        self.scan_ops,
+                        use_plan_restrictions=self.use_plan_restrictions
+                ):
+
+                    join_conds = join.KeepRelevantJoins(all_join_conds)
+                    cost, sql, hint = self.cost_model(join, join_conds)
+                    logcost = math.log(cost)
+
+                    data = encoding.getencoding_Balsa(sql, hint, workload)
+                    assert len(data) == 2
+                    if not FirstTrain:
+                        costbais = torch.tanh(model(data[0], data[1], data[2])) + 1
+                        cost = math.log(cost) * costbais
+                    if join_set not in dp_table or dp_table[join_set][
+                        0] > cost:
+
+                        tem = []
+                        tem.append(logcost)
+                        tem.append(sql)
+                        tem.append(hint)
+                        # # # collect train data (latency)
+                        usebuffer = False
+                        j = experience.FindEntry(exp[level], sql, hint)
+                        if j is not None:
+                            usebuffer = True
+                            latency = j[3]
+                        if (usebuffer == False):
+                            num = num + 1
+                            latency = postgres.GetLatencyFromPg(sql, hint, verbose=False, check_hint_used=False,
+                                                                timeout=timeout, dropbuffer=dropbuffer)
+                            tem.append(latency)
+                            tem.append(data)
+                            exp[level].append(tem)
+                            trainBuffer[level].append(tem)
+                        dp_table[join_set] = (cost, join)
 
         if timeout > latency:
             timeout = latency
@@ -667,6 +1372,8 @@ class DynamicProgramming(object):
     def _batch_DP(self, join_graph, all_join_conds, query_leaves, dp_tables, workload, exp, FirstTrain,
                   model, timeout, dropbuffer, nodeFeaturizer):
         num_rels = len(query_leaves)
+        rel_sets = relsets.RelationSets(query_leaves, join_graph)
+        csg_cmp_pairs = rel_sets.CsgCmpPairsByLevel()
         num = 0
         latency = 0
         for i in range(0, num_rels + 1):
@@ -674,87 +1381,77 @@ class DynamicProgramming(object):
         for level in range(2, num_rels + 1):
             dp_table = dp_tables[level]
             # print(level)
-            for level_i in range(1, level):
-                level_j = level - level_i
-                dp_table_i = dp_tables[level_i]
-                dp_table_j = dp_tables[level_j]
-
-                for l_ids, l_tup in dp_table_i.items():
-                    for r_ids, r_tup in dp_table_j.items():
-                        l = l_tup[1]
-                        r = r_tup[1]
-                        if not plans_lib.ExistsJoinEdgeInGraph(
-                                l, r, join_graph):
-                            # No join clause linking two sides.  Skip.
-                            continue
-                        l_ids_splits = l_ids.split(',')
-                        r_ids_splits = r_ids.split(',')
-                        if len(np.intersect1d(l_ids_splits, r_ids_splits)) > 0:
-                            # A relation exists in both sides.  Skip.
-                            continue
-                        join_ids = ','.join(sorted(l_ids_splits + r_ids_splits))
-                        # Otherwise, form a new join.
-                        dp_costs = []
-                        dp_query_encodings = []
-                        dp_nodes = []
-                        dp_hints_sqls = []
-                        dp_join = []
-                        for join in EnumerateJoinWithOps(
-                                l,
-                                r,
-                                self.join_ops,
-                                self.scan_ops,
-                                use_plan_restrictions=self.use_plan_restrictions
-                        ):
-                            join_conds = join.KeepRelevantJoins(all_join_conds)
-                            cost, sql, hint = self.cost_model(join, join_conds)
-                            logcost = math.log(cost)
-                            data = encoding.getencoding_Balsa(sql, hint, workload)
-                            dp_join.append(join)
-                            dp_costs.append(logcost)
-                            dp_query_encodings.append(data[0])
-                            dp_nodes.append(data[1])
-                            dp_hints_sqls.append([hint, sql])
-                            assert len(data) == 2
-                        if not FirstTrain:
-                            query_feats = torch.cat(dp_query_encodings, dim=0)
-                            trees, indexes = TreeConvFeaturize(nodeFeaturizer, dp_nodes)
-                            if torch.cuda.is_available():
-                                trees = trees.cuda()
-                                indexes = indexes.cuda()
-                                torch_dpcosts = torch.tensor(dp_costs)
-                                torch_dpcosts = torch_dpcosts.cuda()
-                            costbais = torch.tanh(model(query_feats, trees, indexes)).add(1).squeeze(1)
-                            costlist = torch.mul(costbais, torch_dpcosts).tolist()
-                        else:
-                            costlist = dp_costs
-                        # print(costlist)
-                        for i in range(0, len(costlist)):
-                            if join_ids not in dp_table or dp_table[join_ids][
-                                0] > costlist[i]:
-                                tem = []
-                                tem.append(dp_costs[i])
-                                tem.append(dp_hints_sqls[i][1])
-                                tem.append(dp_hints_sqls[i][0])
-                                # # # collect train data (latency)
-                                usebuffer = False
-                                for j in exp[level]:
-                                    if (j[2] == dp_hints_sqls[i][0] and j[1] == dp_hints_sqls[i][1]):
-                                        usebuffer = True
-                                        latency = j[3]
-                                        # print('use buffer')
-                                        break
-                                if (usebuffer == False):
-                                    num = num + 1
-                                    latency = postgres.GetLatencyFromPg(dp_hints_sqls[i][1], dp_hints_sqls[i][0],
-                                                                        verbose=False, check_hint_used=False,
-                                                                        timeout=timeout, dropbuffer=dropbuffer)
-                                    # latency = random.random()
-                                    tem.append(latency)
-                                    tem.append([dp_query_encodings[i], dp_nodes[i]])
-                                    exp[level].append(tem)
-                                    trainBuffer[level].append(tem)
-                                dp_table[join_ids] = (costlist[i], dp_join[i])
+            for l_ids, r_ids in csg_cmp_pairs[level]:
+                # Connected and disjoint by construction (see
+                # relsets.RelationSets.EnumerateCsgCmpPairs).
+                l_tup = dp_tables[relsets.PopCount(l_ids)].get(l_ids)
+                r_tup = dp_tables[relsets.PopCount(r_ids)].get(r_ids)
+                if l_tup is None or r_tup is None:
+                    # No plan for one side.  Skip.
+                    continue
+                l = l_tup[1]
+                r = r_tup[1]
+                join_set = l_ids | r_ids
+                # Otherwise, form a new join.
+                dp_costs = []
+                dp_query_encodings = []
+                dp_nodes = []
+                dp_hints_sqls = []
+                dp_join = []
+                for join in EnumerateJoinWithOps(
+                        l,
+                        r,
+                        self.join_ops,
+                        self.scan_ops,
+                        use_plan_restrictions=self.use_plan_restrictions
+                ):
+                    join_conds = join.KeepRelevantJoins(all_join_conds)
+                    cost, sql, hint = self.cost_model(join, join_conds)
+                    logcost = math.log(cost)
+                    data = encoding.getencoding_Balsa(sql, hint, workload)
+                    dp_join.append(join)
+                    dp_costs.append(logcost)
+                    dp_query_encodings.append(data[0])
+                    dp_nodes.append(data[1])
+                    dp_hints_sqls.append([hint, sql])
+                    assert len(data) == 2
+                if not FirstTrain:
+                    trees, indexes = TreeConvFeaturize(nodeFeaturizer, dp_nodes)
+                    if torch.cuda.is_available():
+                        trees = trees.cuda()
+                        indexes = indexes.cuda()
+                        torch_dpcosts = torch.tensor(dp_costs)
+                        torch_dpcosts = torch_dpcosts.cuda()
+                    query_feats, query_index = ShareQueryEncoding(dp_query_encodings, trees.device)
+                    costbais = torch.tanh(model(query_feats, trees, indexes, query_index)).add(1).squeeze(1)
+                    costlist = torch.mul(costbais, torch_dpcosts).tolist()
+                else:
+                    costlist = dp_costs
+                # print(costlist)
+                for i in range(0, len(costlist)):
+                    if join_set not in dp_table or dp_table[join_set][
+                        0] > costlist[i]:
+                        tem = []
+                        tem.append(dp_costs[i])
+                        tem.append(dp_hints_sqls[i][1])
+                        tem.append(dp_hints_sqls[i][0])
+                        # # # collect train data (latency)
+                        usebuffer = False
+                        j = experience.FindEntry(exp[level], dp_hints_sqls[i][1], dp_hints_sqls[i][0])
+                        if j is not None:
+                            usebuffer = True
+                            latency = j[3]
+                        if (usebuffer == False):
+                            num = num + 1
+                            latency = postgres.GetLatencyFromPg(dp_hints_sqls[i][1], dp_hints_sqls[i][0],
+                                                                verbose=False, check_hint_used=False,
+                                                                timeout=timeout, dropbuffer=dropbuffer)
+                            # latency = random.random()
+                            tem.append(latency)
+                            tem.append([dp_query_encodings[i], dp_nodes[i]])
+                            exp[level].append(tem)
+                            trainBuffer[level].append(tem)
+                        dp_table[join_set] = (costlist[i], dp_join[i])
 
         if timeout > latency:
             timeout = latency
@@ -766,6 +1463,8 @@ class DynamicProgramming(object):
     def _batch_DP_level(self, join_graph, all_join_conds, query_leaves, dp_tables, workload, exp, FirstTrain,
                         model, timeout, dropbuffer, nodeFeaturizer, greedy):
         num_rels = len(query_leaves)
+        rel_sets = relsets.RelationSets(query_leaves, join_graph)
+        csg_cmp_pairs = rel_sets.CsgCmpPairsByLevel()
         num = 0
         latency = 0
         for i in range(0, num_rels + 1):
@@ -773,109 +1472,97 @@ class DynamicProgramming(object):
         for level in range(2, num_rels + 1):
             dp_table = dp_tables[level]
             # print(level)
-            for level_i in range(1, level):
-                level_j = level - level_i
-                dp_table_i = dp_tables[level_i]
-                dp_table_j = dp_tables[level_j]
-
-                for l_ids, l_tup in dp_table_i.items():
-                    for r_ids, r_tup in dp_table_j.items():
-                        l = l_tup[1]
-                        r = r_tup[1]
-                        if not plans_lib.ExistsJoinEdgeInGraph(
-                                l, r, join_graph):
-                            # No join clause linking two sides.  Skip.
-                            continue
-                        l_ids_splits = l_ids.split(',')
-                        r_ids_splits = r_ids.split(',')
-                        if len(np.intersect1d(l_ids_splits, r_ids_splits)) > 0:
-                            # A relation exists in both sides.  Skip.
-                            continue
-                        join_ids = ','.join(sorted(l_ids_splits + r_ids_splits))
-                        # Otherwise, form a new join.
-                        dp_costs = []
-                        dp_query_encodings = []
-                        dp_nodes = []
-                        dp_hints_sqls = []
-                        dp_join = []
-                        for join in EnumerateJoinWithOps(
-                                l,
-                                r,
-                                self.join_ops,
-                                self.scan_ops,
-                                use_plan_restrictions=self.use_plan_restrictions
-                        ):
-                            join_conds = join.KeepRelevantJoins(all_join_conds)
-                            cost, sql, hint = self.cost_model(join, join_conds)
-
-                            logcost = math.log(cost)
-                            data = encoding.getencoding_Balsa(sql, hint, workload)
-                            dp_join.append(join)
-                            dp_costs.append(logcost)
-                            dp_query_encodings.append(data[0])
-                            dp_nodes.append(data[1])
-                            dp_hints_sqls.append([hint, sql])
-                            assert len(data) == 2
-                        if not FirstTrain:
-                            query_feats = (torch.cat(dp_query_encodings, dim=0)).to(DEVICE)
-                            trees, indexes = TreeConvFeaturize(nodeFeaturizer, dp_nodes)
-                            if torch.cuda.is_available():
-                                trees = trees.to(DEVICE)
-                                indexes = indexes.to(DEVICE)
-                                torch_dpcosts = (torch.tensor(dp_costs)).to(DEVICE)
-                            costbais = torch.tanh(model[level](query_feats, trees, indexes).to(DEVICE)).add(1).squeeze(
-                                1)
-                            costlist = torch.mul(costbais, torch_dpcosts).tolist()
-                        else:
-                            costlist = dp_costs
-                        # print(costlist)
-                        for i in range(0, len(costlist)):
-                            if (random.random() < greedy):
-                                tem = []
-                                tem.append(dp_costs[i])
-                                tem.append(dp_hints_sqls[i][1])
-                                tem.append(dp_hints_sqls[i][0])
-                                # # # collect train data (latency)
-                                usebuffer = False
-                                for j in exp[level]:
-                                    if (j[2] == dp_hints_sqls[i][0] and j[1] == dp_hints_sqls[i][1]):
-                                        usebuffer = True
-                                        glatency = j[3]
-                                        # print('use buffer')
-                                        break
-                                if (usebuffer == False):
-                                    num = num + 1
-                                    glatency = postgres.GetLatencyFromPg(dp_hints_sqls[i][1], dp_hints_sqls[i][0],
-                                                                         verbose=False, check_hint_used=False,
-                                                                         timeout=timeout, dropbuffer=dropbuffer)
-                                    tem.append(glatency)
-                                    tem.append([dp_query_encodings[i], dp_nodes[i]])
-                                    exp[level].append(tem)
-                                    trainBuffer[level].append(tem)
-                            if join_ids not in dp_table or dp_table[join_ids][
-                                0] > costlist[i]:
-                                tem = []
-                                tem.append(dp_costs[i])
-                                tem.append(dp_hints_sqls[i][1])
-                                tem.append(dp_hints_sqls[i][0])
-                                # # # collect train data (latency)
-                                usebuffer = False
-                                for j in exp[level]:
-                                    if (j[2] == dp_hints_sqls[i][0] and j[1] == dp_hints_sqls[i][1]):
-                                        usebuffer = True
-                                        latency = j[3]
-                                        # print('use buffer')
-                                        break
-                                if (usebuffer == False):
-                                    num = num + 1
-                                    latency = postgres.GetLatencyFromPg(dp_hints_sqls[i][1], dp_hints_sqls[i][0],
-                                                                        verbose=False, check_hint_used=False,
-                                                                        timeout=timeout, dropbuffer=dropbuffer)
-                                    tem.append(latency)
-                                    tem.append([dp_query_encodings[i], dp_nodes[i]])
-                                    exp[level].append(tem)
-                                    trainBuffer[level].append(tem)
-                                dp_table[join_ids] = (costlist[i], dp_join[i])
+            for l_ids, r_ids in csg_cmp_pairs[level]:
+                # Connected and disjoint by construction (see
+                # relsets.RelationSets.EnumerateCsgCmpPairs).
+                l_tup = dp_tables[relsets.PopCount(l_ids)].get(l_ids)
+                r_tup = dp_tables[relsets.PopCount(r_ids)].get(r_ids)
+                if l_tup is None or r_tup is None:
+                    # No plan for one side.  Skip.
+                    continue
+                l = l_tup[1]
+                r = r_tup[1]
+                join_set = l_ids | r_ids
+                # Otherwise, form a new join.
+                dp_costs = []
+                dp_query_encodings = []
+                dp_nodes = []
+                dp_hints_sqls = []
+                dp_join = []
+                for join in EnumerateJoinWithOps(
+                        l,
+                        r,
+                        self.join_ops,
+                        self.scan_ops,
+                        use_plan_restrictions=self.use_plan_restrictions
+                ):
+                    join_conds = join.KeepRelevantJoins(all_join_conds)
+                    cost, sql, hint = self.cost_model(join, join_conds)
+
+                    logcost = math.log(cost)
+                    data = encoding.getencoding_Balsa(sql, hint, workload)
+                    dp_join.append(join)
+                    dp_costs.append(logcost)
+                    dp_query_encodings.append(data[0])
+                    dp_nodes.append(data[1])
+                    dp_hints_sqls.append([hint, sql])
+                    assert len(data) == 2
+                if not FirstTrain:
+                    query_feats, query_index = ShareQueryEncoding(dp_query_encodings, DEVICE)
+                    trees, indexes = TreeConvFeaturize(nodeFeaturizer, dp_nodes)
+                    if torch.cuda.is_available():
+                        trees = trees.to(DEVICE)
+                        indexes = indexes.to(DEVICE)
+                        torch_dpcosts = (torch.tensor(dp_costs)).to(DEVICE)
+                    costbais = torch.tanh(model[level](query_feats, trees, indexes, query_index).to(DEVICE)).add(1).squeeze(
+                        1)
+                    costlist = torch.mul(costbais, torch_dpcosts).tolist()
+                else:
+                    costlist = dp_costs
+                # print(costlist)
+                for i in range(0, len(costlist)):
+                    if (random.random() < greedy):
+                        tem = []
+                        tem.append(dp_costs[i])
+                        tem.append(dp_hints_sqls[i][1])
+                        tem.append(dp_hints_sqls[i][0])
+                        # # # collect train data (latency)
+                        usebuffer = False
+                        j = experience.FindEntry(exp[level], dp_hints_sqls[i][1], dp_hints_sqls[i][0])
+                        if j is not None:
+                            usebuffer = True
+                            glatency = j[3]
+                        if (usebuffer == False):
+                            num = num + 1
+                            glatency = postgres.GetLatencyFromPg(dp_hints_sqls[i][1], dp_hints_sqls[i][0],
+                                                                 verbose=False, check_hint_used=False,
+                                                                 timeout=timeout, dropbuffer=dropbuffer)
+                            tem.append(glatency)
+                            tem.append([dp_query_encodings[i], dp_nodes[i]])
+                            exp[level].append(tem)
+                            trainBuffer[level].append(tem)
+                    if join_set not in dp_table or dp_table[join_set][
+                        0] > costlist[i]:
+                        tem = []
+                        tem.append(dp_costs[i])
+                        tem.append(dp_hints_sqls[i][1])
+                        tem.append(dp_hints_sqls[i][0])
+                        # # # collect train data (latency)
+                        usebuffer = False
+                        j = experience.FindEntry(exp[level], dp_hints_sqls[i][1], dp_hints_sqls[i][0])
+                        if j is not None:
+                            usebuffer = True
+                            latency = j[3]
+                        if (usebuffer == False):
+                            num = num + 1
+                            latency = postgres.GetLatencyFromPg(dp_hints_sqls[i][1], dp_hints_sqls[i][0],
+                                                                verbose=False, check_hint_used=False,
+                                                                timeout=timeout, dropbuffer=dropbuffer)
+                            tem.append(latency)
+                            tem.append([dp_query_encodings[i], dp_nodes[i]])
+                            exp[level].append(tem)
+                            trainBuffer[level].append(tem)
+                        dp_table[join_set] = (costlist[i], dp_join[i])
 
         if timeout > latency:
             timeout = latency
@@ -885,1074 +1572,212 @@ class DynamicProgramming(object):
     def _DP_TEST(self, join_graph, all_join_conds, query_leaves, dp_tables, workload
                  , model, nodeFeaturizer, justDP):
         num_rels = len(query_leaves)
+        rel_sets = relsets.RelationSets(query_leaves, join_graph)
+        csg_cmp_pairs = rel_sets.CsgCmpPairsByLevel()
         num = 0
         latency = 0
         for level in range(2, num_rels + 1):
             dp_table = dp_tables[level]
             # print(level)
-            for level_i in range(1, level):
-                level_j = level - level_i
-                dp_table_i = dp_tables[level_i]
-                dp_table_j = dp_tables[level_j]
-
-                for l_ids, l_tup in dp_table_i.items():
-                    for r_ids, r_tup in dp_table_j.items():
-                        l = l_tup[1]
-                        r = r_tup[1]
-                        if not plans_lib.ExistsJoinEdgeInGraph(
-                                l, r, join_graph):
-                            # No join clause linking two sides.  Skip.
-                            continue
-                        l_ids_splits = l_ids.split(',')
-                        r_ids_splits = r_ids.split(',')
-                        if len(np.intersect1d(l_ids_splits, r_ids_splits)) > 0:
-                            # A relation exists in both sides.  Skip.
-                            continue
-                        join_ids = ','.join(sorted(l_ids_splits + r_ids_splits))
-                        # Otherwise, form a new join.
-                        dp_costs = []
-                        dp_query_encodings = []
-                        dp_nodes = []
-                        dp_hints_sqls = []
-                        dp_join = []
-                        for join in EnumerateJoinWithOps(
-                                l,
-                                r,
-                                self.join_ops,
-                                self.scan_ops,
-                                use_plan_restrictions=self.use_plan_restrictions
-                        ):
-                            join_conds = join.KeepRelevantJoins(all_join_conds)
-                            cost, sql, hint = self.cost_model(join, join_conds)
-
-                            logcost = math.log(cost)
-                            data = encoding.getencoding_Balsa(sql, hint, workload)
-                            dp_join.append(join)
-                            dp_costs.append(logcost)
-                            dp_query_encodings.append(data[0])
-                            dp_nodes.append(data[1])
-                            dp_hints_sqls.append([hint, sql])
-                            assert len(data) == 2
-                        query_feats = (torch.cat(dp_query_encodings, dim=0)).to(DEVICE)
-                        trees, indexes = TreeConvFeaturize(nodeFeaturizer, dp_nodes)
-                        if justDP:
-                            costlist = dp_costs
-                        else:
-                            if torch.cuda.is_available():
-                                trees = trees.to(DEVICE)
-                                indexes = indexes.to(DEVICE)
-                                torch_dpcosts = (torch.tensor(dp_costs)).to(DEVICE)
-                            costbais = torch.tanh(model[level](query_feats, trees, indexes).to(DEVICE)).add(1).squeeze(
-                                1)
-                            costlist = torch.mul(costbais, torch_dpcosts).tolist()
-                        for i in range(0, len(costlist)):
-                            if join_ids not in dp_table or dp_table[join_ids][
-                                0] > costlist[i]:
-                                dp_table[join_ids] = (costlist[i], dp_join[i])
+            for l_ids, r_ids in csg_cmp_pairs[level]:
+                # Connected and disjoint by construction (see
+                # relsets.RelationSets.EnumerateCsgCmpPairs).
+                l_tup = dp_tables[relsets.PopCount(l_ids)].get(l_ids)
+                r_tup = dp_tables[relsets.PopCount(r_ids)].get(r_ids)
+                if l_tup is None or r_tup is None:
+                    # No plan for one side.  Skip.
+                    continue
+                l = l_tup[1]
+                r = r_tup[1]
+                join_set = l_ids | r_ids
+                # Otherwise, form a new join.
+                dp_costs = []
+                dp_query_encodings = []
+                dp_nodes = []
+                dp_hints_sqls = []
+                dp_join = []
+                for join in EnumerateJoinWithOps(
+                        l,
+                        r,
+                        self.join_ops,
+                        self.scan_ops,
+                        use_plan_restrictions=self.use_plan_restrictions
+                ):
+                    join_conds = join.KeepRelevantJoins(all_join_conds)
+                    cost, sql, hint = self.cost_model(join, join_conds)
+
+                    logcost = math.log(cost)
+                    data = encoding.getencoding_Balsa(sql, hint, workload)
+                    dp_join.append(join)
+                    dp_costs.append(logcost)
+                    dp_query_encodings.append(data[0])
+                    dp_nodes.append(data[1])
+                    dp_hints_sqls.append([hint, sql])
+                    assert len(data) == 2
+                query_feats, query_index = ShareQueryEncoding(dp_query_encodings, DEVICE)
+                trees, indexes = TreeConvFeaturize(nodeFeaturizer, dp_nodes)
+                if justDP:
+                    costlist = dp_costs
+                else:
+                    if torch.cuda.is_available():
+                        trees = trees.to(DEVICE)
+                        indexes = indexes.to(DEVICE)
+                        torch_dpcosts = (torch.tensor(dp_costs)).to(DEVICE)
+                    costbais = torch.tanh(model[level](query_feats, trees, indexes, query_index).to(DEVICE)).add(1).squeeze(
+                        1)
+                    costlist = torch.mul(costbais, torch_dpcosts).tolist()
+                for i in range(0, len(costlist)):
+                    if join_set not in dp_table or dp_table[join_set][
+                        0] > costlist[i]:
+                        dp_table[join_set] = (costlist[i], dp_join[i])
         bestplanhint = list(dp_tables[num_rels].values())[0][1].hint_str()
         return bestplanhint
 
+    def _RunDP(self, query, stages):
+        """Bottom-up left-deep DP over query.dp_tables with the given stages.
+
+        Fills query.dp_tables[2..num_rels]; raises _DeadlineExceeded once
+        query.deadline has passed, checked before every pair, before the
+        level-wide stages and between MC-dropout samples.  With stages.reuse,
+        the levels that do not depend on the model are restored from (or
+        added to) self.level_cache.
+        """
+        try:
+            return self._RunLevels(query, stages)
+        except _DeadlineExceeded as e:
+            if e.level is None:
+                # Raised while scoring; _RunLevels tracks the level.
+                e.level = query.level
+            raise
+
+    def _RunLevels(self, query, stages):
+        first_level = 2
+        reusable = 1
+        if stages.reuse is not None and self.level_cache is not None:
+            reusable = stages.ReusableLevels(query)
+        if reusable > 1:
+            first_level = self.level_cache.Restore(stages.reuse, query.query_leaves, query.all_join_conds,
+                                                   query.dp_tables, reusable) + 1
+        for level in range(first_level, query.num_rels + 1):
+            query.level = level
+            dp_table = query.dp_tables[level]
+            level_candidates = []
+            level_start = time.time()
+            num_pairs = 0
+            num_candidates = 0
+            for l_ids, l, r_ids, r in stages.pairs.Pairs(query, level):
+                _CheckDeadline(query.deadline, level)
+                join_set = l_ids | r_ids
+                candidates = stages.costing.Cost(query, level, l, r, join_set)
+                num_pairs += 1
+                num_candidates += len(candidates)
+                for fn in stages.on_pair:
+                    fn(query, candidates)
+                stages.scoring.Score(query, candidates)
+                if stages.explore is not None:
+                    stages.explore.OnPair(query, candidates)
+                    level_candidates.append(candidates)
+                for i, cost in enumerate(candidates.scores):
+                    if join_set not in dp_table or dp_table[join_set][0] > cost:
+                        if stages.collect is not None:
+                            stages.collect.OnImprove(query, candidates, i)
+                        dp_table[join_set] = (cost, candidates.joins[i])
+            if stages.explore is not None:
+                _CheckDeadline(query.deadline, level)
+                stages.explore.OnLevel(query, level, level_candidates)
+            query.level_stats[level] = LevelStats(num_pairs, num_candidates, time.time() - level_start)
+            if stages.prune is not None:
+                _CheckDeadline(query.deadline, level)
+                stages.prune.Prune(query, level)
+            if level == reusable:
+                self.level_cache.Store(stages.reuse, query.query_leaves, query.all_join_conds,
+                                       query.dp_tables, level)
+        return query.dp_tables[query.num_rels]
+
+    def _RunTrainingDP(self, query, stages, finsql=None, final_latency='plan', subplans_fin=None):
+        """_RunDP() for the training planners.
+
+        final_latency: how the query's timeout is tightened afterwards:
+          'plan': to the latency of the final plan (finsql);
+          'last': to the latest latency measured during the run;
+          None: not at all.
+        subplans_fin: if given, collectSubplans() of the final plan.
+
+        Returns:
+          trainBuffer, bestplanhint, num, timeout
+        """
+        for i in range(0, query.num_rels + 1):
+            trainBuffer.append([])
+        self._RunDP(query, stages)
+        if final_latency == 'last' and query.timeout > query.last_latency:
+            query.timeout = query.last_latency
+        finnode = list(query.dp_tables[query.num_rels].values())[0][1]
+        bestplanhint = finnode.hint_str()
+        if subplans_fin is not None:
+            collectSubplans(finnode, subplans_fin, query.workload, query.exp)
+        if final_latency == 'plan':
+            nowlatency = postgres.GetLatencyFromPg(finsql, bestplanhint, verbose=False, check_hint_used=False,
+                                                   timeout=query.timeout, dropbuffer=query.dropbuffer)
+            if query.timeout > nowlatency:
+                query.timeout = nowlatency
+        return trainBuffer, bestplanhint, query.num, query.timeout
+
     def _batch_DP_level_left(self, join_graph, all_join_conds, query_leaves, dp_tables, workload, exp, FirstTrain,
                              model, timeout, dropbuffer, nodeFeaturizer, greedy=0):
-        num_rels = len(query_leaves)
-        num = 0
-        latency = 0
-        for i in range(0, num_rels + 1):
-            trainBuffer.append([])
-        for level in range(2, num_rels + 1):
-            dp_table = dp_tables[level]
-            print(level)
-            # for level_i in range(1, level):
-            # level_j = level - level_i
-            dp_table_i = random_dic(dp_tables[level - 1])
-            dp_table_j = random_dic(dp_tables[1])
-            # limit = int(len(dp_table_i) * 0.2)
-            #    nowplansnum = 0
-            for l_ids, l_tup in dp_table_i.items():
-                for r_ids, r_tup in dp_table_j.items():
-                    l = l_tup[1]
-                    r = r_tup[1]
-                    if not plans_lib.ExistsJoinEdgeInGraph(
-                            l, r, join_graph):
-                        # No join clause linking two sides.  Skip.
-                        continue
-                    l_ids_splits = l_ids.split(',')
-                    r_ids_splits = r_ids.split(',')
-                    if len(np.intersect1d(l_ids_splits, r_ids_splits)) > 0:
-                        # A relation exists in both sides.  Skip.
-                        continue
-                    join_ids = ','.join(sorted(l_ids_splits + r_ids_splits))
-                    # Otherwise, form a new join.
-                    dp_costs = []
-                    dp_query_encodings = []
-                    dp_nodes = []
-                    dp_hints_sqls = []
-                    dp_join = []
-                    for join in EnumerateJoinWithOps(
-                            l,
-                            r,
-                            self.join_ops,
-                            self.scan_ops,
-                            use_plan_restrictions=self.use_plan_restrictions
-                    ):
-                        join_conds = join.KeepRelevantJoins(all_join_conds)
-                        cost, sql, hint = self.cost_model(join, join_conds)
-                        logcost = math.log(cost)
-                        data = encoding.getencoding_Balsa(sql, hint, workload)
-                        dp_join.append(join)
-                        dp_costs.append(logcost)
-                        dp_query_encodings.append(data[0])
-                        dp_nodes.append(data[1])
-                        dp_hints_sqls.append([hint, sql])
-                        assert len(data) == 2
-                    if not FirstTrain:
-                        query_feats = (torch.cat(dp_query_encodings, dim=0)).to(DEVICE)
-                        trees, indexes = TreeConvFeaturize(nodeFeaturizer, dp_nodes)
-                        if torch.cuda.is_available():
-                            trees = trees.to(DEVICE)
-                            indexes = indexes.to(DEVICE)
-                            torch_dpcosts = (torch.tensor(dp_costs)).to(DEVICE)
-                        costbais = torch.tanh(model[level](query_feats, trees, indexes).to(DEVICE)).add(1).squeeze(1)
-                        costlist = torch.mul(costbais, torch_dpcosts).tolist()
-                    else:
-                        costlist = dp_costs
-                    #                        for i in range(0,len(costlist)):
-                    #                            if (random.random()<greedy):
-                    #                                tem = []
-                    #                                tem.append(dp_costs[i])
-                    #                                tem.append(dp_hints_sqls[i][1])
-                    #                                tem.append(dp_hints_sqls[i][0])
-                    #                                # # # collect train data (latency)
-                    #                                usebuffer = False
-                    #                                for j in exp[level]:
-                    #                                    if (j[2] == dp_hints_sqls[i][0] and j[1] == dp_hints_sqls[i][1]):
-                    #                                        usebuffer = True
-                    #                                        glatency = j[3]
-                    #                                        # print('use buffer')
-                    #                                        break
-                    #                                if (usebuffer == False):
-                    #                                    num = num + 1
-                    #                                    glatency = postgres.GetLatencyFromPg(dp_hints_sqls[i][1], dp_hints_sqls[i][0], verbose=False, check_hint_used=False,
-                    #                                                                       timeout=timeout, dropbuffer=dropbuffer)
-                    #                                    tem.append(glatency)
-                    #                                    tem.append([dp_query_encodings[i],dp_nodes[i]])
-                    #                                    exp[level].append(tem)
-                    #                                    trainBuffer[level].append(tem)
-                    # print(costlist)
-                    for i in range(0, len(costlist)):
-                        if join_ids not in dp_table or dp_table[join_ids][
-                            0] > costlist[i]:
-                            tem = []
-                            tem.append(dp_costs[i])
-                            tem.append(dp_hints_sqls[i][1])
-                            tem.append(dp_hints_sqls[i][0])
-                            # # # collect train data (latency)
-                            usebuffer = False
-                            for j in exp[level]:
-                                if (j[2] == dp_hints_sqls[i][0] and j[1] == dp_hints_sqls[i][1]):
-                                    usebuffer = True
-                                    latency = j[3]
-                                    # print('use buffer')
-                                    break
-                            if (usebuffer == False):
-                                num = num + 1
-                                latency = postgres.GetLatencyFromPg(dp_hints_sqls[i][1], dp_hints_sqls[i][0],
-                                                                    verbose=False, check_hint_used=False,
-                                                                    timeout=timeout, dropbuffer=dropbuffer)
-                                # latency = random.random()
-                                tem.append(latency)
-                                tem.append([dp_query_encodings[i], dp_nodes[i]])
-                                exp[level].append(tem)
-                                trainBuffer[level].append(tem)
-                            dp_table[join_ids] = (costlist[i], dp_join[i])
-            #  nowplansnum = nowplansnum + 1
-            #   if nowplansnum > limit and level > 2:
-            #   print('plan nums = ',num)
-            #    break
-            if level > 3 and level < 14:
-                sortlist = dict(sorted(dp_table.items(), key=lambda x: x[1][0])[:math.ceil(len(dp_table) * 0.3)])
-                dp_tables[level] = sortlist
-        if timeout > latency:
-            timeout = latency
-        bestplanhint = list(dp_tables[num_rels].values())[0][1].hint_str()
-        return trainBuffer, bestplanhint, num, timeout
+        query = DPQuery(self, join_graph, all_join_conds, query_leaves, dp_tables, workload, model,
+                        nodeFeaturizer, exp=exp, FirstTrain=FirstTrain, timeout=timeout, dropbuffer=dropbuffer)
+        stages = DPStages(scoring=CalibratedScoring(num_samples=1),
+                          collect=LatencyCollection(when='always', slack=None, count=True),
+                          prune=LevelPruning(3, 14, top_offset=None, rescore=None))
+        return self._RunTrainingDP(query, stages, final_latency='last')
 
     def UCB_left_KL_prune(self, join_graph, all_join_conds, query_leaves, dp_tables, workload, exp, FirstTrain,
                           model, timeout, dropbuffer, nodeFeaturizer, greedy, subplans_fin, finsql, levelList):
-        num_rels = len(query_leaves)
-        num = 0
-        latency = 0
-        for i in range(0, num_rels + 1):
-            trainBuffer.append([])
-        for level in range(2, num_rels + 1):
-            dp_table = dp_tables[level]
-            bayes_tep = []
-            bayes_list = []
-            dp_table_i = random_dic(dp_tables[level - 1])
-            dp_table_j = random_dic(dp_tables[1])
-            # 按层维护一个字典，字典key为等价类的表名，value为list，存不同的plan的信息
-            # [  [ {},{} ....], [ {}...] ....]
-            # levelList[level]={}
-            for l_ids, l_tup in dp_table_i.items():
-                for r_ids, r_tup in dp_table_j.items():
-                    l = l_tup[1]
-                    r = r_tup[1]
-                    if not plans_lib.ExistsJoinEdgeInGraph(
-                            l, r, join_graph):
-                        # No join clause linking two sides.  Skip.
-                        continue
-                    l_ids_splits = l_ids.split(',')
-                    r_ids_splits = r_ids.split(',')
-                    if len(np.intersect1d(l_ids_splits, r_ids_splits)) > 0:
-                        # A relation exists in both sides.  Skip.
-                        continue
-                    join_ids = ','.join(sorted(l_ids_splits + r_ids_splits))
-                    # Otherwise, form a new join.
-                    dp_costs = []
-                    dp_query_encodings = []
-                    dp_nodes = []
-                    dp_hints_sqls = []
-                    dp_join = []
-                    for join in EnumerateJoinWithOps(
-                            l,
-                            r,
-                            self.join_ops,
-                            self.scan_ops,
-                            use_plan_restrictions=self.use_plan_restrictions
-                    ):
-                        join.info["currentLevel"] = level
-
-                        join_conds = join.KeepRelevantJoins(all_join_conds)
-                        cost, sql, hint = self.cost_model(join, join_conds)
-                        join.info["cost"] = cost
-                        logcost = math.log(cost)
-                        data = encoding.getencoding_Balsa(sql, hint, workload)
-                        join.info["encoding"] = data[0]
-                        join.info["node"] = data[1]
-                        dp_join.append(join)
-                        dp_costs.append(logcost)
-                        dp_query_encodings.append(data[0])
-                        dp_nodes.append(data[1])
-                        dp_hints_sqls.append([hint, sql])
-                        tem = []
-                        tem.append(logcost)
-                        tem.append(sql)
-                        tem.append(hint)
-                        tem.append(0)
-                        tem.append([data[0], data[1]])
-
-                        bayes_tep.append(tem)
-                        assert len(data) == 2
-                    levelList[level][join_ids] = [dp_costs, dp_query_encodings, dp_nodes]
-                    if not FirstTrain:
-                        query_feats = (torch.cat(dp_query_encodings, dim=0)).to(DEVICE)
-                        trees, indexes = TreeConvFeaturize(nodeFeaturizer, dp_nodes)
-                        if torch.cuda.is_available():
-                            trees = trees.to(DEVICE)
-                            indexes = indexes.to(DEVICE)
-                            torch_dpcosts = (torch.tensor(dp_costs)).to(DEVICE)
-                        costbais = []
-                        for i in range(10):
-                            costbais.append(torch.tanh(model[level](query_feats, trees, indexes).to(DEVICE)).add(1))
-                        costbais = torch.cat(costbais, 1)
-                        costbais_mean = torch.mean(costbais, dim=1)
-                        cost_min, _ = torch.min(costbais, dim=1)
-                        var = torch.sum(torch.pow(costbais - costbais_mean.unsqueeze(1), 2), dim=1)
-                        ucb = var / var.max() - cost_min / cost_min.max()
-                        # print('ucb ')
-                        # print(ucb)
-                        bayes_list.extend(ucb.tolist())
-                        costlist = torch.mul(costbais_mean, torch_dpcosts).tolist()
-                    else:
-                        costlist = dp_costs
-                    #                        for i in range(0,len(costlist)):
-                    #                            if (random.random()<greedy):
-                    #                                tem = []
-                    #                                tem.append(dp_costs[i])
-                    #                                tem.append(dp_hints_sqls[i][1])
-                    #                                tem.append(dp_hints_sqls[i][0])
-                    #                                # # # collect train data (latency)
-                    #                                usebuffer = False
-                    #                                for j in exp[level]:
-                    #                                    if (j[2] == dp_hints_sqls[i][0] and j[1] == dp_hints_sqls[i][1]):
-                    #                                        usebuffer = True
-                    #                                        glatency = j[3]
-                    #                                        # print('use buffer')
-                    #                                        break
-                    #                                if (usebuffer == False):
-                    #                                    num = num + 1
-                    #                                    glatency = postgres.GetLatencyFromPg(dp_hints_sqls[i][1], dp_hints_sqls[i][0], verbose=False, check_hint_used=False,
-                    #                                                                       timeout=timeout, dropbuffer=dropbuffer)
-                    #                                    tem.append(glatency)
-                    #                                    tem.append([dp_query_encodings[i],dp_nodes[i]])
-                    #                                    exp[level].append(tem)
-                    #                                    trainBuffer[level].append(tem)
-                    # print(costlist)
-                    for i in range(0, len(costlist)):
-                        if join_ids not in dp_table or dp_table[join_ids][
-                            0] > costlist[i]:
-                            if FirstTrain:
-                                tem = []
-                                tem.append(dp_costs[i])
-                                tem.append(dp_hints_sqls[i][1])
-                                tem.append(dp_hints_sqls[i][0])
-                                # # # collect train data (latency)
-                                usebuffer = False
-                                for j in exp[level]:
-                                    if (j[2] == dp_hints_sqls[i][0] and j[1] == dp_hints_sqls[i][1]):
-                                        usebuffer = True
-                                        latency = j[3]
-                                        dp_nodes[i].info["latency"] = latency
-                                        # print('use buffer')
-                                        break
-                                if (usebuffer == False):
-                                    num = num + 1
-                                    if ((level > num_rels - 1) and slackTimeout(exp[level])):
-                                        latency = postgres.GetLatencyFromPg(dp_hints_sqls[i][1], dp_hints_sqls[i][0],
-                                                                            verbose=False, check_hint_used=False,
-                                                                            timeout=12000, dropbuffer=dropbuffer)
-                                        print("slack")
-                                        #                                   else:
-                                        #                                          latency =postgres.GetLatencyFromPg(dp_hints_sqls[i][1], dp_hints_sqls[i][0], verbose=False, check_hint_used=False,timeout=timeout*2.0, dropbuffer=dropbuffer)
-                                        print(latency, 'level', level)
-                                    else:
-                                        latency = postgres.GetLatencyFromPg(dp_hints_sqls[i][1], dp_hints_sqls[i][0],
-                                                                            verbose=False, check_hint_used=False,
-                                                                            timeout=timeout, dropbuffer=dropbuffer)
-                                    # latency = random.random()
-                                    dp_nodes[i].info["latency"] = latency
-                                    tem.append(latency)
-                                    tem.append([dp_query_encodings[i], dp_nodes[i]])
-                                    exp[level].append(tem)
-                                    trainBuffer[level].append(tem)
-                                    if level == num_rels:
-                                        allPlans = [dp_nodes[i]]
-                                        while (allPlans):
-                                            currentNode = allPlans.pop()
-                                            allPlans.extend(currentNode.children)
-                                            for currentChild in currentNode.children:
-                                                temlevel = currentChild.info.get("currentLevel")
-                                                if (not temlevel == None) and temlevel > 1:
-                                                    #  print(currentChild)
-                                                    temsql = currentChild.to_sql(currentChild.info["join_conds"],
-                                                                                 with_select_exprs=True)
-                                                    #    print(temsql)
-                                                    temhint = currentChild.hint_str()
-                                                    found = False
-                                                    for i in subplans_fin:
-                                                        if (i[1] == dp_hints_sqls[i][1], i[2] == dp_hints_sqls[i][0]):
-                                                            found = True
-                                                            break
-                                                    if not found:
-                                                        tem = []
-                                                        tem.append(currentChild.info["cost"])
-                                                        tem.append(temsql)
-                                                        tem.append(temhint)
-                                                        tem.append(currentChild.info["latency"])
-                                                        tem.append([currentChild.info["encoding"], currentChild])
-                                                        subplans_fin[temlevel].append(tem)
-                            dp_table[join_ids] = (costlist[i], dp_join[i])
-            #  nowplansnum = nowplansnum + 1
-            #   if nowplansnum > limit and level > 2:
-            #   print('plan nums = ',num)
-            #    break
-            # print('num = ',len(dp_table))
-            # todo:根据方差收集数据
-
-            if not FirstTrain:
-                # print('bayes_list len :',len(bayes_list))
-                # print('bayes tep num :',len(bayes_tep))
-                bayes_list = torch.tensor(bayes_list)
-                ucb_argsort = torch.argsort(bayes_list, descending=True)
-                if level < 4:
-                    p = 0.4
-                else:
-                    p = 0.2
-                n = math.ceil(p * len(bayes_tep))
-                for i in range(n):
-                    bayes_plan = bayes_tep[ucb_argsort[i]]
-                    usebuffer = False
-                    for j in exp[level]:
-                        if (j[2] == bayes_plan[2] and j[1] == bayes_plan[1]):
-                            usebuffer = True
-                            blatency = j[3]
-                            break
-                    if (usebuffer == False):
-                        num = num + 1
-                        if ((level > num_rels - 1) and slackTimeout(exp[level])):
-                            blatency = postgres.GetLatencyFromPg(bayes_plan[1], bayes_plan[2], verbose=False,
-                                                                 check_hint_used=False, timeout=12000,
-                                                                 dropbuffer=dropbuffer)
-                            print("slack")
-                            #                                   else:
-                            #                                          latency =postgres.GetLatencyFromPg(dp_hints_sqls[i][1], dp_hints_sqls[i][0], verbose=False, check_hint_used=False,timeout=timeout*2.0, dropbuffer=dropbuffer)
-                            print(latency, 'level', level)
-                        else:
-                            blatency = postgres.GetLatencyFromPg(bayes_plan[1], bayes_plan[2], verbose=False,
-                                                                 check_hint_used=False, timeout=timeout,
-                                                                 dropbuffer=dropbuffer)
-                    bayes_plan[3] = blatency
-                    if usebuffer == False:
-                        trainBuffer[level].append(copy.deepcopy(bayes_plan))
-                        exp[level].append(copy.deepcopy(bayes_plan))
-
-            if level > 4 and level < 15 and level < num_rels:
-                temtable = copy.deepcopy(dp_table)
-                if not FirstTrain:
-                    temcost = []
-                    temnodes = []
-                    tem_query_encodings = []
-                    for key, values in temtable.items():
-                        temcost.append(values[0])
-                        temnodes.append(values[1].info["node"])
-                        tem_query_encodings.append(values[1].info["encoding"])
-                    #  print("nodes num = ",len(temnodes))
-                    temquery_feats = (torch.cat(tem_query_encodings, dim=0)).to(DEVICE)
-                    temtrees, temindexes = TreeConvFeaturize(nodeFeaturizer, temnodes)
-                    if torch.cuda.is_available():
-                        temtrees = temtrees.to(DEVICE)
-                        temindexes = temindexes.to(DEVICE)
-                        torch_costs = (torch.tensor(temcost)).to(DEVICE)
-                    temcostbais = []
-                    for i in range(10):
-                        temcostbais.append(
-                            torch.tanh(model[-1](temquery_feats, temtrees, temindexes).to(DEVICE)).add(1))
-                    temcostbais = torch.cat(temcostbais, 1)
-                    temcostbais_mean = torch.mean(temcostbais, dim=1)
-                    temcostlist = torch.mul(temcostbais_mean, torch_costs).tolist()
-                    count = 0
-                    for key in temtable:
-                        temtable[key] = (temcostlist[count], temtable[key][1])
-                        count = count + 1
-                sortlist = dict(sorted(temtable.items(), key=lambda x: x[1][0])[math.ceil(len(dp_table) * 0.3):])
-                for key in sortlist:
-                    dp_table.pop(key)
-                dp_tables[level] = dp_table
-        # print('level:',level,'subplans num = ',len(dp_tables[level]))
-        # print('level:',level,'exp num = ',len(exp[level]))
-        bestplanhint = list(dp_tables[num_rels].values())[0][1].hint_str()
-        nowlatency = postgres.GetLatencyFromPg(finsql, bestplanhint, verbose=False, check_hint_used=False,
-                                               timeout=timeout, dropbuffer=dropbuffer)
-        if timeout > nowlatency:
-            timeout = nowlatency
-        return trainBuffer, bestplanhint, num, timeout
+        # 按层维护一个字典，字典key为等价类的表名，value为list，存不同的plan的信息
+        def RecordLevelList(query, candidates):
+            levelList[candidates.level][candidates.join_ids] = [candidates.costs, candidates.query_encodings,
+                                                                candidates.nodes]
+
+        query = DPQuery(self, join_graph, all_join_conds, query_leaves, dp_tables, workload, model,
+                        nodeFeaturizer, exp=exp, FirstTrain=FirstTrain, timeout=timeout, dropbuffer=dropbuffer)
+        stages = DPStages(scoring=CalibratedScoring(num_samples=10, priority='ucb'),
+                          explore=UcbExploration(fraction=0.2, low_level_fraction=0.4, per_level=True),
+                          collect=LatencyCollection(count=True),
+                          prune=LevelPruning(4, 15, num_samples=10),
+                          on_pair=[RecordLevelList])
+        return self._RunTrainingDP(query, stages, finsql)
 
     def _batch_DP_level_left_prune(self, join_graph, all_join_conds, query_leaves, dp_tables, workload, exp, FirstTrain,
                                    model, timeout, dropbuffer, nodeFeaturizer, greedy, subplans_fin):
-        num_rels = len(query_leaves)
-        num = 0
-        latency = 0
-        for i in range(0, num_rels + 1):
-            trainBuffer.append([])
-        for level in range(2, num_rels + 1):
-            dp_table = dp_tables[level]
-            # for level_i in range(1, level):
-            # level_j = level - level_i
-            dp_table_i = random_dic(dp_tables[level - 1])
-            dp_table_j = random_dic(dp_tables[1])
-            # limit = int(len(dp_table_i) * 0.2)
-            #    nowplansnum = 0
-            for l_ids, l_tup in dp_table_i.items():
-                for r_ids, r_tup in dp_table_j.items():
-                    l = l_tup[1]
-                    r = r_tup[1]
-                    if not plans_lib.ExistsJoinEdgeInGraph(
-                            l, r, join_graph):
-                        # No join clause linking two sides.  Skip.
-                        continue
-                    l_ids_splits = l_ids.split(',')
-                    r_ids_splits = r_ids.split(',')
-                    if len(np.intersect1d(l_ids_splits, r_ids_splits)) > 0:
-                        # A relation exists in both sides.  Skip.
-                        continue
-                    join_ids = ','.join(sorted(l_ids_splits + r_ids_splits))
-                    # Otherwise, form a new join.
-                    dp_costs = []
-                    dp_query_encodings = []
-                    dp_nodes = []
-                    dp_hints_sqls = []
-                    dp_join = []
-                    for join in EnumerateJoinWithOps(
-                            l,
-                            r,
-                            self.join_ops,
-                            self.scan_ops,
-                            use_plan_restrictions=self.use_plan_restrictions
-                    ):
-                        join.info["currentLevel"] = level
-
-                        join_conds = join.KeepRelevantJoins(all_join_conds)
-                        join.info["join_conds"] = join_conds
-
-                        cost, sql, hint = self.cost_model(join, join_conds)
-                        join.info["cost"] = cost
-                        logcost = math.log(cost)
-                        data = encoding.getencoding_Balsa(sql, hint, workload)
-                        join.info["encoding"] = data[0]
-                        join.info["node"] = data[1]
-                        dp_join.append(join)
-                        dp_costs.append(logcost)
-                        dp_query_encodings.append(data[0])
-                        dp_nodes.append(data[1])
-                        dp_hints_sqls.append([hint, sql])
-                        assert len(data) == 2
-                    if not FirstTrain:
-                        query_feats = (torch.cat(dp_query_encodings, dim=0)).to(DEVICE)
-                        trees, indexes = TreeConvFeaturize(nodeFeaturizer, dp_nodes)
-                        if torch.cuda.is_available():
-                            trees = trees.to(DEVICE)
-                            indexes = indexes.to(DEVICE)
-                            torch_dpcosts = (torch.tensor(dp_costs)).to(DEVICE)
-                        costbais = torch.tanh(model[level](query_feats, trees, indexes).to(DEVICE)).add(1).squeeze(1)
-                        costlist = torch.mul(costbais, torch_dpcosts).tolist()
-                    else:
-                        costlist = dp_costs
-                    #                        for i in range(0,len(costlist)):
-                    #                            if (random.random()<greedy):
-                    #                                tem = []
-                    #                                tem.append(dp_costs[i])
-                    #                                tem.append(dp_hints_sqls[i][1])
-                    #                                tem.append(dp_hints_sqls[i][0])
-                    #                                # # # collect train data (latency)
-                    #                                usebuffer = False
-                    #                                for j in exp[level]:
-                    #                                    if (j[2] == dp_hints_sqls[i][0] and j[1] == dp_hints_sqls[i][1]):
-                    #                                        usebuffer = True
-                    #                                        glatency = j[3]
-                    #                                        # print('use buffer')
-                    #                                        break
-                    #                                if (usebuffer == False):
-                    #                                    num = num + 1
-                    #                                    glatency = postgres.GetLatencyFromPg(dp_hints_sqls[i][1], dp_hints_sqls[i][0], verbose=False, check_hint_used=False,
-                    #                                                                       timeout=timeout, dropbuffer=dropbuffer)
-                    #                                    tem.append(glatency)
-                    #                                    tem.append([dp_query_encodings[i],dp_nodes[i]])
-                    #                                    exp[level].append(tem)
-                    #                                    trainBuffer[level].append(tem)
-                    # print(costlist)
-                    for i in range(0, len(costlist)):
-                        if join_ids not in dp_table or dp_table[join_ids][
-                            0] > costlist[i]:
-                            tem = []
-                            tem.append(dp_costs[i])
-                            tem.append(dp_hints_sqls[i][1])
-                            tem.append(dp_hints_sqls[i][0])
-                            # # # collect train data (latency)
-                            usebuffer = False
-                            for j in exp[level]:
-                                if (j[2] == dp_hints_sqls[i][0] and j[1] == dp_hints_sqls[i][1]):
-                                    usebuffer = True
-                                    latency = j[3]
-                                    dp_nodes[i].info["latency"] = latency
-                                    # print('use buffer')
-                                    break
-                            if (usebuffer == False):
-                                num = num + 1
-                                if ((level > num_rels - 1) and slackTimeout(exp[level])):
-                                    latency = postgres.GetLatencyFromPg(dp_hints_sqls[i][1], dp_hints_sqls[i][0],
-                                                                        verbose=False, check_hint_used=False,
-                                                                        timeout=12000, dropbuffer=dropbuffer)
-                                    print("slack")
-                                    #                                   else:
-                                    #                                          latency =postgres.GetLatencyFromPg(dp_hints_sqls[i][1], dp_hints_sqls[i][0], verbose=False, check_hint_used=False,timeout=timeout*2.0, dropbuffer=dropbuffer)
-                                    print(latency, 'level', level)
-                                else:
-                                    latency = postgres.GetLatencyFromPg(dp_hints_sqls[i][1], dp_hints_sqls[i][0],
-                                                                        verbose=False, check_hint_used=False,
-                                                                        timeout=timeout, dropbuffer=dropbuffer)
-                                # latency = random.random()
-                                dp_nodes[i].info["latency"] = latency
-                                tem.append(latency)
-                                tem.append([dp_query_encodings[i], dp_nodes[i]])
-                                exp[level].append(tem)
-                                trainBuffer[level].append(tem)
-                                if level == num_rels:
-                                    allPlans = [dp_nodes[i]]
-                                    while (allPlans):
-                                        currentNode = allPlans.pop()
-                                        allPlans.extend(currentNode.children)
-                                        for currentChild in currentNode.children:
-                                            temlevel = currentChild.info.get("currentLevel")
-                                            if (not temlevel == None) and temlevel > 1:
-                                                #  print(currentChild)
-                                                temsql = currentChild.to_sql(currentChild.info["join_conds"],
-                                                                             with_select_exprs=True)
-                                                #    print(temsql)
-                                                temhint = currentChild.hint_str()
-                                                found = False
-                                                for i in subplans_fin:
-                                                    if (i[1] == dp_hints_sqls[i][1], i[2] == dp_hints_sqls[i][0]):
-                                                        found = True
-                                                        break
-                                                if not found:
-                                                    tem = []
-                                                    tem.append(currentChild.info["cost"])
-                                                    tem.append(temsql)
-                                                    tem.append(temhint)
-                                                    tem.append(currentChild.info["latency"])
-                                                    tem.append([currentChild.info["encoding"], currentChild])
-                                                    subplans_fin[temlevel].append(tem)
-                            dp_table[join_ids] = (costlist[i], dp_join[i])
-            #  nowplansnum = nowplansnum + 1
-            #   if nowplansnum > limit and level > 2:
-            #   print('plan nums = ',num)
-            #    break
-            # print('num = ',len(dp_table))
-            if level > 4 and level < 15 and level < num_rels:
-                temtable = copy.deepcopy(dp_table)
-                if not FirstTrain:
-
-                    temcost = []
-                    temnodes = []
-                    tem_query_encodings = []
-                    for key, values in temtable.items():
-                        temcost.append(values[0])
-                        temnodes.append(values[1].info["node"])
-                        tem_query_encodings.append(values[1].info["encoding"])
-                    #  print("nodes num = ",len(temnodes))
-                    temquery_feats = (torch.cat(tem_query_encodings, dim=0)).to(DEVICE)
-                    temtrees, temindexes = TreeConvFeaturize(nodeFeaturizer, temnodes)
-                    if torch.cuda.is_available():
-                        temtrees = temtrees.to(DEVICE)
-                        temindexes = temindexes.to(DEVICE)
-                        torch_costs = (torch.tensor(temcost)).to(DEVICE)
-                    temcostbais = torch.tanh(model[-1](temquery_feats, temtrees, temindexes).to(DEVICE)).add(1).squeeze(
-                        1)
-                    temcostlist = torch.mul(temcostbais, torch_costs).tolist()
-                    count = 0
-
-                    for key in temtable:
-                        temtable[key] = (temcostlist[count], temtable[key][1])
-                        count = count + 1
-                sortlist = dict(sorted(temtable.items(), key=lambda x: x[1][0])[math.ceil(len(dp_table) * 0.3):])
-                for key in sortlist:
-                    dp_table.pop(key)
-                dp_tables[level] = dp_table
-            print('level:', level, 'subplans num = ', len(dp_tables[level]))
-            print('level:', level, 'exp num = ', len(exp[level]))
-        if timeout > latency:
-            timeout = latency
-        bestplanhint = list(dp_tables[num_rels].values())[0][1].hint_str()
-        return trainBuffer, bestplanhint, num, timeout
+        query = DPQuery(self, join_graph, all_join_conds, query_leaves, dp_tables, workload, model,
+                        nodeFeaturizer, exp=exp, FirstTrain=FirstTrain, timeout=timeout, dropbuffer=dropbuffer)
+        stages = DPStages(scoring=CalibratedScoring(num_samples=1),
+                          collect=LatencyCollection(when='always', count=True),
+                          prune=LevelPruning(4, 15, num_samples=1))
+        return self._RunTrainingDP(query, stages, final_latency='last')
 
     def UCB_left_prune(self, join_graph, all_join_conds, query_leaves, dp_tables, workload, exp, FirstTrain,
                        model, timeout, dropbuffer, nodeFeaturizer, greedy, subplans_fin, finsql, costCache):
-        num_rels = len(query_leaves)
-        num = 0
-        latency = 0
-        for i in range(0, num_rels + 1):
-            trainBuffer.append([])
-        for level in range(2, num_rels + 1):
-            dp_table = dp_tables[level]
-            bayes_tep = []
-            bayes_list = []
-            dp_table_i = random_dic(dp_tables[level - 1])
-            dp_table_j = random_dic(dp_tables[1])
-            for l_ids, l_tup in dp_table_i.items():
-                for r_ids, r_tup in dp_table_j.items():
-                    l = l_tup[1]
-                    r = r_tup[1]
-                    if not plans_lib.ExistsJoinEdgeInGraph(
-                            l, r, join_graph):
-                        # No join clause linking two sides.  Skip.
-                        continue
-                    l_ids_splits = l_ids.split(',')
-                    r_ids_splits = r_ids.split(',')
-                    if len(np.intersect1d(l_ids_splits, r_ids_splits)) > 0:
-                        # A relation exists in both sides.  Skip.
-                        continue
-                    join_ids = ','.join(sorted(l_ids_splits + r_ids_splits))
-                    # Otherwise, form a new join.
-                    dp_costs = []
-                    dp_query_encodings = []
-                    dp_nodes = []
-                    dp_hints_sqls = []
-                    dp_join = []
-                    for join in EnumerateJoinWithOps(
-                            l,
-                            r,
-                            self.join_ops,
-                            self.scan_ops,
-                            use_plan_restrictions=self.use_plan_restrictions
-                    ):
-                        join.info["currentLevel"] = level
-
-                        join_conds = join.KeepRelevantJoins(all_join_conds)
-                        join.info["join_conds"] = join_conds
-
-                        cost, sql, hint = self.cost_model.getCost_cache(join, join_conds, costCache)
-                        join.info["cost"] = cost
-                        logcost = math.log(cost)
-                        data = encoding.getencoding_Balsa(sql, hint, workload)
-                        join.info["encoding"] = data[0]
-                        join.info["node"] = data[1]
-                        dp_join.append(join)
-                        dp_costs.append(logcost)
-                        dp_query_encodings.append(data[0])
-                        dp_nodes.append(data[1])
-                        dp_hints_sqls.append([hint, sql])
-                        tem = []
-                        tem.append(logcost)
-                        tem.append(sql)
-                        tem.append(hint)
-                        tem.append(0)
-                        tem.append([data[0], data[1]])
-                        btem = copy.deepcopy(tem[:] + [join])
-                        bayes_tep.append(btem)
-                        assert len(data) == 2
-                    if not FirstTrain:
-                        query_feats = (torch.cat(dp_query_encodings, dim=0)).to(DEVICE)
-                        trees, indexes = TreeConvFeaturize(nodeFeaturizer, dp_nodes)
-                        if torch.cuda.is_available():
-                            trees = trees.to(DEVICE)
-                            indexes = indexes.to(DEVICE)
-                            torch_dpcosts = (torch.tensor(dp_costs)).to(DEVICE)
-                        model[level].train()
-                        costbais = []
-                        for i in range(10):
-                            costbais.append(torch.tanh(model[level](query_feats, trees, indexes).to(DEVICE)).add(1))
-                        costbais = torch.cat(costbais, 1)
-                        costbais_mean = torch.mean(costbais, dim=1)
-                        cost_min, _ = torch.min(costbais, dim=1)
-                        var = torch.sum(torch.pow(costbais - costbais_mean.unsqueeze(1), 2), dim=1)
-                        ucb = var / var.max() - cost_min / cost_min.max()
-                        # print('ucb ')
-                        # print(ucb)
-                        bayes_list.extend(ucb.tolist())
-                        costlist = torch.mul(costbais_mean, torch_dpcosts).tolist()
-                    else:
-                        costlist = dp_costs
-                    for i in range(0, len(costlist)):
-                        if join_ids not in dp_table or dp_table[join_ids][
-                            0] > costlist[i]:
-                            if FirstTrain:
-                                tem = []
-                                tem.append(dp_costs[i])
-                                tem.append(dp_hints_sqls[i][1])
-                                tem.append(dp_hints_sqls[i][0])
-                                # # # collect train data (latency)
-                                usebuffer = False
-                                for j in exp[level]:
-                                    if (j[2] == dp_hints_sqls[i][0] and j[1] == dp_hints_sqls[i][1]):
-                                        usebuffer = True
-                                        latency = j[3]
-                                        dp_nodes[i].info["latency"] = latency
-                                        break
-                                if (usebuffer == False):
-                                    if ((level > num_rels - 1) and slackTimeout(exp[level])):
-                                        latency = postgres.GetLatencyFromPg(dp_hints_sqls[i][1], dp_hints_sqls[i][0],
-                                                                            verbose=False, check_hint_used=False,
-                                                                            timeout=12000, dropbuffer=dropbuffer)
-                                    else:
-                                        latency = postgres.GetLatencyFromPg(dp_hints_sqls[i][1], dp_hints_sqls[i][0],
-                                                                            verbose=False, check_hint_used=False,
-                                                                            timeout=timeout, dropbuffer=dropbuffer)
-                                    dp_nodes[i].info["latency"] = latency
-                                    dp_join[i].info["latency"] = latency
-                                    tem.append(latency)
-                                    tem.append([dp_query_encodings[i], dp_nodes[i]])
-                                    exp[level].append(tem)
-                                    trainBuffer[level].append(tem)
-                                    if level == num_rels:
-                                        pass
-                                        # collectSubplans(dp_join[i],subplans_fin,num_rels,workload)
-
-                            dp_table[join_ids] = (costlist[i], dp_join[i])
-            # todo:根据方差收集数据
-
-            if not FirstTrain:
-                # print('bayes_list len :',len(bayes_list))
-                # print('bayes tep num :',len(bayes_tep))
-                bayes_list = torch.tensor(bayes_list)
-                ucb_argsort = torch.argsort(bayes_list, descending=True)
-                if level < 4:
-                    p = 0.25
-                else:
-                    p = 0.1
-                n = math.ceil(p * len(bayes_tep))
-                for i in range(n):
-                    bayes_plan = bayes_tep[ucb_argsort[i]]
-                    usebuffer = False
-                    for j in exp[level]:
-                        if (j[2] == bayes_plan[2] and j[1] == bayes_plan[1]):
-                            usebuffer = True
-                            blatency = j[3]
-                            break
-                    if (usebuffer == False):
-                        num = num + 1
-                        if ((level > num_rels - 1) and slackTimeout(exp[level])):
-                            blatency = postgres.GetLatencyFromPg(bayes_plan[1], bayes_plan[2], verbose=False,
-                                                                 check_hint_used=False, timeout=12000,
-                                                                 dropbuffer=dropbuffer)
-                        else:
-                            blatency = postgres.GetLatencyFromPg(bayes_plan[1], bayes_plan[2], verbose=False,
-                                                                 check_hint_used=False, timeout=timeout,
-                                                                 dropbuffer=dropbuffer)
-                    bayes_plan[3] = blatency
-                    bayes_plan[4][1].info["latency"] = blatency
-                    bayes_plan[5].info["latency"] = blatency
-                    if usebuffer == False:
-                        trainBuffer[level].append(copy.deepcopy(bayes_plan))
-                        exp[level].append(copy.deepcopy(bayes_plan))
-                        if level == num_rels:
-                            pass
-                        # collectSubplans(bayes_plan[5],subplans_fin,num_rels,workload)
-            if level > 4 and level < 15 and level < num_rels:
-                temtable = copy.deepcopy(dp_table)
-                if not FirstTrain:
-                    temcost = []
-                    temnodes = []
-                    tem_query_encodings = []
-                    for key, values in temtable.items():
-                        temcost.append(values[0])
-                        temnodes.append(values[1].info["node"])
-                        tem_query_encodings.append(values[1].info["encoding"])
-                    #  print("nodes num = ",len(temnodes))
-                    temquery_feats = (torch.cat(tem_query_encodings, dim=0)).to(DEVICE)
-                    temtrees, temindexes = TreeConvFeaturize(nodeFeaturizer, temnodes)
-                    if torch.cuda.is_available():
-                        temtrees = temtrees.to(DEVICE)
-                        temindexes = temindexes.to(DEVICE)
-                        torch_costs = (torch.tensor(temcost)).to(DEVICE)
-                    model[num_rels].eval()
-                    temcostbais = model[num_rels](temquery_feats, temtrees, temindexes).to(DEVICE).add(1)
-                    #                    temcostbais = []
-                    #                    for i in range(10):
-                    #                        temcostbais.append(
-                    #                            torch.tanh(model[-1](temquery_feats, temtrees, temindexes).to(DEVICE)).add(1))
-                    #                    temcostbais = torch.cat(temcostbais, 1)
-                    #                    temcostbais = torch.mean(temcostbais, dim=1)
-                    temcostlist = torch.mul(temcostbais, torch_costs).tolist()
-                    count = 0
-                    for key in temtable:
-                        temtable[key] = (temcostlist[count], temtable[key][1])
-                        count = count + 1
-                sortlist = dict(sorted(temtable.items(), key=lambda x: x[1][0])[math.ceil(len(dp_table) * 0.3):])
-                for key in sortlist:
-                    dp_table.pop(key)
-                dp_tables[level] = dp_table
-        bestplanhint = list(dp_tables[num_rels].values())[0][1].hint_str()
-        nowlatency = postgres.GetLatencyFromPg(finsql, bestplanhint, verbose=False, check_hint_used=False,
-                                               timeout=timeout, dropbuffer=dropbuffer)
-        if timeout > nowlatency:
-            timeout = nowlatency
-
-        return trainBuffer, bestplanhint, num, timeout
+        query = DPQuery(self, join_graph, all_join_conds, query_leaves, dp_tables, workload, model,
+                        nodeFeaturizer, costCache=costCache, exp=exp, FirstTrain=FirstTrain, timeout=timeout,
+                        dropbuffer=dropbuffer)
+        stages = DPStages(scoring=CalibratedScoring(num_samples=10, train_mode=True, priority='ucb'),
+                          explore=UcbExploration(fraction=0.1, low_level_fraction=0.25, per_level=True),
+                          collect=LatencyCollection(),
+                          prune=LevelPruning(4, 15, rescore='raw'))
+        return self._RunTrainingDP(query, stages, finsql)
 
     def UCB_left_prune_replay(self, join_graph, all_join_conds, query_leaves, dp_tables, workload, exp, FirstTrain,
                               model, timeout, dropbuffer, nodeFeaturizer, greedy, subplans_fin, finsql, costCache,
                               dpsign):
-        num_rels = len(query_leaves)
-        num = 0
-        latency = 0
-        for i in range(0, num_rels + 1):
-            trainBuffer.append([])
-        for level in range(2, num_rels + 1):
-            dp_table = dp_tables[level]
-            bayes_tep = []
-            bayes_list = []
-            dp_table_i = random_dic(dp_tables[level - 1])
-            dp_table_j = random_dic(dp_tables[1])
-            for l_ids, l_tup in dp_table_i.items():
-                for r_ids, r_tup in dp_table_j.items():
-                    l = l_tup[1]
-                    r = r_tup[1]
-                    if not plans_lib.ExistsJoinEdgeInGraph(
-                            l, r, join_graph):
-                        # No join clause linking two sides.  Skip.
-                        continue
-                    l_ids_splits = l_ids.split(',')
-                    r_ids_splits = r_ids.split(',')
-                    if len(np.intersect1d(l_ids_splits, r_ids_splits)) > 0:
-                        # A relation exists in both sides.  Skip.
-                        continue
-                    join_ids = ','.join(sorted(l_ids_splits + r_ids_splits))
-                    # Otherwise, form a new join.
-                    dp_costs = []
-                    dp_query_encodings = []
-                    dp_nodes = []
-                    dp_hints_sqls = []
-                    dp_join = []
-                    for join in EnumerateJoinWithOps(
-                            l,
-                            r,
-                            self.join_ops,
-                            self.scan_ops,
-                            use_plan_restrictions=self.use_plan_restrictions
-                    ):
-                        join.info["currentLevel"] = level
-
-                        join_conds = join.KeepRelevantJoins(all_join_conds)
-                        join.info["join_conds"] = join_conds
-
-                        cost, sql, hint = self.cost_model.getCost_cache(join, join_conds, costCache)
-                        join.info["cost"] = cost
-                        logcost = math.log(cost)
-                        data = encoding.getencoding_Balsa(sql, hint, workload)
-                        join.info["encoding"] = data[0]
-                        join.info["node"] = data[1]
-                        dp_join.append(join)
-                        dp_costs.append(logcost)
-                        dp_query_encodings.append(data[0])
-                        dp_nodes.append(data[1])
-                        dp_hints_sqls.append([hint, sql])
-                        tem = []
-                        tem.append(logcost)
-                        tem.append(sql)
-                        tem.append(hint)
-                        tem.append(0)
-                        tem.append([data[0], data[1]])
-                        btem = copy.deepcopy(tem[:] + [join])
-                        bayes_tep.append(btem)
-                        assert len(data) == 2
-                    if not FirstTrain:
-                        query_feats = (torch.cat(dp_query_encodings, dim=0)).to(DEVICE)
-                        trees, indexes = TreeConvFeaturize(nodeFeaturizer, dp_nodes)
-                        if torch.cuda.is_available():
-                            trees = trees.to(DEVICE)
-                            indexes = indexes.to(DEVICE)
-                            torch_dpcosts = (torch.tensor(dp_costs)).to(DEVICE)
-                        model[level].train()
-                        costbais = []
-                        for i in range(10):
-                            costbais.append(torch.tanh(model[level](query_feats, trees, indexes).to(DEVICE)).add(1))
-                        costbais = torch.cat(costbais, 1)
-                        costbais_mean = torch.mean(costbais, dim=1)
-                        cost_min, _ = torch.min(costbais, dim=1)
-                        var = torch.sum(torch.pow(costbais - costbais_mean.unsqueeze(1), 2), dim=1)
-                        ucb = var / var.max() - cost_min / cost_min.max()
-                        # print('ucb ')
-                        # print(ucb)
-                        bayes_list.extend(ucb.tolist())
-                        costlist = torch.mul(costbais_mean, torch_dpcosts).tolist()
-                    else:
-                        costlist = dp_costs
-                    for i in range(0, len(costlist)):
-                        if join_ids not in dp_table or dp_table[join_ids][
-                            0] > costlist[i]:
-                            if FirstTrain or dpsign:
-                                tem = []
-                                tem.append(dp_costs[i])
-                                tem.append(dp_hints_sqls[i][1])
-                                tem.append(dp_hints_sqls[i][0])
-                                # # # collect train data (latency)
-                                usebuffer = False
-                                for j in exp[level]:
-                                    if (j[2] == dp_hints_sqls[i][0] and j[1] == dp_hints_sqls[i][1]):
-                                        usebuffer = True
-                                        latency = j[3]
-                                        dp_nodes[i].info["latency"] = latency
-                                        break
-                                coll = False
-                                if (usebuffer == False):
-                                    if (slackTimeout(exp[level])):
-                                        print('slack')
-                                        latency = postgres.GetLatencyFromPg(dp_hints_sqls[i][1], dp_hints_sqls[i][0],
-                                                                            verbose=False, check_hint_used=False,
-                                                                            timeout=12000, dropbuffer=dropbuffer)
-                                        coll = True
-                                    else:
-                                        if random.random() > 0.2:
-                                            latency = postgres.GetLatencyFromPg(dp_hints_sqls[i][1],
-                                                                                dp_hints_sqls[i][0],
-                                                                                verbose=False, check_hint_used=False,
-                                                                                timeout=timeout, dropbuffer=dropbuffer)
-                                            coll = True
-                                    if coll:
-                                        dp_nodes[i].info["latency"] = latency
-                                        dp_join[i].info["latency"] = latency
-                                        tem.append(latency)
-                                        tem.append([dp_query_encodings[i], dp_nodes[i]])
-                                        exp[level].append(tem)
-                                        trainBuffer[level].append(tem)
-                                    if level == num_rels:
-                                        pass
-                                        # collectSubplans(dp_join[i],subplans_fin,num_rels,workload)
-
-                            dp_table[join_ids] = (costlist[i], dp_join[i])
-            # todo:根据方差收集数据
-
-            if not FirstTrain and not dpsign:
-                # print('bayes_list len :',len(bayes_list))
-                # print('bayes tep num :',len(bayes_tep))
-                bayes_list = torch.tensor(bayes_list)
-                ucb_argsort = torch.argsort(bayes_list, descending=True)
-                if level < 4:
-                    p = 0.2
-                else:
-                    p = 0.1
-                n = math.ceil(p * len(bayes_tep))
-                for i in range(n):
-                    bayes_plan = bayes_tep[ucb_argsort[i]]
-                    usebuffer = False
-                    for j in exp[level]:
-                        if (j[2] == bayes_plan[2] and j[1] == bayes_plan[1]):
-                            usebuffer = True
-                            blatency = j[3]
-                            break
-                    if (usebuffer == False):
-                        num = num + 1
-                        if ((level > num_rels - 1) and slackTimeout(exp[level])):
-                            blatency = postgres.GetLatencyFromPg(bayes_plan[1], bayes_plan[2], verbose=False,
-                                                                 check_hint_used=False, timeout=12000,
-                                                                 dropbuffer=dropbuffer)
-                        else:
-                            blatency = postgres.GetLatencyFromPg(bayes_plan[1], bayes_plan[2], verbose=False,
-                                                                 check_hint_used=False, timeout=timeout,
-                                                                 dropbuffer=dropbuffer)
-                    bayes_plan[3] = blatency
-                    bayes_plan[4][1].info["latency"] = blatency
-                    bayes_plan[5].info["latency"] = blatency
-                    if usebuffer == False:
-                        trainBuffer[level].append(copy.deepcopy(bayes_plan))
-                        exp[level].append(copy.deepcopy(bayes_plan))
-                        if level == num_rels:
-                            pass
-                        # collectSubplans(bayes_plan[5],subplans_fin,num_rels,workload)
-            if level > 4 and level < 15 and level < num_rels - 1:
-                temtable = copy.deepcopy(dp_table)
-                if not FirstTrain:
-                    temcost = []
-                    temnodes = []
-                    tem_query_encodings = []
-                    for key, values in temtable.items():
-                        temcost.append(values[0])
-                        temnodes.append(values[1].info["node"])
-                        tem_query_encodings.append(values[1].info["encoding"])
-                    #  print("nodes num = ",len(temnodes))
-                    temquery_feats = (torch.cat(tem_query_encodings, dim=0)).to(DEVICE)
-                    temtrees, temindexes = TreeConvFeaturize(nodeFeaturizer, temnodes)
-                    if torch.cuda.is_available():
-                        temtrees = temtrees.to(DEVICE)
-                        temindexes = temindexes.to(DEVICE)
-                        torch_costs = (torch.tensor(temcost)).to(DEVICE)
-                    model[num_rels].eval()
-                    temcostbais = model[num_rels](temquery_feats, temtrees, temindexes).to(DEVICE).add(1)
-                    #                    temcostbais = []
-                    #                    for i in range(10):
-                    #                        temcostbais.append(
-                    #                            torch.tanh(model[-1](temquery_feats, temtrees, temindexes).to(DEVICE)).add(1))
-                    #                    temcostbais = torch.cat(temcostbais, 1)
-                    #                    temcostbais = torch.mean(temcostbais, dim=1)
-                    temcostlist = torch.mul(temcostbais, torch_costs).tolist()
-                    count = 0
-                    for key in temtable:
-                        temtable[key] = (temcostlist[count], temtable[key][1])
-                        count = count + 1
-                sortlist = dict(sorted(temtable.items(), key=lambda x: x[1][0])[math.ceil(len(dp_table) * 0.3):])
-                for key in sortlist:
-                    dp_table.pop(key)
-                dp_tables[level] = dp_table
-        bestplanhint = list(dp_tables[num_rels].values())[0][1].hint_str()
-        # print(list(dp_tables[num_rels].values())[0][1].info)
-        if dpsign:
-            collectSubplans(list(dp_tables[num_rels].values())[0][1], subplans_fin, workload, exp)
-        nowlatency = postgres.GetLatencyFromPg(finsql, bestplanhint, verbose=False, check_hint_used=False,
-                                               timeout=timeout, dropbuffer=dropbuffer)
-        if timeout > nowlatency:
-            timeout = nowlatency
-
-        return trainBuffer, bestplanhint, num, timeout
+        query = DPQuery(self, join_graph, all_join_conds, query_leaves, dp_tables, workload, model,
+                        nodeFeaturizer, costCache=costCache, exp=exp, FirstTrain=FirstTrain, dpsign=dpsign,
+                        timeout=timeout, dropbuffer=dropbuffer)
+        stages = DPStages(scoring=CalibratedScoring(num_samples=10, train_mode=True, priority='ucb'),
+                          explore=UcbExploration(fraction=0.1, low_level_fraction=0.2, per_level=True),
+                          collect=LatencyCollection(when='first_train_or_dp', skip_prob=0.2, slack='any'),
+                          prune=LevelPruning(4, 15, top_offset=1, rescore='raw'))
+        return self._RunTrainingDP(query, stages, finsql, subplans_fin=subplans_fin if dpsign else None)
 
     def UCB_left_prune_replay_fix_kl(self, join_graph, all_join_conds, query_leaves, dp_tables, workload, exp,
                                      FirstTrain,
@@ -1963,12 +1788,16 @@ class DynamicProgramming(object):
         - 遍历 levels, 对于每一个 level
             - 遍历[level - 1] 和 [1] 所有(连接)表
                 1. 合并左右两边的(连接)表ID 获得 【join_ids】
-                2. 针对一对 [level - 1] 和 [1] 的(连接)表, 【遍历所有 join 连接】，将(dp cost,join, join_ids)  加入 bayes_tep
-                3. 对于 level > num_rels - 4, 获得 query_feats, trees, indexes; 底下几层 level 的 costlist = dp_costs
-                    a) 重复计算 cost, 【计算UCB上置信界来估计不确定性】, 并放入 bayes_list
-                    b) 如果没有使用 dp, 遍历部分按UCB排序后的 plans, 获得一个 bayes_plan的 【latency】, 并加入该 level 的 trainBuffer 和 exp
-                4. 遍历 costlist 中的所有代价估计, 如果 join_ids 不在 dp_table 中或者原来存的 cost 更大, 更新 dp_table 
-            - 对于 中间层, 按 dp_table 中的 items 按 cost 排序, 进行键(连接)表【剪枝】
+                2. 针对一对 [level - 1] 和 [1] 的(连接)表, 【遍历所有 join 连接】, 得到 Candidates (PgCosting)
+                3. 对于顶部 p.model_top_levels 层 (默认 level > num_rels - 4), 使用当前 level 的模型计算 10次 tanh + 1 的均值和方差 (CalibratedScoring);
+                   底下几层 level 的 costlist = dp_costs
+                    a) 方差作为【UCB上置信界来估计不确定性】
+                    b) 如果没有使用 dp, 按UCB排序后取 p.explore_fraction (默认 10%) plans, 获得 bayes_plan的 【latency】, 并加入该 level 的
+                       trainBuffer 和 exp (UcbExploration)
+                4. 遍历 costlist 中的所有代价估计, 如果 join_ids 不在 dp_table 中或者原来存的 cost 更大, 更新 dp_table;
+                   FirstTrain 或 dp 模式下顶层收集其 latency (LatencyCollection)
+            - 对于 中间层, 按 dp_table 中的 items 按 cost 排序, 进行键(连接)表【剪枝】 (LevelPruning, 见 p.prune_*:
+              默认保留 30%; 也可按下一层的候选数或规划时间预算自适应保留)
         - 获得 【bestplanhint】, 使用 PG 计算其 latency
 
         return
@@ -1985,1149 +1814,175 @@ class DynamicProgramming(object):
                 - [6] join_ids 
         bestplanhint 出了如何以最佳方式执行查询的指示
         """
-        num_rels = len(query_leaves) # 指 查询涉及的关系数, 两两连接 所以 num_rels 就是层数 levels
-        num = 0 # 这个 sql 在 buffer 中的第几条记录
-        latency = 0
-        for i in range(0, num_rels + 1): # 创建 空的 trainBuffer
-            trainBuffer.append([])
-        for level in range(2, num_rels + 1): # 遍历 不同 level，从两个关系的连接开始
-            # -------- dp_tables[level][leaf_node.table_alias] = (cost, leaf_node) ----------
-            dp_table = dp_tables[level] # 获取 当前 level 所有(连接)表的 dp table， 并打乱 level-1 和 1 的 dp table 中的 key 顺序
-            dp_table_i = random_dic(dp_tables[level - 1])
-            dp_table_j = random_dic(dp_tables[1])
-            for l_ids, l_tup in dp_table_i.items(): # 遍历 [level - 1]; l_ids是一个(连接)表的别名, l_tup 是一个 (cost, leaf_node)
-                for r_ids, r_tup in dp_table_j.items():
-                    l = l_tup[1] # 获取 leaf_node
-                    r = r_tup[1]
-                    if not plans_lib.ExistsJoinEdgeInGraph( # 检查 两个关系是否有可用的连接关系，没有就跳过
-                            l, r, join_graph):
-                        # No join clause linking two sides.  Skip.
-                        continue
-                    l_ids_splits = l_ids.split(',')
-                    r_ids_splits = r_ids.split(',')
-                    if len(np.intersect1d(l_ids_splits, r_ids_splits)) > 0: # 检查 某个关系是否在两边都存在
-                        # A relation exists in both sides.  Skip.
-                        continue
-                    join_ids = ','.join(sorted(l_ids_splits + r_ids_splits)) # 合并 左右两边的关系ID
-                    # Otherwise, form a new join.
-                    dp_costs = []
-                    dp_query_encodings = []
-                    dp_nodes = []
-                    dp_hints_sqls = []
-                    dp_join = []
-                    bayes_tep = []
-                    bayes_list = []
-                    for join in EnumerateJoinWithOps( # 遍历 针对一对 [level - 1] 和 [1] 的(连接)表, 所有有效的 join 操作, 记录 cost
-                            l, # leaf_node
-                            r,
-                            self.join_ops,
-                            self.scan_ops,
-                            use_plan_restrictions=self.use_plan_restrictions
-                    ):
-                        join.info["currentLevel"] = level
-
-                        join_conds = join.KeepRelevantJoins(all_join_conds) # 获取 与当前 node 相关的连接条件
-                        join.info["join_conds"] = join_conds
-                        cost, sql, hint = self.cost_model.getCost_cache(join, join_conds, costCache)
-                        join.info["cost"] = cost
-                        logcost = math.log(cost)
-                        data = encoding.getencoding_Balsa(sql, hint, workload) # 获得 encoding后的query_vecs 和 node
-                        join.info["encoding"] = data[0]
-                        join.info["node"] = data[1]
-                        dp_join.append(join)
-                        dp_costs.append(logcost)
-                        dp_query_encodings.append(data[0])
-                        dp_nodes.append(data[1])
-                        dp_hints_sqls.append([hint, sql])
-                        tem = [] # 创建 包含cost, sql, hint, encoding 的临时列表
-                        tem.append(logcost)
-                        tem.append(sql)
-                        tem.append(hint)
-                        tem.append(0)
-                        tem.append([data[0], data[1]])
-                        btem = copy.deepcopy(tem[:] + [join] + [join_ids])
-                        bayes_tep.append(btem)
-                    #                    if level > num_rels - 5:
-                    #                        levelList[level][join_ids] = [dp_costs, dp_query_encodings, dp_nodes]
-                    if not FirstTrain and level > num_rels - 4: # 判断 是否 level 是中间位置 底层几个 level 不使用 ML 的方法
-                        query_feats = (torch.cat(dp_query_encodings, dim=0)).to(DEVICE)
-                        trees, indexes = TreeConvFeaturize(nodeFeaturizer, dp_nodes)
-                        if torch.cuda.is_available():
-                            trees = trees.to(DEVICE)
-                            indexes = indexes.to(DEVICE)
-                            torch_dpcosts = (torch.tensor(dp_costs)).to(DEVICE)
-                        model[level].train()
-                        costbais = []
-                        for i in range(10): # 循环 10次
-                            with torch.no_grad():
-                                costbais.append(torch.tanh(model[level](query_feats, trees, indexes).to(DEVICE)).add(1)) # 计算 使用当前 level 的模型计算，使用 tanh 函数后 + 1 
-                        costbais = torch.cat(costbais, 1)
-                        costbais_mean = torch.mean(costbais, dim=1)
-                        cost_t = torch.mul(costbais_mean, torch_dpcosts) # 计算 相乘
-                        costlist = cost_t.tolist()
-                        cost_min, _ = torch.min(cost_t, dim=0)
-                        var = torch.var(costbais, dim=1)
-                        ucb = var / var.max() - cost_min / cost_min.max() # 计算 上置信界Upper Confidence Bound来估计不确定性
-                        bayes_list.extend(ucb.tolist()) # 转换 将ucb的值转换为列表 放入 bayes_list
-
-                        if not FirstTrain and not dpsign and level > num_rels - 4: # 判断 当没有使用 dp 时
-                            # print('bayes_list len :',len(bayes_list))
-                            # print('bayes tep num :',len(bayes_tep))
-                            bayes_list = torch.tensor(bayes_list)
-                            # ucb_argsort = torch.argsort(bayes_list, descending=True)
-                            ucb_argsort = torch.argsort(bayes_list, descending=True) # 获得 降序排序的 ucb 
-                            p = 0.1 # 用于 选取 p 比例的 bayes_tep 进行处理
-                            n = math.ceil(p * len(bayes_tep)) # 计算 向上取整
-                            for i in range(n): # 遍历 排序后的部分plans
-                                bayes_plan = bayes_tep[ucb_argsort[i]] # 获取 某一个plan
-                                usebuffer = False
-                                for j in exp[level]:
-                                    if (j[2] == bayes_plan[2] and j[1] == bayes_plan[1]): # 判断 在buffer中找到与当前 bayes_plan 对应的 exp，就获取 latency 并跳出循环
-                                        usebuffer = True
-                                        blatency = j[3]
-                                        break
-                                if (usebuffer == False): # 判断 buffer中没有对应的 exp 
-                                    num = num + 1
-                                    if slackTimeout(exp[level]): # 判断 是否需要放宽超时设置；如需放宽，设置 12000 来从PG中获取 latency 
-                                        blatency = postgres.GetLatencyFromPg(bayes_plan[1], bayes_plan[2],
-                                                                             verbose=False,
-                                                                             check_hint_used=False, timeout=12000,
-                                                                             dropbuffer=dropbuffer)
-                                    else:
-                                        blatency = postgres.GetLatencyFromPg(bayes_plan[1], bayes_plan[2],
-                                                                             verbose=False,
-                                                                             check_hint_used=False, timeout=timeout,
-                                                                             dropbuffer=dropbuffer)
-                                    # if blatency == 90000:
-                                    #  continue
-                                    bayes_plan[3] = blatency
-                                    bayes_plan[4][1].info["latency"] = blatency
-                                    bayes_plan[5].info["latency"] = blatency
-                                    bayes_plan[4][1].info["join_ids"] = join_ids
-                                    bayes_plan[5].info["join_ids"] = join_ids
-                                    trainBuffer[level].append(copy.deepcopy(bayes_plan))
-                                    exp[level].append(copy.deepcopy(bayes_plan))
-
-                    else:
-                        costlist = dp_costs
-                    
-                    for i in range(0, len(costlist)):
-                        if join_ids not in dp_table or dp_table[join_ids][ # 判断 join_ids 不在dp_table 中，或者原来存的 cost 更大
-                            0] > costlist[i]:
-                            if (FirstTrain or dpsign) and level > num_rels - 4:
-                                tem = []
-                                tem.append(dp_costs[i])
-                                tem.append(dp_hints_sqls[i][1])
-                                tem.append(dp_hints_sqls[i][0])
-                                # # # collect train data (latency)
-                                usebuffer = False
-                                for j in exp[level]:
-                                    if (j[2] == dp_hints_sqls[i][0] and j[1] == dp_hints_sqls[i][1]):
-                                        usebuffer = True
-                                        latency = j[3]
-                                        dp_nodes[i].info["latency"] = latency
-                                        break
-                                coll = False
-                                if (usebuffer == False):
-                                    if (slackTimeout(exp[level])):
-                                        print('slack')
-                                        latency = postgres.GetLatencyFromPg(dp_hints_sqls[i][1], dp_hints_sqls[i][0],
-                                                                            verbose=False, check_hint_used=False,
-                                                                            timeout=12000, dropbuffer=dropbuffer)
-                                        coll = True
-                                    else:
-                                        if random.random() > -1:
-                                            latency = postgres.GetLatencyFromPg(dp_hints_sqls[i][1],
-                                                                                dp_hints_sqls[i][0],
-                                                                                verbose=False, check_hint_used=False,
-                                                                                timeout=timeout, dropbuffer=dropbuffer)
-                                            coll = True
-                                    if coll:
-                                        dp_nodes[i].info["latency"] = latency
-                                        dp_join[i].info["latency"] = latency
-                                        dp_nodes[i].info["join_ids"] = join_ids
-                                        dp_join[i].info["join_ids"] = join_ids
-
-                                        tem.append(latency)
-                                        tem.append([dp_query_encodings[i], dp_nodes[i]])
-                                        tem.append(dp_join[i])
-                                        tem.append(join_ids)
-                                        exp[level].append(tem)
-                                        trainBuffer[level].append(tem)
-
-                            dp_table[join_ids] = (costlist[i], dp_join[i])
-
-            if level > 6 and level < 15 and level < num_rels - 1:
-                temtable = copy.deepcopy(dp_table) # dp_table  (cost, leaf_node)
-                if not FirstTrain:
-                    temcost = []
-                    temnodes = []
-                    tem_query_encodings = []
-                    for key, values in temtable.items(): # 将 temtable 中的每个项加入上面三个 list 
-                        temcost.append(values[0]) # 添加 cost
-                        temnodes.append(values[1].info["node"])
-                        tem_query_encodings.append(values[1].info["encoding"])
-                    #  print("nodes num = ",len(temnodes))
-                    temquery_feats = (torch.cat(tem_query_encodings, dim=0)).to(DEVICE)
-                    temtrees, temindexes = TreeConvFeaturize(nodeFeaturizer, temnodes) # 获得 temp 的 树结构 和 索引
-                    if torch.cuda.is_available():
-                        temtrees = temtrees.to(DEVICE)
-                        temindexes = temindexes.to(DEVICE)
-                        torch_costs = (torch.tensor(temcost)).to(DEVICE)
-                    # temcostbais = model[num_rels](temquery_feats, temtrees, temindexes).to(DEVICE).add(1)
-                    temcostbais = []
-                    for i in range(10):
-                        with torch.no_grad():
-                            temcostbais.append(
-                                torch.tanh(model[-1](temquery_feats, temtrees, temindexes).to(DEVICE)).add(1))
-                    temcostbais = torch.cat(temcostbais, 1)
-                    temcostbais = torch.mean(temcostbais, dim=1)
-                    temcostlist = torch.mul(temcostbais, torch_costs).tolist()
-                    count = 0
-                    for key in temtable: # 更新 temtable 中的 cost, 第二项leaf_node不变
-                        temtable[key] = (temcostlist[count], temtable[key][1])
-                        count = count + 1
-                sortlist = dict(sorted(temtable.items(), key=lambda x: x[1][0])[math.ceil(len(dp_table) * 0.3):]) # 将 temtable 按 cost 排序，取30%部分生成 sortlist
-                for key in sortlist:
-                    dp_table.pop(key) # 移除键(连接)表 【剪枝】
-                dp_tables[level] = dp_table
-        bestplanhint = list(dp_tables[num_rels].values())[0][1].hint_str()
-        # print(list(dp_tables[num_rels].values())[0][1].info)
-        #        if dpsign:
-        #            collectSubplans(list(dp_tables[num_rels].values())[0][1], subplans_fin, workload, exp)
-        nowlatency = postgres.GetLatencyFromPg(finsql, bestplanhint, verbose=False, check_hint_used=False,
-                                               timeout=timeout, dropbuffer=dropbuffer)
-        if timeout > nowlatency:
-            timeout = nowlatency
-
-        return trainBuffer, bestplanhint, num, timeout
+        query = DPQuery(self, join_graph, all_join_conds, query_leaves, dp_tables, workload, model,
+                        nodeFeaturizer, costCache=costCache, exp=exp, FirstTrain=FirstTrain, dpsign=dpsign,
+                        timeout=timeout, dropbuffer=dropbuffer)
+        p = self.params
+        stages = DPStages(scoring=CalibratedScoring(top_levels=p.model_top_levels, num_samples=10, train_mode=True,
+                                                    priority='var'),
+                          explore=UcbExploration(fraction=p.explore_fraction, slack_last_level_only=False),
+                          collect=LatencyCollection(when='first_train_or_dp', top_levels=p.model_top_levels,
+                                                    skip_prob=-1, slack='any'),
+                          prune=self._LevelPruning(top_offset=1, num_samples=10),
+                          reuse='left_deep_prune')
+        return self._RunTrainingDP(query, stages, finsql)
 
     def test_speed(self, join_graph, all_join_conds, query_leaves, dp_tables, workload, exp, FirstTrain,
                    model, timeout, dropbuffer, nodeFeaturizer, greedy, subplans_fin, finsql, costCache,
                    dpsign, levelList):
-        num_rels = len(query_leaves)
-        num = 0
-        latency = 0
-        plans_num = 0
-        tui_time = 0
-        tui_num = 0
-        for i in range(0, num_rels + 1):
-            trainBuffer.append([])
-        for level in range(2, num_rels + 1):
-            dp_table = dp_tables[level]
-            dp_table_i = random_dic(dp_tables[level - 1])
-            dp_table_j = random_dic(dp_tables[1])
-            for l_ids, l_tup in dp_table_i.items():
-                for r_ids, r_tup in dp_table_j.items():
-                    l = l_tup[1]
-                    r = r_tup[1]
-                    if not plans_lib.ExistsJoinEdgeInGraph(
-                            l, r, join_graph):
-                        # No join clause linking two sides.  Skip.
-                        continue
-                    l_ids_splits = l_ids.split(',')
-                    r_ids_splits = r_ids.split(',')
-                    if len(np.intersect1d(l_ids_splits, r_ids_splits)) > 0:
-                        # A relation exists in both sides.  Skip.
-                        continue
-                    join_ids = ','.join(sorted(l_ids_splits + r_ids_splits))
-                    # Otherwise, form a new join.
-                    dp_costs = []
-                    dp_query_encodings = []
-                    dp_nodes = []
-                    dp_hints_sqls = []
-                    dp_join = []
-                    bayes_tep = []
-                    bayes_list = []
-                    for join in EnumerateJoinWithOps(
-                            l,
-                            r,
-                            self.join_ops,
-                            self.scan_ops,
-                            use_plan_restrictions=self.use_plan_restrictions
-                    ):
-                        #                        join.info["currentLevel"] = level
-
-                        join_conds = join.KeepRelevantJoins(all_join_conds)
-                        #                        join.info["join_conds"] = join_conds
-                        #                        cost, sql, hint = self.cost_model.getCost_cache(join, join_conds, costCache)
-                        cost = 1
-                        plans_num = plans_num + 1
-                        if level > num_rels - 3:
-                            tui_num = tui_num + 1
-                        #                        join.info["cost"] = cost
-                        #                        logcost = math.log(cost)
-                        #                        data = encoding.getencoding_Balsa(sql, hint, workload)
-                        #                        join.info["encoding"] = data[0]
-                        #                        join.info["node"] = data[1]
-                        dp_join.append(join)
-                        #                        dp_costs.append(logcost)
-                        dp_costs.append(cost)
-                    #                        dp_query_encodings.append(data[0])
-                    #                        dp_nodes.append(data[1])
-                    #                        dp_hints_sqls.append([hint, sql])
-                    #                        tem = []
-                    #                        tem.append(logcost)
-                    #                        tem.append(sql)
-                    #                        tem.append(hint)
-                    #                        tem.append(0)
-                    #                        tem.append([data[0], data[1]])
-                    #                        btem = copy.deepcopy(tem[:] + [join]+[join_ids])
-                    #                        bayes_tep.append(btem)
-                    #                    if level > num_rels - 5:
-                    #                        levelList[level][join_ids] = [dp_costs, dp_query_encodings, dp_nodes]
-                    #                    if level > num_rels - 3 :
-                    #
-                    #                        query_feats = (torch.cat(dp_query_encodings, dim=0)).to(DEVICE)
-                    #                        trees, indexes = TreeConvFeaturize(nodeFeaturizer, dp_nodes)
-                    #                        if torch.cuda.is_available():
-                    #                            trees = trees.to(DEVICE)
-                    #                            indexes = indexes.to(DEVICE)
-                    #                            torch_dpcosts = (torch.tensor(dp_costs)).to(DEVICE)
-                    #                        model[level].train()
-                    #                        costbais = []
-                    #                        stime = time.time()
-                    #                        with torch.no_grad():
-                    #                            tem_tor = torch.tanh(model[level](query_feats, trees, indexes).to(DEVICE)).add(1)
-                    #                        tui_time = tui_time+time.time()-stime
-                    #                        costbais.append(tem_tor)
-                    #
-                    #                        costbais = torch.cat(costbais, 1)
-                    #                        costbais_mean = torch.mean(costbais, dim=1)
-                    #                        cost_t = torch.mul(costbais_mean, torch_dpcosts)
-                    #
-                    #                        costlist = cost_t.tolist()
-                    #                        cost_min, _ = torch.min(cost_t, dim=0)
-                    #                        var = torch.var(costbais, dim=1)
-                    #                        ucb = var / var.max() - cost_min / cost_min.max()
-                    #                        bayes_list.extend(ucb.tolist())
-
-                    # else:
-                    costlist = dp_costs
-                    for i in range(0, len(costlist)):
-                        if join_ids not in dp_table or dp_table[join_ids][
-                            0] > costlist[i]:
-                            dp_table[join_ids] = (costlist[i], dp_join[i])
-
-        #            if level > 6 and level < 15 and level < num_rels - 1:
-        #                temtable = copy.deepcopy(dp_table)
-        ##                if not FirstTrain:
-        ##                    temcost = []
-        ##                    temnodes = []
-        ##                    tem_query_encodings = []
-        ##                    for key, values in temtable.items():
-        ##                        temcost.append(values[0])
-        ##                        temnodes.append(values[1].info["node"])
-        ##                        tem_query_encodings.append(values[1].info["encoding"])
-        ##                    #  print("nodes num = ",len(temnodes))
-        ##                    temquery_feats = (torch.cat(tem_query_encodings, dim=0)).to(DEVICE)
-        ##                    temtrees, temindexes = TreeConvFeaturize(nodeFeaturizer, temnodes)
-        ##                    if torch.cuda.is_available():
-        ##                        temtrees = temtrees.to(DEVICE)
-        ##                        temindexes = temindexes.to(DEVICE)
-        ##                        torch_costs = (torch.tensor(temcost)).to(DEVICE)
-        ##                    # temcostbais = model[num_rels](temquery_feats, temtrees, temindexes).to(DEVICE).add(1)
-        ##                    temcostbais = []
-        ##                    for i in range(10):
-        ##                        with torch.no_grad():
-        ##                            temcostbais.append(
-        ##                               torch.tanh(model[-1](temquery_feats, temtrees, temindexes).to(DEVICE)).add(1))
-        ##                    temcostbais = torch.cat(temcostbais, 1)
-        ##                    temcostbais = torch.mean(temcostbais, dim=1)
-        ##                    temcostlist = torch.mul(temcostbais, torch_costs).tolist()
-        ##                    count = 0
-        ##                    for key in temtable:
-        ##                        temtable[key] = (temcostlist[count], temtable[key][1])
-        ##                        count = count + 1
-        #                sortlist = dict(sorted(temtable.items(), key=lambda x: x[1][0])[math.ceil(len(dp_table) * 0.3):])
-        #                for key in sortlist:
-        #                    dp_table.pop(key)
-        #                dp_tables[level] = dp_table
-        bestplanhint = list(dp_tables[num_rels].values())[0][1].hint_str()
-        #        # print(list(dp_tables[num_rels].values())[0][1].info)
-        #        #        if dpsign:
-        #        #            collectSubplans(list(dp_tables[num_rels].values())[0][1], subplans_fin, workload, exp)
-        #        nowlatency = postgres.GetLatencyFromPg(finsql, bestplanhint, verbose=False, check_hint_used=False,
-        #                                               timeout=timeout, dropbuffer=dropbuffer)
-        #        if timeout > nowlatency:
-        #            timeout = nowlatency
-        print('plans num :', plans_num, 'tui_num :', tui_num)
-        return trainBuffer, bestplanhint, num, timeout
+        costing = UnitCosting()
+        query = DPQuery(self, join_graph, all_join_conds, query_leaves, dp_tables, workload, exp=exp,
+                        timeout=timeout)
+        result = self._RunTrainingDP(query, DPStages(costing=costing), final_latency=None)
+        print('plans num :', costing.plans_num, 'tui_num :', costing.top_plans_num)
+        return result
 
     def UCB_left_prune_replay_fix_kl_1(self, join_graph, all_join_conds, query_leaves, dp_tables, workload, exp,
                                        FirstTrain,
                                        model, timeout, dropbuffer, nodeFeaturizer, greedy, subplans_fin, finsql,
                                        costCache,
                                        dpsign, levelList, epoch):
-        num_rels = len(query_leaves)
-        num = 0
-        latency = 0
-        time_all = 0
-        for i in range(0, num_rels + 1):
-            trainBuffer.append([])
-        for level in range(2, num_rels + 1):
-            dp_table = dp_tables[level]
-            dp_table_i = random_dic(dp_tables[level - 1])
-            dp_table_j = random_dic(dp_tables[1])
-            for l_ids, l_tup in dp_table_i.items():
-                for r_ids, r_tup in dp_table_j.items():
-                    l = l_tup[1]
-                    r = r_tup[1]
-                    if not plans_lib.ExistsJoinEdgeInGraph(
-                            l, r, join_graph):
-                        # No join clause linking two sides.  Skip.
-                        continue
-                    l_ids_splits = l_ids.split(',')
-                    r_ids_splits = r_ids.split(',')
-                    if len(np.intersect1d(l_ids_splits, r_ids_splits)) > 0:
-                        # A relation exists in both sides.  Skip.
-                        continue
-                    join_ids = ','.join(sorted(l_ids_splits + r_ids_splits))
-                    # Otherwise, form a new join.
-                    dp_costs = []
-                    dp_query_encodings = []
-                    dp_nodes = []
-                    dp_hints_sqls = []
-                    dp_join = []
-                    bayes_tep = []
-                    bayes_list = []
-                    for join in EnumerateJoinWithOps(
-                            l,
-                            r,
-                            self.join_ops,
-                            self.scan_ops,
-                            use_plan_restrictions=self.use_plan_restrictions
-                    ):
-                        join.info["currentLevel"] = level
-
-                        join_conds = join.KeepRelevantJoins(all_join_conds)
-                        join.info["join_conds"] = join_conds
-                        cost, sql, hint = self.cost_model.getCost_cache(join, join_conds, costCache)
-                        join.info["cost"] = cost
-                        logcost = math.log(cost)
-                        data = encoding.getencoding_Balsa(sql, hint, workload)
-                        join.info["encoding"] = data[0]
-                        join.info["node"] = data[1]
-                        dp_join.append(join)
-                        dp_costs.append(logcost)
-                        dp_query_encodings.append(data[0])
-                        dp_nodes.append(data[1])
-                        dp_hints_sqls.append([hint, sql])
-                        tem = []
-                        tem.append(logcost)
-                        tem.append(sql)
-                        tem.append(hint)
-                        tem.append(0)
-                        tem.append([data[0], data[1]])
-                        btem = copy.deepcopy(tem[:] + [join] + [join_ids])
-                        bayes_tep.append(btem)
-                    #                    if level > num_rels - 5:
-                    #                        levelList[level][join_ids] = [dp_costs, dp_query_encodings, dp_nodes]
-                    # if level > num_rels - 4 :
-                    if not FirstTrain and level > num_rels - 4:
-                        times = time.time()
-                        query_feats = (torch.cat(dp_query_encodings, dim=0)).to(DEVICE)
-                        trees, indexes = TreeConvFeaturize(nodeFeaturizer, dp_nodes)
-                        if torch.cuda.is_available():
-                            trees = trees.to(DEVICE)
-                            indexes = indexes.to(DEVICE)
-                            torch_dpcosts = (torch.tensor(dp_costs)).to(DEVICE)
-                        model[level].train()
-                        costbais = []
-                        for i in range(1):
-                            with torch.no_grad():
-                                costbais.append(torch.tanh(model[level](query_feats, trees, indexes).to(DEVICE)).add(1))
-                        costbais = torch.cat(costbais, 1)
-                        costbais_mean = torch.mean(costbais, dim=1)
-                        timee = time.time() - times
-                        time_all = time_all + timee
-                        cost_t = torch.mul(costbais_mean, torch_dpcosts)
-                        costlist = cost_t.tolist()
-                        cost_min, _ = torch.min(cost_t, dim=0)
-                        if epoch > 9:
-                            var = - torch.var(costbais, dim=1)
-                            ucb = var / var.max() + cost_min / cost_min.max()
-                        else:
-                            ucb = cost_min / cost_min.max()
-                        bayes_list.extend(ucb.tolist())
-
-                        # if False:
-                        if not FirstTrain and not dpsign:
-                            # print('bayes_list len :',len(bayes_list))
-                            # print('bayes tep num :',len(bayes_tep))
-                            bayes_list = torch.tensor(bayes_list)
-                            # ucb_argsort = torch.argsort(bayes_list, descending=True)
-                            ucb_argsort = torch.argsort(bayes_list)
-                            p = 0.1
-                            n = math.ceil(p * len(bayes_tep))
-                            for i in range(n):
-                                bayes_plan = bayes_tep[ucb_argsort[i]]
-                                usebuffer = False
-                                for j in exp[level]:
-                                    if (j[2] == bayes_plan[2] and j[1] == bayes_plan[1]):
-                                        usebuffer = True
-                                        blatency = j[3]
-                                        break
-                                if (usebuffer == False):
-                                    num = num + 1
-                                    if slackTimeout(exp[level]):
-                                        blatency = postgres.GetLatencyFromPg(bayes_plan[1], bayes_plan[2],
-                                                                             verbose=False,
-                                                                             check_hint_used=False, timeout=12000,
-                                                                             dropbuffer=dropbuffer)
-                                    else:
-                                        blatency = postgres.GetLatencyFromPg(bayes_plan[1], bayes_plan[2],
-                                                                             verbose=False,
-                                                                             check_hint_used=False, timeout=timeout,
-                                                                             dropbuffer=dropbuffer)
-                                    # if blatency == 90000:
-                                    #  continue
-                                    bayes_plan[3] = blatency
-                                    bayes_plan[4][1].info["latency"] = blatency
-                                    bayes_plan[5].info["latency"] = blatency
-                                    bayes_plan[4][1].info["join_ids"] = join_ids
-                                    bayes_plan[5].info["join_ids"] = join_ids
-                                    trainBuffer[level].append(copy.deepcopy(bayes_plan))
-                                    exp[level].append(copy.deepcopy(bayes_plan))
-
-                    else:
-                        costlist = dp_costs
-                    for i in range(0, len(costlist)):
-                        if join_ids not in dp_table or dp_table[join_ids][
-                            0] > costlist[i]:
-                            if False:
-                                # if (FirstTrain or dpsign) and level > num_rels -3:
-                                tem = []
-                                tem.append(dp_costs[i])
-                                tem.append(dp_hints_sqls[i][1])
-                                tem.append(dp_hints_sqls[i][0])
-                                # # # collect train data (latency)
-                                usebuffer = False
-                                for j in exp[level]:
-                                    if (j[2] == dp_hints_sqls[i][0] and j[1] == dp_hints_sqls[i][1]):
-                                        usebuffer = True
-                                        latency = j[3]
-                                        dp_nodes[i].info["latency"] = latency
-                                        break
-                                coll = False
-                                if (usebuffer == False):
-                                    if (slackTimeout(exp[level])):
-                                        print('slack')
-                                        latency = postgres.GetLatencyFromPg(dp_hints_sqls[i][1], dp_hints_sqls[i][0],
-                                                                            verbose=False, check_hint_used=False,
-                                                                            timeout=12000, dropbuffer=dropbuffer)
-                                        coll = True
-                                    else:
-                                        if random.random() > -1:
-                                            latency = postgres.GetLatencyFromPg(dp_hints_sqls[i][1],
-                                                                                dp_hints_sqls[i][0],
-                                                                                verbose=False, check_hint_used=False,
-                                                                                timeout=timeout, dropbuffer=dropbuffer)
-                                            coll = True
-                                    if coll:
-                                        dp_nodes[i].info["latency"] = latency
-                                        dp_join[i].info["latency"] = latency
-                                        dp_nodes[i].info["join_ids"] = join_ids
-                                        dp_join[i].info["join_ids"] = join_ids
-
-                                        tem.append(latency)
-                                        tem.append([dp_query_encodings[i], dp_nodes[i]])
-                                        tem.append(dp_join[i])
-                                        tem.append(join_ids)
-                                        exp[level].append(tem)
-                                        trainBuffer[level].append(tem)
-
-                            dp_table[join_ids] = (costlist[i], dp_join[i])
-
-            if level > 6 and level < 15 and level < num_rels - 1:
-                temtable = copy.deepcopy(dp_table)
-                if True:
-                    # if not FirstTrain:
-                    temcost = []
-                    temnodes = []
-                    tem_query_encodings = []
-                    for key, values in temtable.items():
-                        temcost.append(values[0])
-                        temnodes.append(values[1].info["node"])
-                        tem_query_encodings.append(values[1].info["encoding"])
-                    #  print("nodes num = ",len(temnodes))
-                    temquery_feats = (torch.cat(tem_query_encodings, dim=0)).to(DEVICE)
-                    temtrees, temindexes = TreeConvFeaturize(nodeFeaturizer, temnodes)
-                    if torch.cuda.is_available():
-                        temtrees = temtrees.to(DEVICE)
-                        temindexes = temindexes.to(DEVICE)
-                        torch_costs = (torch.tensor(temcost)).to(DEVICE)
-                    # temcostbais = model[num_rels](temquery_feats, temtrees, temindexes).to(DEVICE).add(1)
-                    temcostbais = []
-                    for i in range(10):
-                        with torch.no_grad():
-                            temcostbais.append(
-                                torch.tanh(model[-1](temquery_feats, temtrees, temindexes).to(DEVICE)).add(1))
-                    temcostbais = torch.cat(temcostbais, 1)
-                    temcostbais = torch.mean(temcostbais, dim=1)
-                    temcostlist = torch.mul(temcostbais, torch_costs).tolist()
-                    count = 0
-                    for key in temtable:
-                        temtable[key] = (temcostlist[count], temtable[key][1])
-                        count = count + 1
-                sortlist = dict(sorted(temtable.items(), key=lambda x: x[1][0])[math.ceil(len(dp_table) * 0.3):])
-                for key in sortlist:
-                    dp_table.pop(key)
-                dp_tables[level] = dp_table
-        bestplanhint = list(dp_tables[num_rels].values())[0][1].hint_str()
-        # print(list(dp_tables[num_rels].values())[0][1].info)
-        #        if dpsign:
-        #            collectSubplans(list(dp_tables[num_rels].values())[0][1], subplans_fin, workload, exp)
-        nowlatency = postgres.GetLatencyFromPg(finsql, bestplanhint, verbose=False, check_hint_used=False,
-                                               timeout=timeout, dropbuffer=dropbuffer)
-        if timeout > nowlatency:
-            timeout = nowlatency
-        print('*****time:', time_all)
-        return trainBuffer, bestplanhint, num, timeout
+        # A single MC pass has no variance: explore in enumeration order.
+        query = DPQuery(self, join_graph, all_join_conds, query_leaves, dp_tables, workload, model,
+                        nodeFeaturizer, costCache=costCache, exp=exp, FirstTrain=FirstTrain, dpsign=dpsign,
+                        timeout=timeout, dropbuffer=dropbuffer)
+        stages = DPStages(scoring=CalibratedScoring(top_levels=3, num_samples=1, train_mode=True,
+                                                    priority='enumeration'),
+                          explore=UcbExploration(fraction=0.1, slack_last_level_only=False),
+                          prune=LevelPruning(6, 15, top_offset=1, num_samples=10, rescore_first_train=True))
+        return self._RunTrainingDP(query, stages, finsql)
 
     def KM_left_prune(self, join_graph, all_join_conds, query_leaves, dp_tables, workload, exp, FirstTrain,
                       model, timeout, dropbuffer, nodeFeaturizer, greedy, subplans_fin, finsql):
-        num_rels = len(query_leaves)
-        num = 0
-        latency = 0
-        for i in range(0, num_rels + 1):
-            trainBuffer.append([])
-        for level in range(2, num_rels + 1):
-            dp_table = dp_tables[level]
-            bayes_tep = []
-            bayes_list = []
-            # for level_i in range(1, level):
-            # level_j = level - level_i
-            dp_table_i = random_dic(dp_tables[level - 1])
-            dp_table_j = random_dic(dp_tables[1])
-            # limit = int(len(dp_table_i) * 0.2)
-            #    nowplansnum = 0
-            for l_ids, l_tup in dp_table_i.items():
-                for r_ids, r_tup in dp_table_j.items():
-                    l = l_tup[1]
-                    r = r_tup[1]
-                    if not plans_lib.ExistsJoinEdgeInGraph(
-                            l, r, join_graph):
-                        # No join clause linking two sides.  Skip.
-                        continue
-                    l_ids_splits = l_ids.split(',')
-                    r_ids_splits = r_ids.split(',')
-                    if len(np.intersect1d(l_ids_splits, r_ids_splits)) > 0:
-                        # A relation exists in both sides.  Skip.
-                        continue
-                    join_ids = ','.join(sorted(l_ids_splits + r_ids_splits))
-                    # Otherwise, form a new join.
-                    dp_costs = []
-                    dp_query_encodings = []
-                    dp_nodes = []
-                    dp_hints_sqls = []
-                    dp_join = []
-                    for join in EnumerateJoinWithOps(
-                            l,
-                            r,
-                            self.join_ops,
-                            self.scan_ops,
-                            use_plan_restrictions=self.use_plan_restrictions
-                    ):
-                        join.info["currentLevel"] = level
-
-                        join_conds = join.KeepRelevantJoins(all_join_conds)
-                        join.info["join_conds"] = join_conds
-
-                        cost, sql, hint = self.cost_model(join, join_conds)
-                        join.info["cost"] = cost
-                        logcost = math.log(cost)
-                        data = encoding.getencoding_Balsa(sql, hint, workload)
-                        join.info["encoding"] = data[0]
-                        join.info["node"] = data[1]
-                        dp_join.append(join)
-                        dp_costs.append(logcost)
-                        dp_query_encodings.append(data[0])
-                        dp_nodes.append(data[1])
-                        dp_hints_sqls.append([hint, sql])
-                        tem = []
-                        tem.append(logcost)
-                        tem.append(sql)
-                        tem.append(hint)
-                        tem.append(0)
-                        tem.append([data[0], data[1]])
-
-                        bayes_tep.append(tem)
-                        assert len(data) == 2
-                    if not FirstTrain:
-                        query_feats = (torch.cat(dp_query_encodings, dim=0)).to(DEVICE)
-                        trees, indexes = TreeConvFeaturize(nodeFeaturizer, dp_nodes)
-                        if torch.cuda.is_available():
-                            trees = trees.to(DEVICE)
-                            indexes = indexes.to(DEVICE)
-                            torch_dpcosts = (torch.tensor(dp_costs)).to(DEVICE)
-                        costbais = []
-                        for i in range(10):
-                            costbais.append(torch.tanh(model[level](query_feats, trees, indexes).to(DEVICE)).add(1))
-                        costbais = torch.cat(costbais, 1)
-                        costbais_mean = torch.mean(costbais, dim=1)
-                        # cost_min, _ = torch.min(costbais, dim=1)
-                        var = torch.sum(torch.pow(costbais - costbais_mean.unsqueeze(1), 2), dim=1)
-                        # ucb = var / var.max() - cost_min / cost_min.max()
-                        # print('ucb ')
-                        # print(ucb)
-                        bayes_list.extend(var.tolist())
-                        costlist = torch.mul(costbais_mean, torch_dpcosts).tolist()
-                    else:
-                        costlist = dp_costs
-                    #                        for i in range(0,len(costlist)):
-                    #                            if (random.random()<greedy):
-                    #                                tem = []
-                    #                                tem.append(dp_costs[i])
-                    #                                tem.append(dp_hints_sqls[i][1])
-                    #                                tem.append(dp_hints_sqls[i][0])
-                    #                                # # # collect train data (latency)
-                    #                                usebuffer = False
-                    #                                for j in exp[level]:
-                    #                                    if (j[2] == dp_hints_sqls[i][0] and j[1] == dp_hints_sqls[i][1]):
-                    #                                        usebuffer = True
-                    #                                        glatency = j[3]
-                    #                                        # print('use buffer')
-                    #                                        break
-                    #                                if (usebuffer == False):
-                    #                                    num = num + 1
-                    #                                    glatency = postgres.GetLatencyFromPg(dp_hints_sqls[i][1], dp_hints_sqls[i][0], verbose=False, check_hint_used=False,
-                    #                                                                       timeout=timeout, dropbuffer=dropbuffer)
-                    #                                    tem.append(glatency)
-                    #                                    tem.append([dp_query_encodings[i],dp_nodes[i]])
-                    #                                    exp[level].append(tem)
-                    #                                    trainBuffer[level].append(tem)
-                    # print(costlist)
-                    for i in range(0, len(costlist)):
-                        if join_ids not in dp_table or dp_table[join_ids][
-                            0] > costlist[i]:
-                            if FirstTrain:
-                                tem = []
-                                tem.append(dp_costs[i])
-                                tem.append(dp_hints_sqls[i][1])
-                                tem.append(dp_hints_sqls[i][0])
-                                # # # collect train data (latency)
-                                usebuffer = False
-                                for j in exp[level]:
-                                    if (j[2] == dp_hints_sqls[i][0] and j[1] == dp_hints_sqls[i][1]):
-                                        usebuffer = True
-                                        latency = j[3]
-                                        dp_nodes[i].info["latency"] = latency
-                                        # print('use buffer')
-                                        break
-                                if (usebuffer == False):
-                                    num = num + 1
-                                    if ((level > num_rels - 1) and slackTimeout(exp[level])):
-                                        latency = postgres.GetLatencyFromPg(dp_hints_sqls[i][1],
-                                                                            dp_hints_sqls[i][0], verbose=False,
-                                                                            check_hint_used=False, timeout=12000,
-                                                                            dropbuffer=dropbuffer)
-                                        print("slack")
-                                        #                                   else:
-                                        #                                          latency =postgres.GetLatencyFromPg(dp_hints_sqls[i][1], dp_hints_sqls[i][0], verbose=False, check_hint_used=False,timeout=timeout*2.0, dropbuffer=dropbuffer)
-                                        print(latency, 'level', level)
-                                    else:
-                                        latency = postgres.GetLatencyFromPg(dp_hints_sqls[i][1],
-                                                                            dp_hints_sqls[i][0], verbose=False,
-                                                                            check_hint_used=False, timeout=timeout,
-                                                                            dropbuffer=dropbuffer)
-                                    # latency = random.random()
-                                    dp_nodes[i].info["latency"] = latency
-                                    tem.append(latency)
-                                    tem.append([dp_query_encodings[i], dp_nodes[i]])
-                                    exp[level].append(tem)
-                                    trainBuffer[level].append(tem)
-                                    if level == num_rels:
-                                        allPlans = [dp_nodes[i]]
-                                        while (allPlans):
-                                            currentNode = allPlans.pop()
-                                            allPlans.extend(currentNode.children)
-                                            for currentChild in currentNode.children:
-                                                temlevel = currentChild.info.get("currentLevel")
-                                                if (not temlevel == None) and temlevel > 1:
-                                                    #  print(currentChild)
-                                                    temsql = currentChild.to_sql(currentChild.info["join_conds"],
-                                                                                 with_select_exprs=True)
-                                                    #    print(temsql)
-                                                    temhint = currentChild.hint_str()
-                                                    found = False
-                                                    for i in subplans_fin:
-                                                        if (
-                                                                i[1] == dp_hints_sqls[i][1],
-                                                                i[2] == dp_hints_sqls[i][0]):
-                                                            found = True
-                                                            break
-                                                    if not found:
-                                                        tem = []
-                                                        tem.append(currentChild.info["cost"])
-                                                        tem.append(temsql)
-                                                        tem.append(temhint)
-                                                        tem.append(currentChild.info["latency"])
-                                                        tem.append([currentChild.info["encoding"], currentChild])
-                                                        subplans_fin[temlevel].append(tem)
-                            dp_table[join_ids] = (costlist[i], dp_join[i])
-            #  nowplansnum = nowplansnum + 1
-            #   if nowplansnum > limit and level > 2:
-            #   print('plan nums = ',num)
-            #    break
-            # print('num = ',len(dp_table))
-            # todo:根据方差收集数据
-
-            if not FirstTrain:
-                # print('bayes_list len :',len(bayes_list))
-                # print('bayes tep num :',len(bayes_tep))
-                # bayes_list 存储的方差
-                bayes_list = torch.tensor(bayes_list)
-                # bayes_tep 所有的计划
-                # item : [logcost ,sql ,hint ,latency,[queryencoding,nodes]]
-                km_query_encodings = []
-                km_nodes = []
-                for item in bayes_tep:
-                    km_query_encodings.append(item[4][0])
-                    km_nodes.append(item[4][1])
-                query_feats = (torch.cat(km_query_encodings, dim=0)).to(DEVICE)
-                # print(query_feats.shape)
-                trees, indexes = TreeConvFeaturize(nodeFeaturizer, km_nodes)
-                if torch.cuda.is_available():
-                    trees = trees.to(DEVICE)
-                    indexes = indexes.to(DEVICE)
-                final_idxes = []  # selected index
-                trees = trees.reshape((trees.shape[0], -1))
-                indexes = indexes.reshape((indexes.shape[0], -1))
-                pool_encodings = torch.cat([query_feats, trees, indexes], dim=1)
-                pool_encodings = pool_encodings.cpu().numpy()
-                n_classes = 10
-                if n_classes > len(pool_encodings):
-                    n_classes = len(pool_encodings)
-                kmeans = KMeans(n_clusters=n_classes, random_state=123).fit(pool_encodings)
-                # print('pool_encodings num',len(pool_encodings))
-                # print('bayes list num ',len(bayes_list))
-                #  print('bayes_tep num ',len(bayes_tep))
-                labels = list(kmeans.labels_)
-                #  print(labels)
-                classes = dict()
-                if level < 4:
-                    p = 0.4
-                else:
-                    p = 0.15
-                for i in range(n_classes):
-                    classes[i] = []
-                    idxs = []
-                    v = []
-                    for idx, label in enumerate(labels):
-                        if label == i:
-                            idxs.append(idx)
-                            v.append(bayes_list[idx])
-                    v = torch.tensor(v)
-                    v_argsort = torch.argsort(v, descending=True)
-                    n = math.ceil(p * len(idxs))
-                    for j in range(n):
-                        final_idxes.append(idxs[v_argsort[j]])
-
-                for i in final_idxes:
-                    bayes_plan = bayes_tep[i]
-                    usebuffer = False
-                    for j in exp[level]:
-                        if (j[2] == bayes_plan[2] and j[1] == bayes_plan[1]):
-                            usebuffer = True
-                            blatency = j[3]
-                            break
-                    if (usebuffer == False):
-                        num = num + 1
-                        if ((level > num_rels - 1) and slackTimeout(exp[level])):
-                            blatency = postgres.GetLatencyFromPg(bayes_plan[1], bayes_plan[2], verbose=False,
-                                                                 check_hint_used=False, timeout=12000,
-                                                                 dropbuffer=dropbuffer)
-                            print("slack")
-                            #                                   else:
-                            #                                          latency =postgres.GetLatencyFromPg(dp_hints_sqls[i][1], dp_hints_sqls[i][0], verbose=False, check_hint_used=False,timeout=timeout*2.0, dropbuffer=dropbuffer)
-                            print(latency, 'level', level)
-                        else:
-                            blatency = postgres.GetLatencyFromPg(bayes_plan[1], bayes_plan[2], verbose=False,
-                                                                 check_hint_used=False, timeout=timeout,
-                                                                 dropbuffer=dropbuffer)
-                    bayes_plan[3] = blatency
-                    if usebuffer == False:
-                        trainBuffer[level].append(copy.deepcopy(bayes_plan))
-                        exp[level].append(copy.deepcopy(bayes_plan))
-
-            if level > 4 and level < 15 and level < num_rels:
-                temtable = copy.deepcopy(dp_table)
-                if not FirstTrain:
-                    temcost = []
-                    temnodes = []
-                    tem_query_encodings = []
-                    for key, values in temtable.items():
-                        temcost.append(values[0])
-                        temnodes.append(values[1].info["node"])
-                        tem_query_encodings.append(values[1].info["encoding"])
-                    #  print("nodes num = ",len(temnodes))
-                    temquery_feats = (torch.cat(tem_query_encodings, dim=0)).to(DEVICE)
-                    temtrees, temindexes = TreeConvFeaturize(nodeFeaturizer, temnodes)
-                    if torch.cuda.is_available():
-                        temtrees = temtrees.to(DEVICE)
-                        temindexes = temindexes.to(DEVICE)
-                        torch_costs = (torch.tensor(temcost)).to(DEVICE)
-                    temcostbais = []
-                    for i in range(10):
-                        temcostbais.append(
-                            torch.tanh(model[-1](temquery_feats, temtrees, temindexes).to(DEVICE)).add(1))
-                    temcostbais = torch.cat(temcostbais, 1)
-                    temcostbais_mean = torch.mean(temcostbais, dim=1)
-                    temcostlist = torch.mul(temcostbais_mean, torch_costs).tolist()
-                    count = 0
-                    for key in temtable:
-                        temtable[key] = (temcostlist[count], temtable[key][1])
-                        count = count + 1
-                sortlist = dict(sorted(temtable.items(), key=lambda x: x[1][0])[math.ceil(len(dp_table) * 0.45):])
-                for key in sortlist:
-                    dp_table.pop(key)
-                dp_tables[level] = dp_table
-        # print('level:',level,'subplans num = ',len(dp_tables[level]))
-        # print('level:',level,'exp num = ',len(exp[level]))
-        bestplanhint = list(dp_tables[num_rels].values())[0][1].hint_str()
-        nowlatency = postgres.GetLatencyFromPg(finsql, bestplanhint, verbose=False, check_hint_used=False,
-                                               timeout=timeout, dropbuffer=dropbuffer)
-        if timeout > nowlatency:
-            timeout = nowlatency
-
-        return trainBuffer, bestplanhint, num, timeout
+        query = DPQuery(self, join_graph, all_join_conds, query_leaves, dp_tables, workload, model,
+                        nodeFeaturizer, exp=exp, FirstTrain=FirstTrain, timeout=timeout, dropbuffer=dropbuffer)
+        stages = DPStages(scoring=CalibratedScoring(num_samples=10, priority='var'),
+                          explore=KMeansExploration(),
+                          collect=LatencyCollection(count=True),
+                          prune=LevelPruning(4, 15, keep=0.45, num_samples=10))
+        return self._RunTrainingDP(query, stages, finsql)
 
     def TEST_left_prune_bayes(self, join_graph, all_join_conds, query_leaves, dp_tables, workload, model,
-                              nodeFeaturizer, costCache):
+                              nodeFeaturizer, costCache, deadline=None):
+        """deadline: optional time.time() value; once it has passed, raises
+        _DeadlineExceeded (see TEST_anytime)."""
+        query = DPQuery(self, join_graph, all_join_conds, query_leaves, dp_tables, workload, model,
+                        nodeFeaturizer, costCache=costCache, deadline=deadline)
+        stages = DPStages(scoring=CalibratedScoring(top_levels=self.params.model_top_levels),
+                          prune=self._LevelPruning(), reuse='left_deep_prune')
+        finnode = list(self._RunDP(query, stages).values())[0][1]
+        return finnode.hint_str(), finnode
+
+    def TEST_beam(self, join_graph, all_join_conds, query_leaves, dp_tables, workload, model,
+                  nodeFeaturizer, costCache, beam_width=None):
+        """Left-deep beam search scored with the calibrated cost.
+
+        Every candidate of level k is scored as TEST_left_prune_bayes scores
+        its top levels, mean(tanh(model[k]) + 1) * log(PG cost).  As in the DP,
+        the best candidate per join set is kept; of those, only the beam width
+        best join sets are extended at level k + 1.
+
+        Args:
+          beam_width: overrides p.beam_width (an int, or a list indexed by
+            level).
 
-        num_rels = len(query_leaves)
-
-        for level in range(2, num_rels + 1):
-            dp_table = dp_tables[level]
+        Returns:
+          (bestplanhint, final plan Node), as TEST_left_prune_bayes.
+        """
+        query = DPQuery(self, join_graph, all_join_conds, query_leaves, dp_tables, workload, model,
+                        nodeFeaturizer, costCache=costCache)
+        width = self.params.beam_width if beam_width is None else beam_width
+        stages = DPStages(pairs=LeftDeepPairs(shuffle=False), scoring=CalibratedScoring(),
+                          prune=BeamPruning(width))
+        finnode = min(self._RunDP(query, stages).values(), key=lambda x: x[0])[1]
+        return finnode.hint_str(), finnode
+
+    def PlanTest(self, join_graph, all_join_conds, query_leaves, dp_tables, workload, model,
+                 nodeFeaturizer, costCache):
+        """TEST_beam if p.search_space is 'beam', else TEST_left_prune_bayes."""
+        if self.params.search_space == 'beam':
+            return self.TEST_beam(join_graph, all_join_conds, query_leaves, dp_tables, workload, model,
+                                  nodeFeaturizer, costCache)
+        return self.TEST_left_prune_bayes(join_graph, all_join_conds, query_leaves, dp_tables, workload,
+                                          model, nodeFeaturizer, costCache)
+
+    def _GreedyLeftDeep(self, join_graph, all_join_conds, query_leaves, dp_tables, workload, costCache,
+                        deadline):
+        """Left-deep plan extended by the cheapest (PG cost) join at every level.
+
+        A beam search of width 1 on PG costs, in its own dp_tables.  Costs go
+        through costCache, so a DP pass run afterwards on the same query finds
+        them there.  Returns None once deadline has passed.
+        """
+        greedy_tables = collections.defaultdict(dict)
+        greedy_tables[1] = dp_tables[1]
+        query = DPQuery(self, join_graph, all_join_conds, query_leaves, greedy_tables, workload,
+                        costCache=costCache, deadline=deadline)
+        stages = DPStages(pairs=LeftDeepPairs(shuffle=False), prune=BeamPruning(1))
+        try:
+            table = self._RunDP(query, stages)
+        except _DeadlineExceeded:
+            return None
+        if not table:
+            # Disconnected join graph: the DP cannot plan it either.
+            return None
+        return list(table.values())[0][1]
+
+    def TEST_anytime(self, join_graph, all_join_conds, query_leaves, dp_tables, workload, model,
+                     nodeFeaturizer, costCache, budget):
+        """TEST_left_prune_bayes under a wall-clock budget.
+
+        First builds a complete plan cheaply (_GreedyLeftDeep, PG costs only),
+        then refines it with TEST_left_prune_bayes, which uses the learned
+        model at the top levels, as long as time allows.  At the deadline the
+        best complete plan so far is returned: the DP plan if the DP finished,
+        else the greedy plan, else None, meaning "run PG's own plan".
+
+        Args:
+          budget: planning time in seconds.  The greedy plan gets
+            params.anytime_greedy_fraction of it, the DP the remainder.
 
-            dp_table_i = random_dic(dp_tables[level - 1])
-            dp_table_j = random_dic(dp_tables[1])
-
-            for l_ids, l_tup in dp_table_i.items():
-                for r_ids, r_tup in dp_table_j.items():
-                    l = l_tup[1]
-                    r = r_tup[1]
-                    if not plans_lib.ExistsJoinEdgeInGraph(
-                            l, r, join_graph):
-                        # No join clause linking two sides.  Skip.
-                        continue
-                    l_ids_splits = l_ids.split(',')
-                    r_ids_splits = r_ids.split(',')
-                    if len(np.intersect1d(l_ids_splits, r_ids_splits)) > 0:
-                        # A relation exists in both sides.  Skip.
-                        continue
-                    join_ids = ','.join(sorted(l_ids_splits + r_ids_splits))
-                    # Otherwise, form a new join.
-                    dp_costs = []
-                    dp_query_encodings = []
-                    dp_nodes = []
-                    dp_hints_sqls = []
-                    dp_join = []
-                    for join in EnumerateJoinWithOps(
-                            l,
-                            r,
-                            self.join_ops,
-                            self.scan_ops,
-                            use_plan_restrictions=self.use_plan_restrictions
-                    ):
-                        join.info["currentLevel"] = level
-                        join_conds = join.KeepRelevantJoins(all_join_conds)
-                        join.info["join_conds"] = join_conds
-                        join.info["join_ids"] = join_ids
-                        cost, sql, hint = self.cost_model.getCost_cache(join, join_conds, costCache)
-                        join.info["cost"] = cost
-                        logcost = math.log(cost)
-                        dp_costs.append(logcost)
-                        dp_hints_sqls.append([hint, sql])
-                        dp_join.append(join)
-                        data = encoding.getencoding_Balsa(sql, hint, workload)
-                        join.info["encoding"] = data[0]
-                        join.info["node"] = data[1]
-                        dp_query_encodings.append(data[0])
-                        dp_nodes.append(data[1])
-
-                    # assert len(data) == 2
-                    # level > num_rels -3
-                    costlist = dp_costs
-                    if level > num_rels - 4:
-                        query_feats = (torch.cat(dp_query_encodings, dim=0)).to(DEVICE)
-                        trees, indexes = TreeConvFeaturize(nodeFeaturizer, dp_nodes)
-                        if torch.cuda.is_available():
-                            trees = trees.to(DEVICE)
-                            indexes = indexes.to(DEVICE)
-                            torch_dpcosts = (torch.tensor(dp_costs)).to(DEVICE)
-
-                        #  costbais = torch.tanh(model[level](query_feats, trees, indexes).to(DEVICE)).add(1).squeeze(1)
-
-                        costbais = []
-
-                        for i in range(10):
-                            with torch.no_grad():
-                                costbais.append(
-                                    torch.tanh(model[level](query_feats, trees, indexes).to(DEVICE)).add(1).detach())
-                        costbais = torch.cat(costbais, 1)
-                        costbais = torch.mean(costbais, dim=1)
-                        # cost_min, _ = torch.min(costbais, dim=1)
-                        #    var = torch.sum(torch.pow(costbais - costbais_mean.unsqueeze(1), 2), dim=1)
-                        # ucb = var / var.max() - cost_min / cost_min.max()
-                        # print('ucb ')
-                        # print(ucb)
-                        # bayes_list.extend(var.tolist())
-                        costlist = torch.mul(costbais, torch_dpcosts).tolist()
-
-                    for i in range(0, len(costlist)):
-                        if join_ids not in dp_table or dp_table[join_ids][
-                            0] > costlist[i]:
-                            dp_table[join_ids] = (costlist[i], dp_join[i])
-            if level > 6 and level < 15 and level < num_rels:
-                temtable = copy.deepcopy(dp_table)
-                temcost = []
-                temnodes = []
-                tem_query_encodings = []
-                for key, values in temtable.items():
-                    temcost.append(values[0])
-                    temnodes.append(values[1].info["node"])
-                    tem_query_encodings.append(values[1].info["encoding"])
-                #  print("nodes num = ",len(temnodes))
-                temquery_feats = (torch.cat(tem_query_encodings, dim=0)).to(DEVICE)
-                temtrees, temindexes = TreeConvFeaturize(nodeFeaturizer, temnodes)
-                if torch.cuda.is_available():
-                    temtrees = temtrees.to(DEVICE)
-                    temindexes = temindexes.to(DEVICE)
-                    torch_costs = (torch.tensor(temcost)).to(DEVICE)
-                # temcostbais = torch.tanh(model[num_rels](temquery_feats, temtrees, temindexes).to(DEVICE)).add(1)
-                temcostbais = []
-                for i in range(10):
-                    with torch.no_grad():
-                        temcostbais.append(
-                            torch.tanh(model[-1](temquery_feats, temtrees, temindexes).to(DEVICE)).add(1))
-                temcostbais = torch.cat(temcostbais, 1)
-                temcostbais = torch.mean(temcostbais, dim=1)
-                temcostlist = torch.mul(temcostbais, torch_costs).tolist()
-                count = 0
-                for key in temtable:
-                    temtable[key] = (temcostlist[count], temtable[key][1])
-                    count = count + 1
-                sortlist = dict(sorted(temtable.items(), key=lambda x: x[1][0])[math.ceil(len(dp_table) * 0.3):])
-                for key in sortlist:
-                    dp_table.pop(key)
-                dp_tables[level] = dp_table
-        bestplanhint = list(dp_tables[num_rels].values())[0][1].hint_str()
-        return bestplanhint, list(dp_tables[num_rels].values())[0][1]
+        Returns:
+          (bestplanhint, final plan Node, stats).  bestplanhint and the Node
+          are None if no complete plan was ready in time.  stats is a dict:
+            source: 'dp', 'greedy' or 'pg', where the returned plan came from.
+            levels_finished: fraction of the DP levels (2..num_rels) completed.
+            elapsed: planning time in seconds.
+            overrun: elapsed - budget; positive if the deadline checks (per
+              pair, level-wide stage and MC-dropout sample) let it run over.
+        """
+        start = time.time()
+        deadline = start + budget
+        num_rels = len(query_leaves)
+        greedy = self._GreedyLeftDeep(join_graph, all_join_conds, query_leaves, dp_tables, workload,
+                                      costCache, start + self.params.anytime_greedy_fraction * budget)
+        try:
+            bestplanhint, finnode = self.TEST_left_prune_bayes(join_graph, all_join_conds, query_leaves,
+                                                               dp_tables, workload, model, nodeFeaturizer,
+                                                               costCache, deadline=deadline)
+            source, levels_finished = 'dp', 1.0
+        except _DeadlineExceeded as e:
+            levels_finished = (e.level - 2) / max(num_rels - 1, 1)
+            if greedy is not None:
+                source, bestplanhint, finnode = 'greedy', greedy.hint_str(), greedy
+            else:
+                source, bestplanhint, finnode = 'pg', None, None
+        elapsed = time.time() - start
+        stats = {
+            'source': source,
+            'levels_finished': levels_finished,
+            'elapsed': elapsed,
+            'overrun': elapsed - budget,
+        }
+        return bestplanhint, finnode, stats
 
     def TEST_left_prune_bayes1(self, join_graph, all_join_conds, query_leaves, dp_tables, workload, model,
                                nodeFeaturizer):
-        num_rels = len(query_leaves)
-
-        for level in range(2, num_rels + 1):
-            dp_table = dp_tables[level]
-
-            dp_table_i = random_dic(dp_tables[level - 1])
-            dp_table_j = random_dic(dp_tables[1])
-
-            for l_ids, l_tup in dp_table_i.items():
-                for r_ids, r_tup in dp_table_j.items():
-                    l = l_tup[1]
-                    r = r_tup[1]
-                    if not plans_lib.ExistsJoinEdgeInGraph(
-                            l, r, join_graph):
-                        # No join clause linking two sides.  Skip.
-                        continue
-                    l_ids_splits = l_ids.split(',')
-                    r_ids_splits = r_ids.split(',')
-                    if len(np.intersect1d(l_ids_splits, r_ids_splits)) > 0:
-                        # A relation exists in both sides.  Skip.
-                        continue
-                    join_ids = ','.join(sorted(l_ids_splits + r_ids_splits))
-                    # Otherwise, form a new join.
-                    dp_costs = []
-                    dp_query_encodings = []
-                    dp_nodes = []
-                    dp_hints_sqls = []
-                    dp_join = []
-                    for join in EnumerateJoinWithOps(
-                            l,
-                            r,
-                            self.join_ops,
-                            self.scan_ops,
-                            use_plan_restrictions=self.use_plan_restrictions
-                    ):
-                        join.info["currentLevel"] = level
-
-                        join_conds = join.KeepRelevantJoins(all_join_conds)
-                        join.info["join_conds"] = join_conds
-                        cost, sql, hint = self.cost_model(join, join_conds)
-                        join.info["cost"] = cost
-                        logcost = math.log(cost)
-                        data = encoding.getencoding_Balsa(sql, hint, workload)
-                        join.info["encoding"] = data[0]
-                        join.info["node"] = data[1]
-                        dp_join.append(join)
-                        dp_costs.append(logcost)
-                        dp_query_encodings.append(data[0])
-                        dp_nodes.append(data[1])
-                        dp_hints_sqls.append([hint, sql])
-                        assert len(data) == 2
-                    query_feats = (torch.cat(dp_query_encodings, dim=0)).to(DEVICE)
-                    trees, indexes = TreeConvFeaturize(nodeFeaturizer, dp_nodes)
-                    if torch.cuda.is_available():
-                        trees = trees.to(DEVICE)
-                        indexes = indexes.to(DEVICE)
-                        torch_dpcosts = (torch.tensor(dp_costs)).to(DEVICE)
-                    # costbais = torch.tanh(model[level](query_feats, trees, indexes).to(DEVICE)).add(1).squeeze(1)
-
-                    costbais = []
-                    for i in range(10):
-                        costbais.append(
-                            torch.tanh(model[level](query_feats, trees, indexes).to(DEVICE)).add(1).detach())
-                    costbais = torch.cat(costbais, 1)
-                    costbais = torch.mean(costbais, dim=1)
-                    # cost_min, _ = torch.min(costbais, dim=1)
-                    #    var = torch.sum(torch.pow(costbais - costbais_mean.unsqueeze(1), 2), dim=1)
-                    # ucb = var / var.max() - cost_min / cost_min.max()
-                    # print('ucb ')
-                    # print(ucb)
-                    # bayes_list.extend(var.tolist())
-                    costlist = torch.mul(costbais, torch_dpcosts).tolist()
-
-                    for i in range(0, len(costlist)):
-                        if join_ids not in dp_table or dp_table[join_ids][
-                            0] > costlist[i]:
-                            dp_table[join_ids] = (costlist[i], dp_join[i])
-            if level > 4 and level < 15 and level < num_rels:
-                temtable = copy.deepcopy(dp_table)
-                temcost = []
-                temnodes = []
-                tem_query_encodings = []
-                for key, values in temtable.items():
-                    temcost.append(values[0])
-                    temnodes.append(values[1].info["node"])
-                    tem_query_encodings.append(values[1].info["encoding"])
-                #  print("nodes num = ",len(temnodes))
-                temquery_feats = (torch.cat(tem_query_encodings, dim=0)).to(DEVICE)
-                temtrees, temindexes = TreeConvFeaturize(nodeFeaturizer, temnodes)
-                if torch.cuda.is_available():
-                    temtrees = temtrees.to(DEVICE)
-                    temindexes = temindexes.to(DEVICE)
-                    torch_costs = (torch.tensor(temcost)).to(DEVICE)
-                # temcostbais = torch.tanh(model[num_rels](temquery_feats, temtrees, temindexes).to(DEVICE)).add(1)
-                temcostbais = []
-                for i in range(10):
-                    temcostbais.append(torch.tanh(model[-1](temquery_feats, temtrees, temindexes).to(DEVICE)).add(1))
-                temcostbais = torch.cat(temcostbais, 1)
-                temcostbais = torch.mean(temcostbais, dim=1)
-                temcostlist = torch.mul(temcostbais, torch_costs).tolist()
-                count = 0
-                for key in temtable:
-                    temtable[key] = (temcostlist[count], temtable[key][1])
-                    count = count + 1
-                sortlist = dict(sorted(temtable.items(), key=lambda x: x[1][0])[math.ceil(len(dp_table) * 0.3):])
-                for key in sortlist:
-                    dp_table.pop(key)
-                dp_tables[level] = dp_table
-        bestplanhint = list(dp_tables[num_rels].values())[0][1].hint_str()
-        return bestplanhint
+        query = DPQuery(self, join_graph, all_join_conds, query_leaves, dp_tables, workload, model,
+                        nodeFeaturizer)
+        stages = DPStages(scoring=CalibratedScoring(num_samples=10),
+                          prune=LevelPruning(4, 15, num_samples=10))
+        return list(self._RunDP(query, stages).values())[0][1].hint_str()
 
     def _dp_dbmsx_search_space(self, original_node, join_graph, all_join_conds,
                                query_leaves, dp_tables):
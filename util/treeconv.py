@@ -62,21 +62,27 @@ class TreeConvolution(nn.Module):
                 # assert 'norm' in name and 'weight' in name, name
                 nn.init.ones_(p)
 
-    def forward(self, query_feats, trees, indexes):
+    def forward(self, query_feats, trees, indexes, query_index=None):
         """Forward pass.
 
         Args:
           query_feats: Query encoding vectors.  Shaped as
-            [batch size, query dims].
+            [batch size, query dims], or [num queries, query dims] if
+            query_index is given.
           trees: The input plan features.  Shaped as
             [batch size, plan dims, max tree nodes].
           indexes: For Tree convolution.
+          query_index: Optional LongTensor, sized [batch size], mapping each
+            plan to its row in query_feats.  Plans of the same query then
+            share a single query_mlp pass.
 
         Returns:
           Predicted costs: Tensor of float, sized [batch size, 1].
         """
 
         query_embs = self.query_mlp(query_feats.unsqueeze(1))
+        if query_index is not None:
+            query_embs = query_embs.index_select(0, query_index)
         query_embs = query_embs.transpose(1, 2)
         max_subtrees = trees.shape[-1]
         #    print(query_embs.shape)
@@ -104,8 +110,9 @@ class TreeConv1d(nn.Module):
         feats = self.weights(
             torch.gather(data, 2,
                          indexes.expand(-1, -1, self._in_dims).transpose(1, 2)))
-        zeros = torch.zeros((data.shape[0], self._out_dims),
-                            device=DEVICE).unsqueeze(2)
+        # Allocated on the input's device so the module is device-agnostic
+        # (and traceable for CPU inference; see util/inference.py).
+        zeros = feats.new_zeros((feats.shape[0], self._out_dims, 1))
         feats = torch.cat((zeros, feats), dim=2)
         return feats, indexes
 
@@ -255,3 +262,15 @@ def make_and_featurize_trees(trees, node_featurizer):
         _batch([_featurize_tree(x, node_featurizer) for x in trees
                 ])).transpose(1, 2)
     return trees, indexes
+
+
+def featurize_tree(tree, node_featurizer):
+    """Returns (node features [n + 1, d], indexes [3n, 1]) of one plan."""
+    return _featurize_tree(tree, node_featurizer), _make_indexes(tree)
+
+
+def batch_trees(features, indexes):
+    """Batches featurize_tree() outputs as make_and_featurize_trees() does."""
+    indexes = torch.from_numpy(_batch(indexes)).long()
+    trees = torch.from_numpy(_batch(features)).transpose(1, 2)
+    return trees, indexes
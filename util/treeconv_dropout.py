@@ -67,21 +67,31 @@ class TreeConvolution(nn.Module):
                 # assert 'norm' in name and 'weight' in name, name
                 nn.init.ones_(p)
 
-    def forward(self, query_feats, trees, indexes):
+    def forward(self, query_feats, trees, indexes, query_index=None):
         """Forward pass.
 
         Args:
           query_feats: Query encoding vectors.  Shaped as
-            [batch size, query dims].
+            [batch size, query dims], or [num queries, query dims] if
+            query_index is given.
           trees: The input plan features.  Shaped as
             [batch size, plan dims, max tree nodes].
           indexes: For Tree convolution.
+          query_index: Optional LongTensor, sized [batch size], mapping each
+            plan to its row in query_feats.  Plans of the same query then
+            share a single query_mlp pass.
 
         Returns:
           Predicted costs: Tensor of float, sized [batch size, 1].
         """
 
         query_embs = self.query_mlp(query_feats.unsqueeze(1))
+        if query_index is not None:
+            query_embs = query_embs.index_select(0, query_index)
+        return self._forward_trees(query_embs, trees, indexes)
+
+    def _forward_trees(self, query_embs, trees, indexes):
+        """Tree conv + output head; query_embs is [batch size, 1, 32]."""
         query_embs = query_embs.transpose(1, 2)
         max_subtrees = trees.shape[-1]
         #    print(query_embs.shape)
@@ -94,6 +104,59 @@ class TreeConvolution(nn.Module):
         return out
 
 
+class MultiLevelTreeConvolution(TreeConvolution):
+    """A single TreeConvolution shared by every DP level.
+
+    The level is fed in through a learned embedding added to the query
+    embedding, so all levels share one trunk (and one optimizer) instead of
+    one network per level.  Use ForLevel() to get a per-level model with the
+    usual (query_feats, trees, indexes, query_index) interface.
+    """
+
+    def __init__(self, feature_size, plan_size, label_size, max_level):
+        super().__init__(feature_size, plan_size, label_size)
+        self.max_level = max_level
+        self.level_embs = nn.Embedding(max_level + 1, 32)
+        nn.init.normal_(self.level_embs.weight, std=0.02)
+
+    def forward(self, query_feats, trees, indexes, levels, query_index=None):
+        """Forward pass.
+
+        Args:
+          query_feats, trees, indexes, query_index: See
+            TreeConvolution.forward().
+          levels: LongTensor, sized [batch size], the DP level of each plan.
+
+        Returns:
+          Predicted costs: Tensor of float, sized [batch size, 1].
+        """
+        query_embs = self.query_mlp(query_feats.unsqueeze(1))
+        if query_index is not None:
+            query_embs = query_embs.index_select(0, query_index)
+        query_embs = query_embs + self.level_embs(levels).unsqueeze(1)
+        return self._forward_trees(query_embs, trees, indexes)
+
+    def ForLevel(self, level):
+        assert 0 <= level <= self.max_level, (level, self.max_level)
+        return LevelView(self, level)
+
+
+class LevelView(nn.Module):
+    """One level of a MultiLevelTreeConvolution; shares its parameters."""
+
+    def __init__(self, model, level):
+        super().__init__()
+        self.model = model
+        self.level = level
+
+    def forward(self, query_feats, trees, indexes, query_index=None):
+        levels = torch.full((trees.shape[0],),
+                            self.level,
+                            dtype=torch.long,
+                            device=trees.device)
+        return self.model(query_feats, trees, indexes, levels, query_index)
+
+
 class TreeConv1d(nn.Module):
     """Conv1d adapted to tree data."""
 
@@ -109,8 +172,9 @@ class TreeConv1d(nn.Module):
         feats = self.weights(
             torch.gather(data, 2,
                          indexes.expand(-1, -1, self._in_dims).transpose(1, 2)))
-        zeros = torch.zeros((data.shape[0], self._out_dims),
-                            device=DEVICE).unsqueeze(2)
+        # Allocated on the input's device so the module is device-agnostic
+        # (and traceable for CPU inference; see util/inference.py).
+        zeros = feats.new_zeros((feats.shape[0], self._out_dims, 1))
         feats = torch.cat((zeros, feats), dim=2)
         return feats, indexes
 